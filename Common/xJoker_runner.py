@@ -0,0 +1,1079 @@
+# -*- coding: utf-8 -*-
+'''
+Process execution shared by the xJoker modules
+
+:platform:      Windows
+
+Install into the ``_utils`` directory of the file roots, the execution
+modules call it through ``__utils__['xjoker_runner.<function>']``:
+
+run
+    Run a command with a timeout and return its decoded output. Output is
+    read while the command runs and capped, so a chatty command can not
+    fill the minion memory.
+run_stream
+    Yield the output lines of a command while it runs.
+powershell
+    Run a script in a pooled long-lived powershell host, or in a fresh
+    powershell process.
+csv_rows
+    Read ``ConvertTo-Csv`` output of a powershell script as dicts.
+parallel
+    Call a function for many items on a bounded number of threads.
+instrument
+    Optionally wrap the public functions of an execution module, so
+    ``xjoker_stats.report`` shows per function where the time goes.
+
+With ``histograms`` (or ``instrument``) set, every command is timed into
+a histogram per label, which ``xjoker_stats.histograms`` reports. It can
+be tuned in the minion config:
+
+.. code-block:: yaml
+
+    xjoker_runner:
+      encoding: ''               # output encoding, default the OEM code page
+      timeout: 600               # default seconds a command may take
+      max_output: 67108864       # bytes of output kept by run()
+      pshost_idle_timeout: 300   # seconds before an idle host is shut down
+      pshost_timeout: 600        # seconds a single host command may take
+      pshost_cmd: ''             # replacement host speaking the same framing
+      pshost_pool_size: 4        # hosts per set of imported modules
+      histograms: False          # keep per label command timings
+      instrument: False          # time every xJoker module function call
+      trace_max_bytes: 67108864  # size at which the call trace file rotates
+
+The ``pshost_*`` settings are still read from ``xjoker_win_iis`` when they
+are not set here.
+'''
+
+from __future__ import absolute_import
+
+# Import salt libs
+import salt.utils
+import salt.utils.atomicfile
+from salt.exceptions import CommandExecutionError
+from salt.ext import six
+from salt.ext.six.moves import queue
+
+import atexit
+import base64
+import codecs
+import collections
+import contextlib
+import csv
+import fnmatch
+import functools
+import inspect
+import json
+import locale
+import logging
+import multiprocessing.util
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+# Define the module's virtual name
+__virtualname__ = 'xjoker_runner'
+
+_LOG = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the histogram buckets, the last one is open
+_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+_STATS_LOCK = threading.Lock()
+_STATS_PENDING = {}
+_STATS_FLUSH = {'pid': None, 'last': 0}
+
+# Instrumented calls, see instrument() and report()
+_TRACE = threading.local()
+_TRACE_PENDING = []
+_SPAN_LOCK = threading.Lock()
+_getargspec = getattr(inspect, 'getfullargspec', getattr(inspect, 'getargspec', None))
+
+# Persistent powershell host pools, one per set of imported modules
+_PSHOST_POOLS = {}
+_PSHOST_LOCK = threading.Lock()
+_PSHOST_FRAME = b'XJOKER-FRAME'
+_PSHOST_QUIT = b'XJOKER-QUIT'
+_PSHOST_BOOTSTRAP = r'''
+$ErrorActionPreference = 'Continue'
+$ProgressPreference = 'SilentlyContinue'
+#IMPORTS#
+$utf8 = New-Object System.Text.UTF8Encoding $false
+while ($true) {
+    $line = [Console]::In.ReadLine()
+    if ($line -eq $null -or $line -eq 'XJOKER-QUIT') { break }
+    $status = 0
+    try {
+        $script = $utf8.GetString([Convert]::FromBase64String($line))
+        $items = @(Invoke-Expression $script 2>&1)
+        if (@($items | Where-Object { $_ -isnot [string] }).Count) {
+            $out = $items | Out-String -Width 4096
+        } else {
+            $out = $items -join "`n"
+        }
+    } catch {
+        $status = 1
+        $out = $_ | Out-String -Width 4096
+    }
+    [Console]::Out.WriteLine('XJOKER-FRAME ' + $status + ' ' + [Convert]::ToBase64String($utf8.GetBytes([string]$out)))
+    [Console]::Out.Flush()
+}
+'''
+# Longest script passed with -EncodedCommand, longer ones go to a file
+_PS_INLINE_MAX = 8000
+
+
+def __virtual__():
+    return __virtualname__
+
+
+def _option(key, default):
+    '''
+    Read ``xjoker_runner:<key>``, the powershell host settings fall back to
+    their former ``xjoker_win_iis`` section
+    '''
+    sections = ('xjoker_runner', 'xjoker_win_iis') if key.startswith('pshost') \
+        else ('xjoker_runner',)
+    for section in sections:
+        conf = __opts__.get(section) or {}
+        if conf.get(key) not in (None, ''):
+            return conf[key]
+    return default
+
+
+def _encoding(encoding=None):
+    '''
+    Encoding of console program output: the OEM code page on Windows
+    '''
+    encoding = encoding or _option('encoding', None)
+    if encoding:
+        return encoding
+    if salt.utils.is_windows():
+        import ctypes
+        return 'cp{0}'.format(ctypes.windll.kernel32.GetOEMCP())
+    return locale.getpreferredencoding() or 'utf-8'
+
+
+def _label(cmd, label):
+    if label:
+        return label
+    exe = cmd if isinstance(cmd, six.string_types) else cmd[0]
+    return os.path.splitext(os.path.basename(str(exe).split()[0]))[0].lower()
+
+
+def _split(cmd):
+    '''
+    Split a command line string into arguments. Backslashes separate
+    Windows paths, so there the string is split in non-POSIX mode, which
+    keeps them, and only the double quotes around a whole word are removed.
+    '''
+    if not salt.utils.is_windows():
+        return salt.utils.shlex_split(cmd)
+    return [x[1:-1] if len(x) > 1 and x[0] == x[-1] == '"' else x
+            for x in salt.utils.shlex_split(cmd, posix=False)]
+
+
+def _popen(cmd, cwd=None, env=None):
+    if isinstance(cmd, six.string_types):
+        cmd = _split(cmd)
+    _LOG.debug('Running %s', cmd)
+    # Own process group, so a timeout kills the children as well
+    preexec_fn = None if salt.utils.is_windows() else os.setsid
+    count('spawns')
+    try:
+        return subprocess.Popen([str(x) for x in cmd],
+                                cwd=cwd,
+                                env=env,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                preexec_fn=preexec_fn)
+    except (IOError, OSError) as exc:
+        raise CommandExecutionError('Unable to run {0}: {1}'.format(cmd[0], exc))
+
+
+def _feed(proc, stdin):
+    if stdin:
+        if isinstance(stdin, six.text_type):
+            stdin = stdin.encode('utf-8')
+        try:
+            proc.stdin.write(stdin)
+        except (IOError, OSError):
+            pass
+    try:
+        proc.stdin.close()
+    except (IOError, OSError):
+        pass
+
+
+def _kill(proc):
+    '''
+    Kill a command together with the processes it started
+    '''
+    if proc.poll() is not None:
+        return
+    if salt.utils.is_windows():
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['taskkill', '/F', '/T', '/PID', str(proc.pid)],
+                            stdout=devnull, stderr=devnull)
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    if proc.poll() is None:
+        proc.kill()
+
+
+class _Watchdog(object):
+    '''
+    Kill a command once it ran ``timeout`` seconds
+    '''
+
+    def __init__(self, proc, timeout):
+        self.fired = False
+        self._timer = None
+        if timeout:
+            self._timer = threading.Timer(float(timeout), self._fire, [proc])
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _fire(self, proc):
+        self.fired = True
+        _kill(proc)
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
+
+def _failure(label, proc, timeout, watchdog, output):
+    if watchdog.fired:
+        return CommandExecutionError('{0} timed out after {1}s:\n{2}'.format(label, timeout, output))
+    return CommandExecutionError('{0} failed with exit code {1}:\n{2}'
+                                 .format(label, proc.returncode, output))
+
+
+def run(cmd,
+        timeout=None,
+        encoding=None,
+        cwd=None,
+        stdin=None,
+        env=None,
+        label=None,
+        ok_codes=(0,),
+        max_output=None):
+    '''
+    Run ``cmd`` (an argument list, or a string split like a shell would)
+    and return its combined stdout and stderr as text with ``\\n`` line
+    ends.
+
+    timeout
+        Seconds before the command and its children are killed, default
+        ``xjoker_runner:timeout``
+    encoding
+        Encoding of the output, default the OEM code page
+    stdin
+        Data written to the command before its stdin is closed
+    label
+        Histogram the timing goes to, default the program name
+    ok_codes
+        Exit codes that are not an error
+    max_output
+        Bytes of output kept, the rest is read and dropped
+
+    Raises ``CommandExecutionError`` with the output on a failing exit code
+    or a timeout.
+    '''
+    label = _label(cmd, label)
+    timeout = _option('timeout', 600) if timeout is None else timeout
+    max_output = int(max_output or _option('max_output', 64 * 1024 * 1024))
+    start = time.time()
+    proc = _popen(cmd, cwd, env)
+    watchdog = _Watchdog(proc, timeout)
+    kept = []
+    size = dropped = 0
+    try:
+        _feed(proc, stdin)
+        fileno = proc.stdout.fileno()
+        while True:
+            chunk = os.read(fileno, 65536)
+            if not chunk:
+                break
+            if size < max_output:
+                chunk, rest = chunk[:max_output - size], chunk[max_output - size:]
+                kept.append(chunk)
+                size += len(chunk)
+                dropped += len(rest)
+            else:
+                dropped += len(chunk)
+        proc.wait()
+    finally:
+        watchdog.cancel()
+        _kill(proc)
+        proc.stdout.close()
+
+    output = b''.join(kept).decode(_encoding(encoding), 'replace').replace('\r\n', '\n')
+    if dropped:
+        _LOG.warning('%s wrote %d bytes more than the %d kept', label, dropped, max_output)
+        output += '\n... {0} bytes of output dropped'.format(dropped)
+    failed = watchdog.fired or proc.returncode not in ok_codes
+    record(label, time.time() - start, error=failed, timed_out=watchdog.fired,
+           nbytes=size + dropped)
+    if failed:
+        raise _failure(label, proc, timeout, watchdog, output.strip())
+    return output
+
+
+def run_stream(cmd,
+               timeout=None,
+               encoding=None,
+               cwd=None,
+               stdin=None,
+               env=None,
+               label=None,
+               ok_codes=(0,)):
+    '''
+    Like ``run``, but yield the output line by line (without line ends)
+    while the command runs. Nothing is kept except the last lines for the
+    error message, so the output may be of any size. Closing the generator
+    early kills the command.
+    '''
+    label = _label(cmd, label)
+    timeout = _option('timeout', 600) if timeout is None else timeout
+    start = time.time()
+    proc = _popen(cmd, cwd, env)
+    watchdog = _Watchdog(proc, timeout)
+    decoder = codecs.getincrementaldecoder(_encoding(encoding))('replace')
+    tail = collections.deque(maxlen=50)
+    complete = False
+    size = 0
+    try:
+        _feed(proc, stdin)
+        for line in iter(proc.stdout.readline, b''):
+            size += len(line)
+            line = decoder.decode(line).rstrip('\r\n')
+            tail.append(line)
+            yield line
+        proc.wait()
+        complete = True
+    finally:
+        watchdog.cancel()
+        _kill(proc)
+        proc.stdout.close()
+        failed = not complete or watchdog.fired or proc.returncode not in ok_codes
+        record(label, time.time() - start, error=failed, timed_out=watchdog.fired,
+               nbytes=size)
+
+    if watchdog.fired or proc.returncode not in ok_codes:
+        raise _failure(label, proc, timeout, watchdog, '\n'.join(tail).strip())
+
+
+class _PSHostDied(Exception):
+    '''
+    The powershell host went away before answering a request
+    '''
+
+
+class _PSHost(object):
+    '''
+    Long-lived powershell process with the modules already imported.
+
+    Every request is one line on stdin holding the base64 encoded UTF-8
+    script. Every reply is one line on stdout of the form
+    ``XJOKER-FRAME <status> <base64 UTF-8 output>``; other lines are
+    ignored. ``XJOKER-QUIT`` (or EOF) ends the host. Any executable that
+    speaks this framing can stand in for powershell.
+    '''
+
+    def __init__(self, argv, idle_timeout=300):
+        self.argv = argv
+        self.idle_timeout = idle_timeout
+        self.proc = None
+        self.lock = threading.Lock()
+        self.last_used = 0
+        self._lines = None
+        self._timer = None
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        _LOG.debug('Starting powershell host: %s', self.argv[0])
+        count('spawns')
+        self.proc = subprocess.Popen(self.argv,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+        self._lines = queue.Queue()
+        pump = threading.Thread(target=self._pump, args=(self.proc, self._lines))
+        pump.daemon = True
+        pump.start()
+
+    @staticmethod
+    def _pump(proc, lines):
+        for line in iter(proc.stdout.readline, b''):
+            lines.put(line)
+        lines.put(None)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        proc, self.proc = self.proc, None
+        if proc is None or proc.poll() is not None:
+            return
+        try:
+            proc.stdin.write(_PSHOST_QUIT + b'\n')
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        deadline = time.time() + 5
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if proc.poll() is None:
+            proc.kill()
+
+    def _idle_check(self):
+        if not self.lock.acquire(False):
+            return
+        try:
+            if self.alive() and time.time() - self.last_used >= self.idle_timeout:
+                _LOG.debug('Powershell host idle for %ss, shutting down', self.idle_timeout)
+                self.stop()
+        finally:
+            self.lock.release()
+
+    def _arm_idle_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        if self.idle_timeout:
+            self._timer = threading.Timer(self.idle_timeout, self._idle_check)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _send(self, script):
+        if not self.alive():
+            self.start()
+        payload = base64.b64encode(script.encode('utf-8'))
+        self.proc.stdin.write(payload + b'\n')
+        self.proc.stdin.flush()
+
+    def execute(self, script, timeout=600):
+        '''
+        Run ``script`` in the host and return ``(status, output)``
+        '''
+        with self.lock:
+            try:
+                self._send(script)
+            except (IOError, OSError):
+                # Nothing reached the host, so it is safe to try again
+                _LOG.warning('Powershell host crashed, restarting')
+                self.stop()
+                self._send(script)
+
+            deadline = time.time() + timeout
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.stop()
+                    raise CommandExecutionError(
+                        'Powershell host timed out after {0}s'.format(timeout))
+                try:
+                    line = self._lines.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+                if line is None:
+                    self.stop()
+                    raise _PSHostDied()
+                fields = line.strip().split(b' ')
+                if fields[0] != _PSHOST_FRAME:
+                    continue
+                output = base64.b64decode(fields[2]) if len(fields) > 2 else b''
+                self.last_used = time.time()
+                self._arm_idle_timer()
+                return int(fields[1]), output.decode('utf-8')
+
+
+class _PSHostPool(object):
+    '''
+    Up to ``size`` hosts shared by the threads of one worker process
+    '''
+
+    def __init__(self, argv, idle_timeout=300, size=4):
+        self.argv = argv
+        self.idle_timeout = idle_timeout
+        self.size = max(1, size)
+        self.hosts = []
+        self.idle = []
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                if self.idle:
+                    return self.idle.pop()
+                if len(self.hosts) < self.size:
+                    host = _PSHost(self.argv, idle_timeout=self.idle_timeout)
+                    self.hosts.append(host)
+                    return host
+                self.cond.wait()
+
+    def release(self, host):
+        with self.cond:
+            self.idle.append(host)
+            self.cond.notify()
+
+    def stop(self):
+        for host in self.hosts:
+            host.stop()
+
+
+def _ps_argv(script):
+    encoded = base64.b64encode(script.encode('utf-16-le')).decode('ascii')
+    return ['powershell', '-NoLogo', '-NoProfile', '-NonInteractive',
+            '-ExecutionPolicy', 'Bypass', '-EncodedCommand', encoded]
+
+
+def _ps_imports(modules):
+    return '\n'.join('Import-Module {0}'.format(x) for x in modules)
+
+
+def _pshost_argv(modules):
+    '''
+    Command line of the persistent host, ``pshost_cmd`` overrides the
+    default powershell bootstrap
+    '''
+    argv = _option('pshost_cmd', None)
+    if argv:
+        return _split(argv) if isinstance(argv, six.string_types) else list(argv)
+    return _ps_argv(_PSHOST_BOOTSTRAP.replace('#IMPORTS#', _ps_imports(modules)))
+
+
+def _pshost_pool(modules):
+    with _PSHOST_LOCK:
+        if modules not in _PSHOST_POOLS:
+            pool = _PSHostPool(_pshost_argv(modules),
+                               idle_timeout=_option('pshost_idle_timeout', 300),
+                               size=_option('pshost_pool_size', 4))
+            atexit.register(pool.stop)
+            _PSHOST_POOLS[modules] = pool
+        return _PSHOST_POOLS[modules]
+
+
+def _powershell_once(script, modules, timeout, label):
+    prelude = '[Console]::OutputEncoding = New-Object System.Text.UTF8Encoding $false\n'
+    script = '{0}{1}\n{2}'.format(prelude, _ps_imports(modules), script)
+    if len(script) <= _PS_INLINE_MAX:
+        return run(_ps_argv(script), timeout=timeout, encoding='utf-8', label=label)
+
+    # The command line is limited to 32k characters
+    path = salt.utils.mkstemp(suffix='.ps1')
+    try:
+        with salt.utils.fopen(path, 'wb') as fp_:
+            fp_.write(codecs.BOM_UTF8 + script.encode('utf-8'))
+        return run(['powershell', '-NoLogo', '-NoProfile', '-NonInteractive',
+                    '-ExecutionPolicy', 'Bypass', '-File', path],
+                   timeout=timeout, encoding='utf-8', label=label)
+    finally:
+        os.remove(path)
+
+
+def powershell(script, modules=(), persistent=True, timeout=None, label='powershell'):
+    '''
+    Run a powershell script and return its output as text.
+
+    With ``persistent`` the script runs in a pooled long-lived host which
+    already imported ``modules``, otherwise in a new powershell process.
+    Errors of the script itself are part of the output, like they are with
+    ``cmd.run``.
+    '''
+    modules = tuple(modules)
+    if not persistent:
+        return _powershell_once(script, modules, timeout, label).rstrip()
+
+    timeout = _option('pshost_timeout', 600) if timeout is None else timeout
+    pool = _pshost_pool(modules)
+    start = time.time()
+    host = pool.acquire()
+    status, output = 1, ''
+    try:
+        status, output = host.execute(script, timeout=timeout)
+    except _PSHostDied:
+        raise CommandExecutionError('Powershell host exited while running: {0}'.format(script))
+    finally:
+        pool.release(host)
+        record(label, time.time() - start, error=bool(status),
+               timed_out=time.time() - start >= timeout, nbytes=len(output))
+    if status:
+        _LOG.debug('Powershell host reported an error for: %s', script)
+    return output.replace('\r\n', '\n').rstrip()
+
+
+def csv_rows(lines):
+    '''
+    Read ConvertTo-Csv output row by row as dicts
+    '''
+    if six.PY2:
+        lines = (line.encode('utf-8') for line in lines)
+    header = None
+    for row in csv.reader(lines):
+        if not row:
+            continue
+        if six.PY2:
+            row = [x.decode('utf-8') for x in row]
+        if header is None:
+            header = row
+            continue
+        yield dict(zip(header, row))
+
+
+def parallel(items, func, concurrency=4, fail_fast=False):
+    '''
+    Call ``func(item)`` for every item on at most ``concurrency`` threads.
+
+    ``func`` returns ``(result, comment)``. Each item gets a dict with
+    ``result``, ``comment`` and ``duration`` in seconds. With
+    ``fail_fast`` items not started before the first failure are skipped
+    and reported with a ``None`` result.
+    '''
+    pending = queue.Queue()
+    for item in items:
+        pending.put(item)
+    results = {}
+    failed = threading.Event()
+    parent = _current()
+
+    def _worker():
+        # Work done on the threads counts for the calling function
+        _TRACE.span = parent
+        while True:
+            try:
+                item = pending.get_nowait()
+            except queue.Empty:
+                return
+            if fail_fast and failed.is_set():
+                results[item] = {'result': None, 'duration': 0.0,
+                                 'comment': 'Skipped after an earlier failure'}
+                continue
+            start = time.time()
+            try:
+                result, comment = func(item)
+            except Exception as exc:
+                result, comment = False, str(exc)
+            results[item] = {'result': result, 'comment': comment,
+                             'duration': round(time.time() - start, 3)}
+            if not result:
+                failed.set()
+
+    workers = [threading.Thread(target=_worker)
+               for _ in range(max(1, min(int(concurrency), len(items))))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+class FileLock(object):
+    '''
+    Exclusive lock file shared by all minion jobs on this host. A lock
+    older than ``stale`` seconds is assumed to be left over from a killed
+    job and is taken over.
+    '''
+
+    def __init__(self, path, timeout=30, stale=120):
+        self.path = path
+        self.timeout = timeout
+        self.stale = stale
+        self.fd = None
+
+    def __enter__(self):
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                self.fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_RDWR)
+                os.write(self.fd, str(os.getpid()).encode('ascii'))
+                return self
+            except OSError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > self.stale:
+                        _LOG.warning('Removing stale lock file %s', self.path)
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    # Released meanwhile, or its directory is missing
+                    pass
+            if time.time() > deadline:
+                raise CommandExecutionError('Timed out waiting for lock {0}'.format(self.path))
+            time.sleep(0.05)
+
+    def __exit__(self, *args):
+        os.close(self.fd)
+        os.remove(self.path)
+
+
+def file_lock(path, timeout=30, stale=120):
+    '''
+    Context manager holding the lock file ``path``, see ``FileLock``
+    '''
+    return FileLock(path, timeout, stale)
+
+
+class _Span(object):
+    '''
+    One instrumented function call. Counters are inclusive: whatever a
+    nested call or command adds is added to every enclosing span as well.
+    '''
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.start = time.time()
+        self.counters = collections.defaultdict(float)
+
+
+def _current():
+    return getattr(_TRACE, 'span', None)
+
+
+def count(name, value=1):
+    '''
+    Add ``value`` to counter ``name`` (``cache_hits``, ``cache_misses``,
+    ``bytes``, ...) of the instrumented call running in this thread. A
+    no-op when no call is instrumented.
+    '''
+    span = _current()
+    if span is None:
+        return
+    with _SPAN_LOCK:
+        while span is not None:
+            span.counters[name] += value
+            span = span.parent
+
+
+@contextlib.contextmanager
+def span(name):
+    '''
+    Time the block as a call of ``name`` for ``report`` and the trace
+    '''
+    parent = _current()
+    current = _Span(name, parent)
+    _TRACE.span = current
+    error = False
+    try:
+        yield current
+    except Exception:
+        error = True
+        raise
+    finally:
+        _TRACE.span = parent
+        seconds = time.time() - current.start
+        with _STATS_LOCK:
+            stats = _pending()['functions'].setdefault(name, _new_call_stats())
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            stats['wall'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            for key, value in six.iteritems(current.counters):
+                stats[key] = stats.get(key, 0) + value
+        _event(name, 'function', current.start, seconds, dict(current.counters, error=error))
+
+
+def _wrap(func, name):
+    '''
+    Instrumented copy of ``func`` with the very same signature, so the
+    loader passes arguments to it exactly like to ``func``
+    '''
+    spec = _getargspec(func)
+    defaults = spec.defaults or ()
+    first_default = len(spec.args) - len(defaults)
+    params = []
+    call = []
+    for idx, arg in enumerate(spec.args):
+        if idx >= first_default:
+            params.append('{0}=_xjoker_defaults[{1}]'.format(arg, idx - first_default))
+        else:
+            params.append(arg)
+        call.append(arg)
+    if spec.varargs:
+        params.append('*' + spec.varargs)
+        call.append('*' + spec.varargs)
+    varkw = getattr(spec, 'keywords', None) or getattr(spec, 'varkw', None)
+    if varkw:
+        params.append('**' + varkw)
+        call.append('**' + varkw)
+
+    def _xjoker_call(*args, **kwargs):
+        with span(name):
+            return func(*args, **kwargs)
+
+    namespace = {'_xjoker_call': _xjoker_call, '_xjoker_defaults': defaults}
+    source = 'def _xjoker_wrapper({0}):\n    return _xjoker_call({1})\n'.format(
+        ', '.join(params), ', '.join(call))
+    six.exec_(source, namespace)
+    wrapper = functools.update_wrapper(namespace['_xjoker_wrapper'], func)
+    wrapper._xjoker_instrumented = True
+    return wrapper
+
+
+def instrument(namespace, virtualname):
+    '''
+    Wrap the public functions of an execution module for ``report`` when
+    ``xjoker_runner:instrument`` is True. Called from ``__virtual__`` with
+    the module ``globals()``, before the loader collects the functions;
+    without the setting nothing is wrapped and nothing is slower.
+    '''
+    if not _option('instrument', False):
+        return
+    module = namespace.get('__name__')
+    for name, func in list(namespace.items()):
+        if name.startswith('_') or not inspect.isfunction(func):
+            continue
+        if func.__module__ != module or getattr(func, '_xjoker_instrumented', False):
+            continue
+        namespace[name] = _wrap(func, '{0}.{1}'.format(virtualname, name))
+
+
+def _new_stats():
+    return {'count': 0, 'errors': 0, 'timeouts': 0, 'total': 0.0, 'max': 0.0,
+            'buckets': [0] * (len(_BUCKETS) + 1)}
+
+
+def _new_call_stats():
+    return {'calls': 0, 'errors': 0, 'wall': 0.0, 'max': 0.0}
+
+
+def _merge_stats(into, stats):
+    for label, rec in six.iteritems(stats.get('commands', {})):
+        target = into.setdefault('commands', {}).setdefault(label, _new_stats())
+        for key in ('count', 'errors', 'timeouts', 'total'):
+            target[key] += rec.get(key, 0)
+        target['max'] = max(target['max'], rec.get('max', 0.0))
+        for idx, num in enumerate(rec.get('buckets', [])[:len(target['buckets'])]):
+            target['buckets'][idx] += num
+    for name, rec in six.iteritems(stats.get('functions', {})):
+        target = into.setdefault('functions', {}).setdefault(name, _new_call_stats())
+        for key, value in six.iteritems(rec):
+            if key == 'max':
+                target['max'] = max(target['max'], value)
+            else:
+                target[key] = target.get(key, 0) + value
+    return into
+
+
+def _stats_path(name='stats.json'):
+    path = os.path.join(__opts__['cachedir'], 'xjoker_runner')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return os.path.join(path, name)
+
+
+def _read_stats(path):
+    try:
+        with salt.utils.fopen(path, 'r') as fp_:
+            return json.load(fp_)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _write_stats(path, stats):
+    with salt.utils.atomicfile.atomic_open(path, 'w') as fp_:
+        json.dump(stats, fp_)
+
+
+def _pending():
+    '''
+    Timings of this process not saved yet, called with ``_STATS_LOCK``
+    held
+    '''
+    pid = os.getpid()
+    if _STATS_FLUSH['pid'] != pid:
+        # A forked job starts with the timings of its parent, those are
+        # the parent's to save
+        _STATS_PENDING.clear()
+        del _TRACE_PENDING[:]
+        _STATS_FLUSH['pid'] = pid
+        _STATS_FLUSH['last'] = time.time()
+        multiprocessing.util.Finalize(None, flush, exitpriority=10)
+        atexit.register(flush)
+    if not _STATS_PENDING:
+        _STATS_PENDING.update({'commands': {}, 'functions': {}})
+    return _STATS_PENDING
+
+
+def _event(name, cat, start, seconds, args=None):
+    '''
+    Queue a complete event of the Chrome trace format
+    '''
+    if _current() is None and cat != 'function':
+        return
+    event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(),
+             'tid': threading.current_thread().ident,
+             'ts': int(start * 1000000), 'dur': int(seconds * 1000000)}
+    if args:
+        event['args'] = args
+    with _STATS_LOCK:
+        _pending()
+        _TRACE_PENDING.append(event)
+
+
+def _append_trace(events):
+    '''
+    Append events to the minion trace file. It is kept as a JSON array
+    without the closing bracket, which trace viewers accept, so every job
+    can append to it.
+    '''
+    path = _stats_path('trace.json')
+    if os.path.isfile(path) and os.path.getsize(path) > _option('trace_max_bytes', 64 * 1024 * 1024):
+        shutil.move(path, path + '.1')
+    with salt.utils.fopen(path, 'a') as fp_:
+        if not fp_.tell():
+            fp_.write('[\n')
+        for event in events:
+            fp_.write(json.dumps(event))
+            fp_.write(',\n')
+
+
+def flush():
+    '''
+    Merge the timings recorded by this process into the minion wide
+    files in the cachedir
+    '''
+    with _STATS_LOCK:
+        pending = dict(_STATS_PENDING)
+        events = list(_TRACE_PENDING)
+        _STATS_PENDING.clear()
+        del _TRACE_PENDING[:]
+        _STATS_FLUSH['last'] = time.time()
+    if not pending and not events:
+        return
+    try:
+        path = _stats_path()
+        with file_lock(path + '.lock', timeout=5):
+            if pending:
+                _write_stats(path, _merge_stats(_read_stats(path), pending))
+            if events:
+                _append_trace(events)
+    except (IOError, OSError, CommandExecutionError) as exc:
+        _LOG.debug('Unable to save command timings: %s', exc)
+
+
+def record(label, seconds, error=False, timed_out=False, nbytes=0):
+    '''
+    Add one command run of ``seconds`` to the histogram of ``label``, and
+    to the instrumented call running in this thread.
+
+    Timings are kept in memory and merged into a file in the minion
+    cachedir every few seconds and when the process ends, so the numbers
+    of all minion jobs add up. Nothing is recorded unless
+    ``xjoker_runner:histograms`` or ``xjoker_runner:instrument`` is set.
+    '''
+    if not (_option('histograms', False) or _option('instrument', False)):
+        return
+    with _STATS_LOCK:
+        rec = _pending()['commands'].setdefault(label, _new_stats())
+        rec['count'] += 1
+        rec['errors'] += int(bool(error))
+        rec['timeouts'] += int(bool(timed_out))
+        rec['total'] += seconds
+        rec['max'] = max(rec['max'], seconds)
+        idx = len(_BUCKETS)
+        for pos, bound in enumerate(_BUCKETS):
+            if seconds <= bound:
+                idx = pos
+                break
+        rec['buckets'][idx] += 1
+        due = time.time() - _STATS_FLUSH['last'] > 5
+
+    count('commands')
+    count('command_time', seconds)
+    count('bytes', nbytes)
+    _event(label, 'command', time.time() - seconds, seconds,
+           {'bytes': nbytes, 'error': bool(error)})
+    if due:
+        flush()
+
+
+def _reset(section):
+    path = _stats_path()
+    with file_lock(path + '.lock', timeout=5):
+        stats = _read_stats(path)
+        _write_stats(path, dict(stats, **{section: {}}))
+    return stats
+
+
+def histograms(label=None, reset=False):
+    '''
+    Command timings per label: ``count``, ``errors``, ``timeouts``,
+    ``total``, ``mean`` and ``max`` seconds, and ``buckets``: the number
+    of runs per duration bucket, shortest first
+    '''
+    flush()
+    stats = _reset('commands') if reset else _read_stats(_stats_path())
+
+    bounds = ['<={0}s'.format(x) for x in _BUCKETS] + ['>{0}s'.format(_BUCKETS[-1])]
+    ret = {}
+    for name, rec in six.iteritems(stats.get('commands', {})):
+        if label and name != label:
+            continue
+        ret[name] = {
+            'count': rec['count'],
+            'errors': rec['errors'],
+            'timeouts': rec['timeouts'],
+            'total': round(rec['total'], 3),
+            'mean': round(rec['total'] / rec['count'], 3) if rec['count'] else 0.0,
+            'max': round(rec['max'], 3),
+            'buckets': [{bound: num} for bound, num in zip(bounds, rec['buckets'])],
+        }
+    return ret
+
+
+def report(function=None, trace_file=None, reset=False):
+    '''
+    Totals per instrumented function: ``calls``, ``errors``, ``wall``,
+    ``mean`` and ``max`` seconds, and the inclusive ``spawns`` (processes
+    started), ``commands`` (commands run, in a new process or a
+    powershell host), ``command_time``, ``bytes`` of output parsed,
+    ``cache_hits`` and ``cache_misses``.
+
+    With ``trace_file`` the trace of all instrumented calls is also
+    written there as a Chrome trace JSON array (chrome://tracing,
+    Perfetto, speedscope).
+    '''
+    flush()
+    stats = _reset('functions') if reset else _read_stats(_stats_path())
+
+    ret = {}
+    for name, rec in six.iteritems(stats.get('functions', {})):
+        if function and not fnmatch.fnmatch(name, function):
+            continue
+        item = {
+            'calls': rec['calls'],
+            'errors': rec['errors'],
+            'wall': round(rec['wall'], 3),
+            'mean': round(rec['wall'] / rec['calls'], 3) if rec['calls'] else 0.0,
+            'max': round(rec['max'], 3),
+        }
+        for key in ('spawns', 'commands', 'bytes', 'cache_hits', 'cache_misses'):
+            item[key] = int(rec.get(key, 0))
+        item['command_time'] = round(rec.get('command_time', 0.0), 3)
+        ret[name] = item
+
+    if trace_file:
+        path = _stats_path('trace.json')
+        with file_lock(_stats_path() + '.lock', timeout=5):
+            try:
+                with salt.utils.fopen(path, 'r') as fp_:
+                    body = fp_.read().rstrip().rstrip(',')
+            except (IOError, OSError):
+                body = '['
+            if reset and os.path.isfile(path):
+                os.remove(path)
+        with salt.utils.atomicfile.atomic_open(trace_file, 'w') as fp_:
+            fp_.write(body + '\n]\n')
+    return ret
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+'''
+Command timings of the xJoker modules
+
+:platform:      Windows
+
+Install into the ``_modules`` directory of the file roots, next to the
+``xjoker_runner`` utils module in ``_utils``.
+'''
+from __future__ import absolute_import
+
+# Define the module's virtual name
+__virtualname__ = 'xjoker_stats'
+
+
+def __virtual__():
+    '''
+    Load only if the xjoker_runner utils module is available
+    '''
+    if 'xjoker_runner.histograms' in __utils__:
+        return __virtualname__
+    return (False, 'Module xjoker_stats: the xjoker_runner utils module is missing')
+
+
+def histograms(label=None, reset=False):
+    '''
+    Timing histogram of every command the xJoker modules ran on this
+    minion, per label (``iis``, ``service``, ``svn``, ``netsh``,
+    ``goodsync``, ``icacls``, ...)
+
+    Every label has ``count``, ``errors``, ``timeouts``, ``total``,
+    ``mean`` and ``max`` seconds, and ``buckets`` with the number of runs
+    per duration bucket. ``reset=True`` clears the numbers after reading
+    them. Commands are only timed with ``xjoker_runner:histograms`` or
+    ``xjoker_runner:instrument`` set in the minion config.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_stats.histograms
+        salt '*' xjoker_stats.histograms svn reset=True
+    '''
+    return __utils__['xjoker_runner.histograms'](label=label, reset=reset)
+
+
+def report(function=None, trace_file=None, reset=False):
+    '''
+    Where the time of the xJoker module functions goes, recorded when
+    ``xjoker_runner:instrument`` is True in the minion config
+
+    Returns per function (a glob like ``xjoker_svn.*`` limits the list)
+    the ``calls``, ``errors``, ``wall``, ``mean`` and ``max`` seconds,
+    plus the ``spawns`` (processes started), ``commands`` run,
+    ``command_time``, ``bytes`` of output parsed, ``cache_hits`` and
+    ``cache_misses``. Nested calls are included in their caller.
+
+    ``trace_file`` also writes every recorded call and command as a Chrome
+    trace JSON file, to load into chrome://tracing, Perfetto or
+    speedscope. ``reset=True`` clears the numbers and the trace after
+    reading them.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_stats.report
+        salt '*' xjoker_stats.report 'xjoker_win_iis.*' trace_file='c:\\salt\\var\\trace.json'
+    '''
+    return __utils__['xjoker_runner.report'](function=function, trace_file=trace_file,
+                                             reset=reset)
@@ -5,13 +5,11 @@ from __future__ import absolute_import
 # Import python libs
 import logging
 import os
-import subprocess
 
 # 用于读取用户SID而导入的库
 import win32security
 
 import salt.utils
-from salt import utils, exceptions
 
 
 __virtualname__ = 'xjoker_goodsync'
@@ -22,7 +20,10 @@ _GoodSyncLang=""
 
 def __virtual__():
     if salt.utils.is_windows():
+        if 'xjoker_runner.run' not in __utils__:
+            return False, "xjoker_runner utils module is missing"
         if os.path.isfile(_Gsync_path):
+            __utils__['xjoker_runner.instrument'](globals(), __virtualname__)
             return True
         else:
             return False, "Normal path cannot find gsync"
@@ -38,14 +39,13 @@ def _run_cmd(cmd,RunasUsername):
         base_cmd.extend([i])
 
     _LOG.info(base_cmd)
-    p = subprocess.Popen(base_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    stdout, stderr = p.communicate()
-    if p.returncode==0:
+    try:
+        return __utils__['xjoker_runner.run'](
+            base_cmd,
+            timeout=__salt__['config.get']('xjoker_goodsync:timeout', None),
+            label='goodsync')
+    finally:
         _SetGoodSyncLanguageToDefault(RunasUsername,c)
-        return stdout
-
-    _SetGoodSyncLanguageToDefault(RunasUsername,c)
-    raise exceptions.CommandExecutionError(stdout+ '\n\n')
 
 def sayhi():
     return "Hi xJoker."
@@ -6,29 +6,89 @@ Microsoft IIS site management via WebAdministration powershell module
 
 .. versionadded:: 2016.3.0
 
+Needs the ``xjoker_runner`` utils module. Commands run in its long-lived
+powershell hosts, so WebAdministration is only imported once; the hosts
+are tuned with the ``xjoker_runner:pshost_*`` settings. The module itself
+can be tuned in the minion config:
+
+.. code-block:: yaml
+
+    xjoker_win_iis:
+      pshost: True               # False starts a new powershell per call
+      inventory_ttl: 60          # seconds the site/apppool index is cached
+      backend: appcmd            # 'config' reads applicationHost.config directly
+      config_path: ''            # applicationHost.config location for that backend
+      acl_timeout: 600           # seconds create_site waits for its ACL job
+      acl_job_ttl: 3600          # seconds a finished ACL job is kept unreported
+
 '''
 
 from __future__ import absolute_import
 
 # Import salt libs
 import salt.utils
+import salt.utils.atomicfile
 import os
-import subprocess
-from salt.exceptions import SaltInvocationError
-
+from salt.exceptions import SaltInvocationError, CommandExecutionError
+from salt.ext import six
+
+import contextlib
+import fnmatch
+import io
+import itertools
+import json
 import logging
+import mmap
+import shutil
+import threading
+import time
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+# Used to check existing ACLs in incremental mode
+try:
+    import ntsecuritycon
+    import win32security
+    HAS_WIN32 = True
+except ImportError:
+    HAS_WIN32 = False
 
 # Define the module's virtual name
 __virtualname__ = 'xjoker_win_iis'
 
 _LOG = logging.getLogger(__name__)
 _VALID_PROTOCOLS = ('ftp', 'http', 'https')  # Allow protocols string
+_INVENTORY_KEY = 'xjoker_win_iis.inventory'
+_APPPOOL_ATTRS = {
+    'auto_start': 'autoStart',
+    'runtime_version': 'managedRuntimeVersion',
+    'pipeline_mode': 'managedPipelineMode',
+    'enable_32bit': 'enable32BitAppOnWin64',
+}
+_APPPOOL_SCHEMA_DEFAULTS = {
+    'auto_start': 'true',
+    'runtime_version': 'v4.0',
+    'pipeline_mode': 'Integrated',
+    'enable_32bit': 'false',
+    'identity_type': 'ApplicationPoolIdentity',
+}
+
+# Directory ACL jobs of this worker process, job id -> _AclJob
+_ACL_JOBS = {}
+_ACL_LOCK = threading.Lock()
+_ACL_IDS = itertools.count()
 
 def __virtual__():
     '''
     Load only on Windows
     '''
     if salt.utils.is_windows():
+        if 'xjoker_runner.powershell' not in __utils__:
+            return (False, 'Module xjoker_win_iis: the xjoker_runner utils module is missing')
+        __utils__['xjoker_runner.instrument'](globals(), __virtualname__)
         return __virtualname__
     return (False, 'Module xjoker_win_iis: module only works on Windows systems')
 
@@ -38,7 +98,6 @@ def _srvmgr(func, xml=False):
     Execute a function from the WebAdministration PS module
     '''
 
-    command = 'Import-Module WebAdministration;'
     appcmd = "$appcmd=$env:windir + \"\system32\\inetsrv\\appcmd\";"
     if xml:
         appcmd_path = os.environ['WINDIR']+"\\system32\\inetsrv\\appcmd.exe"
@@ -48,10 +107,13 @@ def _srvmgr(func, xml=False):
         else:
             return False
     else:
-        command = '{0} {1}'.format(command, func)
+        command = func
 
-    cmd_ret = __salt__['cmd.run'](command, shell='powershell', python_shell=True)
-    return cmd_ret
+    return __utils__['xjoker_runner.powershell'](
+        command,
+        modules=('WebAdministration',),
+        persistent=__salt__['config.get']('xjoker_win_iis:pshost', True),
+        label='iis')
 
 def _get_binding_info(hostheader='', ipaddress='*', port=80):
     '''
@@ -62,11 +124,960 @@ def _get_binding_info(hostheader='', ipaddress='*', port=80):
     return ret
 
 
+def _ps_quote(value):
+    '''
+    Quote a value as a powershell single quoted string
+    '''
+    return "'{0}'".format(six.text_type(value).replace("'", "''"))
+
+
+def _site_path(name):
+    return _ps_quote(r'IIS:\Sites\{0}'.format(name))
+
+
+def _apppool_path(name):
+    return _ps_quote(r'IIS:\AppPools\{0}'.format(name))
+
+
+def _batch_create_apppool(name):
+    path = _apppool_path(name)
+    return [
+        "if (Test-Path -LiteralPath {0}) {{ $r.comment = 'AppPool already present' }}".format(path),
+        "else {",
+        " New-WebAppPool -Name {0} | Out-Null;".format(_ps_quote(name)),
+        " $r.changed = $true; $r.result = [bool](Test-Path -LiteralPath {0})".format(path),
+        "}",
+    ]
+
+
+def _batch_remove_apppool(name):
+    path = _apppool_path(name)
+    return [
+        "if (-not (Test-Path -LiteralPath {0})) {{ $r.comment = 'AppPool already absent' }}".format(path),
+        "else {",
+        " Remove-Item -LiteralPath {0} -Recurse;".format(path),
+        " $r.changed = $true; $r.result = -not (Test-Path -LiteralPath {0})".format(path),
+        "}",
+    ]
+
+
+def _batch_create_site(name, sourcepath, port='80', apppool='', hostheader='',
+                       ipaddress='*', site_id=None, **kwargs):
+    # An unknown or empty apppool falls back to a new pool named after the
+    # site, unless such a pool already exists
+    path = _site_path(name)
+    name_pool = _apppool_path(name)
+    if site_id:
+        get_id = "$id = {0}".format(int(site_id))
+    else:
+        get_id = ("$id = (dir iis:\\sites | foreach {$_.id} | sort -Descending"
+                  " | select -first 1) + 1")
+    # The id, pool and state of a new site are returned under ``index``
+    # so the cached inventory can be updated without reading it again
+    return [
+        "if (Test-Path -LiteralPath {0}) {{ $r.comment = 'Site already present' }}".format(path),
+        "else {",
+        " $pool = {0};".format(_ps_quote(apppool)),
+        " if (-not $pool -or -not (Test-Path -LiteralPath ('IIS:\\AppPools\\' + $pool))) {",
+        "  if (Test-Path -LiteralPath {0}) {{ throw 'Invalid AppPool Name!' }}".format(name_pool),
+        "  New-WebAppPool -Name {0} | Out-Null; $pool = {0}".format(_ps_quote(name)),
+        " }",
+        " if (-not (Test-Path -LiteralPath {0})) {{ New-Item -ItemType Directory -Path {0} -Force | Out-Null }}"
+        .format(_ps_quote(sourcepath)),
+        " {0};".format(get_id),
+        " New-Website -Name {0} -PhysicalPath {1} -ApplicationPool $pool -Port {2}"
+        " -IPAddress {3} -HostHeader {4} -id $id | Out-Null;".format(
+            _ps_quote(name), _ps_quote(sourcepath), _ps_quote(port),
+            _ps_quote(ipaddress), _ps_quote(hostheader)),
+        " $r.changed = $true; $r.result = [bool](Test-Path -LiteralPath {0});".format(path),
+        " $r.index = @{{site_id=[int]$id; apppool=$pool; state=(Get-WebsiteState -Name {0}).Value}}"
+        .format(_ps_quote(name)),
+        "}",
+    ]
+
+
+def _batch_remove_site(name):
+    path = _site_path(name)
+    return [
+        "if (-not (Test-Path -LiteralPath {0})) {{ $r.comment = 'Site already absent' }}".format(path),
+        "else {",
+        " Remove-WebSite -Name {0};".format(_ps_quote(name)),
+        " $r.changed = $true; $r.result = -not (Test-Path -LiteralPath {0})".format(path),
+        "}",
+    ]
+
+
+def _batch_has_binding(site, info, protocol=''):
+    match = '$_.bindingInformation -eq {0}'.format(_ps_quote(info))
+    if protocol:
+        match += ' -and $_.protocol -eq {0}'.format(_ps_quote(protocol))
+    return ("@(Get-WebBinding -Name {0} | Where-Object {{ {1} }}).Count"
+            .format(_ps_quote(site), match))
+
+
+def _batch_create_binding(site, hostheader='', ipaddress='*', port=80, protocol='http'):
+    protocol = str(protocol).lower()
+    if protocol not in _VALID_PROTOCOLS:
+        message = ("Invalid protocol '{0}' specified. Valid formats:"
+                   ' {1}').format(protocol, _VALID_PROTOCOLS)
+        raise SaltInvocationError(message)
+    check = _batch_has_binding(site, _get_binding_info(hostheader, ipaddress, port), protocol)
+    return [
+        "if ({0}) {{ $r.comment = 'Binding already present' }}".format(check),
+        "else {",
+        " New-WebBinding -Name {0} -HostHeader {1} -IPAddress {2} -Port {3} -Protocol {4};".format(
+            _ps_quote(site), _ps_quote(hostheader), _ps_quote(ipaddress),
+            _ps_quote(port), _ps_quote(protocol)),
+        " $r.changed = $true; $r.result = [bool]({0})".format(check),
+        "}",
+    ]
+
+
+def _batch_remove_binding(site, hostheader='', ipaddress='*', port=80, protocol=''):
+    protocol = str(protocol).lower()
+    check = _batch_has_binding(site, _get_binding_info(hostheader, ipaddress, port), protocol)
+    remove = "Remove-WebBinding -Name {0} -HostHeader {1} -IPAddress {2} -Port {3}".format(
+        _ps_quote(site), _ps_quote(hostheader), _ps_quote(ipaddress), _ps_quote(port))
+    if protocol:
+        remove += " -Protocol {0}".format(_ps_quote(protocol))
+    return [
+        "if (-not ({0})) {{ $r.comment = 'Binding already absent' }}".format(check),
+        "else {",
+        " {0};".format(remove),
+        " $r.changed = $true; $r.result = -not ({0})".format(check),
+        "}",
+    ]
+
+
+def _batch_set_apppool(name, settings):
+    # settings is keyed by inventory record keys, see _APPPOOL_ATTRS
+    path = _apppool_path(name)
+    script = ["if (-not (Test-Path -LiteralPath {0})) {{ $r.result = $false; $r.comment = 'Not found' }}"
+              .format(path), "else {"]
+    for key, value in sorted(settings.items()):
+        if value in ('true', 'false'):
+            value = '$' + value
+        else:
+            value = _ps_quote(value)
+        script.append(" Set-ItemProperty -LiteralPath {0} -Name {1} -Value {2};"
+                      .format(path, _APPPOOL_ATTRS[key], value))
+    script.append(" $r.changed = $true")
+    script.append("}")
+    return script
+
+
+def _batch_control(template, test_path):
+    def _step(name):
+        path = test_path(name)
+        return [
+            "if (-not (Test-Path -LiteralPath {0})) {{ $r.result = $false; $r.comment = 'Not found' }}"
+            .format(path),
+            "else {{ {0}; $r.changed = $true }}".format(template.format(_ps_quote(name))),
+        ]
+    return _step
+
+
+_BATCH_STEPS = {
+    'create_apppool': _batch_create_apppool,
+    'remove_apppool': _batch_remove_apppool,
+    'set_apppool': _batch_set_apppool,
+    'create_site': _batch_create_site,
+    'remove_site': _batch_remove_site,
+    'create_binding': _batch_create_binding,
+    'remove_binding': _batch_remove_binding,
+    'start_site': _batch_control('Start-WebSite {0}', _site_path),
+    'stop_site': _batch_control('Stop-WebSite {0}', _site_path),
+    'restart_site': _batch_control('Stop-WebSite {0}; Start-WebSite {0}', _site_path),
+    'start_apppool': _batch_control('Start-WebAppPool {0}', _apppool_path),
+    'stop_apppool': _batch_control('Stop-WebAppPool {0}', _apppool_path),
+    'restart_apppool': _batch_control('Restart-WebAppPool {0}', _apppool_path),
+}
+
+
+def _batch_script(steps, fail_fast=False):
+    '''
+    Generate one powershell script running every step and printing the
+    per-step results as a JSON list. With ``fail_fast`` the steps after
+    the first failed one are skipped with a None result.
+    '''
+    script = ['$__results = @(); $__stop = $false;']
+    for idx, step in enumerate(steps):
+        step = dict(step)
+        op = step.pop('op', None)
+        if op not in _BATCH_STEPS:
+            raise SaltInvocationError("Invalid batch op '{0}'. Valid ops: {1}"
+                                      .format(op, sorted(_BATCH_STEPS)))
+        label = step.get('name', step.get('site', ''))
+        script.append("$r = @{{step={0}; op={1}; name={2}; result=$true; changed=$false; comment=''}};"
+                      .format(idx, _ps_quote(op), _ps_quote(label)))
+        script.append("if ($__stop) { $r.result = $null; $r.comment = 'Skipped after an earlier failure' }")
+        script.append('else { $__sw = [Diagnostics.Stopwatch]::StartNew();')
+        script.append('try {')
+        script.extend(_BATCH_STEPS[op](**step))
+        script.append('} catch { $r.result = $false; $r.comment = $_.Exception.Message };')
+        script.append('$r.duration = [math]::Round($__sw.Elapsed.TotalSeconds, 3) };')
+        if fail_fast:
+            script.append('if ($r.result -eq $false) { $__stop = $true };')
+        script.append('$__results += ,$r;')
+    script.append('ConvertTo-Json -InputObject @($__results) -Compress -Depth 4')
+    return '\n'.join(script)
+
+
+def _parse_json(output):
+    '''
+    Load the JSON document printed last by a powershell script
+    '''
+    for line in reversed((output or '').splitlines()):
+        line = line.strip()
+        if line.startswith(('[', '{')):
+            return json.loads(line)
+    raise CommandExecutionError('No JSON result in powershell output: {0}'.format(output))
+
+
+def _new_inventory():
+    return {
+        'sites': {},          # site name -> site record
+        'site_ids': {},       # site id -> site name
+        'apppools': {},       # apppool name -> apppool record
+        'apppool_sites': {},  # apppool name -> [site name]
+        'bindings': {},       # protocol/bindingInformation -> site name
+        'max_site_id': 0,
+        # settings of a new apppool, from applicationPoolDefaults
+        'apppool_defaults': dict(_APPPOOL_SCHEMA_DEFAULTS),
+    }
+
+
+def _binding_key(protocol, info):
+    # A flat string, the inventory is returned to the master as is
+    return '{0}/{1}'.format(protocol, info)
+
+
+def _index_site(inventory, site):
+    inventory['sites'][site['name']] = site
+    inventory['site_ids'][site['id']] = site['name']
+    inventory['max_site_id'] = max(inventory['max_site_id'], site['id'])
+    for binding in site['bindings']:
+        key = _binding_key(binding['protocol'], binding['binding_information'])
+        inventory['bindings'][key] = site['name']
+
+
+def _index_apppool(inventory, apppool):
+    inventory['apppools'][apppool['name']] = apppool
+
+
+def _apppool_record(elem, state=None):
+    process_model = elem.find('processModel')
+    return {
+        'name': elem.get('name'),
+        'state': state,
+        'auto_start': elem.get('autoStart'),
+        'runtime_version': elem.get('managedRuntimeVersion'),
+        'pipeline_mode': elem.get('managedPipelineMode'),
+        'enable_32bit': elem.get('enable32BitAppOnWin64'),
+        'identity_type': process_model.get('identityType') if process_model is not None else None,
+    }
+
+
+def _parse_inventory(source, inventory=None):
+    '''
+    Build the inventory index from ``<site>`` and application pool
+    ``<add>`` elements of appcmd ``/config /xml`` output or of
+    applicationHost.config.
+
+    ``source`` is a file object. The document is read with iterparse and
+    every site and apppool element is cleared once it is indexed, so
+    memory stays flat however many sites there are. Attributes missing
+    from an element are filled from ``applicationPoolDefaults``,
+    ``<sites><applicationDefaults>`` and finally the IIS schema defaults.
+    '''
+    if inventory is None:
+        inventory = _new_inventory()
+    stack = []
+    state = None
+    site = None
+    site_defaults = {'apppool': None}
+    pool_defaults = {}
+    for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            parent = stack[-1] if stack else None
+            stack.append(tag)
+            if tag in ('SITE', 'APPPOOL'):
+                state = elem.get('state')
+            elif tag == 'site':
+                site = {
+                    'name': elem.get('name'),
+                    'id': int(elem.get('id', 0)),
+                    'state': state,
+                    'auto_start': elem.get('serverAutoStart', 'true').lower() == 'true',
+                    'apppool': None,
+                    'physical_path': None,
+                    'bindings': [],
+                }
+            elif tag == 'applicationDefaults' and parent == 'sites':
+                site_defaults['apppool'] = elem.get('applicationPool')
+            elif site is not None and tag == 'binding':
+                site['bindings'].append({
+                    'protocol': elem.get('protocol'),
+                    'binding_information': elem.get('bindingInformation'),
+                })
+            elif site is not None and tag == 'applicationDefaults' and site['apppool'] is None:
+                site['apppool'] = elem.get('applicationPool')
+            elif site is not None and tag == 'application' and elem.get('path') == '/':
+                site['apppool'] = elem.get('applicationPool') or site['apppool']
+            elif (site is not None and tag == 'virtualDirectory' and elem.get('path') == '/'
+                  and parent == 'application' and site['physical_path'] is None):
+                site['physical_path'] = elem.get('physicalPath')
+            continue
+
+        stack.pop()
+        parent = stack[-1] if stack else None
+        if tag == 'site':
+            _index_site(inventory, site)
+            site = None
+            elem.clear()
+        elif tag == 'add' and parent in ('APPPOOL', 'applicationPools'):
+            _index_apppool(inventory, _apppool_record(elem, state))
+            elem.clear()
+        elif tag == 'applicationPoolDefaults' and parent == 'applicationPools':
+            pool_defaults = _apppool_record(elem)
+            elem.clear()
+        elif tag in ('SITE', 'APPPOOL') or len(stack) <= 2:
+            # Nothing below the second level is needed once it is closed
+            state = None
+            elem.clear()
+
+    for key, value in six.iteritems(_APPPOOL_SCHEMA_DEFAULTS):
+        default = pool_defaults.get(key) or value
+        inventory['apppool_defaults'][key] = default
+        for apppool in six.itervalues(inventory['apppools']):
+            if apppool[key] is None:
+                apppool[key] = default
+    default_pool = site_defaults['apppool'] or 'DefaultAppPool'
+    for site in six.itervalues(inventory['sites']):
+        if site['apppool'] is None:
+            site['apppool'] = default_pool
+        inventory['apppool_sites'].setdefault(site['apppool'], []).append(site['name'])
+    return inventory
+
+
+def _read_inventory():
+    '''
+    Read sites and apppools with one appcmd call and index them
+    '''
+    command = ('"<inventory>"; '
+               '.$appcmd list site /config /xml | Where-Object { $_ -notmatch "^<\\?xml" }; '
+               '.$appcmd list apppool /config /xml | Where-Object { $_ -notmatch "^<\\?xml" }; '
+               '"</inventory>"')
+    output = _srvmgr(command, xml=True)
+    if output is False:
+        raise CommandExecutionError('appcmd.exe not found, unable to read the IIS inventory')
+    return _parse_inventory(io.BytesIO(output.encode('utf-8')))
+
+
+def _config_path():
+    default = os.path.join(os.environ.get('WINDIR', r'C:\Windows'),
+                           'system32', 'inetsrv', 'config', 'applicationHost.config')
+    return __salt__['config.get']('xjoker_win_iis:config_path', default)
+
+
+def _read_config_inventory(path):
+    '''
+    Index applicationHost.config directly, without powershell or appcmd.
+
+    The file is memory-mapped and fed to the incremental parser, so only
+    the pages holding sites and apppools are touched. The config has no
+    runtime state, so ``state`` is None for every site and apppool.
+    '''
+    with salt.utils.fopen(path, 'rb') as fp_:
+        if not os.fstat(fp_.fileno()).st_size:
+            raise CommandExecutionError('IIS config {0} is empty'.format(path))
+        __utils__['xjoker_runner.count']('bytes', os.fstat(fp_.fileno()).st_size)
+        with contextlib.closing(mmap.mmap(fp_.fileno(), 0, access=mmap.ACCESS_READ)) as data:
+            return _parse_inventory(data)
+
+
+def _inventory(refresh=False):
+    '''
+    Return the inventory cached in ``__context__``, reading it again when
+    it is older than ``xjoker_win_iis:inventory_ttl`` seconds.
+
+    With ``xjoker_win_iis:backend: config`` the index is read from
+    applicationHost.config and is also refreshed whenever the file
+    changes.
+    '''
+    ttl = __salt__['config.get']('xjoker_win_iis:inventory_ttl', 60)
+    backend = __salt__['config.get']('xjoker_win_iis:backend', 'appcmd')
+    cached = __context__.get(_INVENTORY_KEY)
+    if backend == 'config':
+        path = _config_path()
+        stamp = os.path.getmtime(path)
+        if (not refresh and cached and time.time() - cached[0] < ttl
+                and cached[2] == stamp):
+            __utils__['xjoker_runner.count']('cache_hits')
+            return cached[1]
+        _LOG.debug('Reading IIS inventory from %s', path)
+        inventory = _read_config_inventory(path)
+    else:
+        stamp = None
+        if not refresh and cached and time.time() - cached[0] < ttl:
+            __utils__['xjoker_runner.count']('cache_hits')
+            return cached[1]
+        _LOG.debug('Reading IIS inventory')
+        inventory = _read_inventory()
+    __utils__['xjoker_runner.count']('cache_misses')
+    __context__[_INVENTORY_KEY] = (time.time(), inventory, stamp)
+    return inventory
+
+
+def _write_config(mutate):
+    '''
+    Change applicationHost.config through ``mutate(root)``.
+
+    The current file is copied to ``applicationHost.config.xjoker.bak``
+    first and the new content is swapped in atomically, so IIS never
+    reads a half written file.
+    '''
+    path = _config_path()
+    try:
+        # Keep the comments of the file where the parser supports it
+        parser = ElementTree.XMLParser(target=ElementTree.TreeBuilder(insert_comments=True))
+    except TypeError:
+        parser = None
+    tree = ElementTree.parse(path, parser)
+    if not mutate(tree.getroot()):
+        return False
+    shutil.copy2(path, path + '.xjoker.bak')
+    with salt.utils.atomicfile.atomic_open(path, 'wb') as fp_:
+        tree.write(fp_, encoding='UTF-8', xml_declaration=True)
+    _invalidate_inventory()
+    return True
+
+
+def _allocate_site_id():
+    '''
+    Hand out the next free site id.
+
+    The highest id is tracked by the inventory index, and the last id
+    handed out is kept next to a lock file in the minion cachedir. Two
+    concurrent jobs therefore never get the same id, even before either
+    site exists in IIS.
+    '''
+    cachedir = os.path.join(__opts__['cachedir'], 'xjoker_win_iis')
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    last_file = os.path.join(cachedir, 'site_id')
+
+    # Read outside the lock, an inventory read can take longer than the
+    # lock is considered stale
+    known = _inventory()['max_site_id']
+    with __utils__['xjoker_runner.file_lock'](os.path.join(cachedir, 'site_id.lock')):
+        try:
+            with salt.utils.fopen(last_file, 'r') as fp_:
+                last = int(fp_.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            last = 0
+        site_id = max(last, known) + 1
+        with salt.utils.fopen(last_file, 'w') as fp_:
+            fp_.write(str(site_id))
+    return site_id
+
+
+def _invalidate_inventory():
+    __context__.pop(_INVENTORY_KEY, None)
+
+
+def _srvmgr_update(op, name, command):
+    '''
+    Run a single WebAdministration cmdlet and update the cached inventory.
+
+    These cmdlets print nothing when they succeed, so any output means an
+    error or a warning and the cache is dropped instead of being updated.
+    '''
+    ret = _srvmgr(command)
+    if ret:
+        _invalidate_inventory()
+    else:
+        _update_inventory(op, name)
+    return ret
+
+
+def _update_inventory(op, name=None, site=None, hostheader='', ipaddress='*',
+                      port=80, protocol='', **kwargs):
+    '''
+    Apply a successful mutation to the cached inventory in place. Ops whose
+    result cannot be derived locally drop the cache instead.
+    '''
+    cached = __context__.get(_INVENTORY_KEY)
+    if not cached:
+        return
+    inventory = cached[1]
+    sites = inventory['sites']
+
+    if op == 'create_site' and kwargs.get('site_id'):
+        apppool = kwargs['apppool']
+        if apppool not in inventory['apppools']:
+            _index_apppool(inventory, dict(inventory['apppool_defaults'], name=apppool,
+                                           state='Started'))
+        _index_site(inventory, {
+            'name': name,
+            'id': int(kwargs['site_id']),
+            'state': kwargs.get('state'),
+            'auto_start': True,
+            'apppool': apppool,
+            'physical_path': kwargs.get('sourcepath'),
+            'bindings': [{'protocol': 'http',
+                          'binding_information': _get_binding_info(hostheader, ipaddress, port)}],
+        })
+        inventory['apppool_sites'].setdefault(apppool, []).append(name)
+    elif op == 'create_apppool':
+        _index_apppool(inventory, dict(inventory['apppool_defaults'], name=name, state='Started'))
+    elif op == 'remove_site' and name in sites:
+        record = sites.pop(name)
+        inventory['site_ids'].pop(record['id'], None)
+        pool_sites = inventory['apppool_sites'].get(record['apppool'], [])
+        if name in pool_sites:
+            pool_sites.remove(name)
+        for binding in record['bindings']:
+            inventory['bindings'].pop(_binding_key(binding['protocol'], binding['binding_information']), None)
+    elif op == 'remove_apppool':
+        inventory['apppools'].pop(name, None)
+    elif op in ('create_binding', 'remove_binding') and site in sites:
+        info = _get_binding_info(hostheader, ipaddress, port)
+        protocol = str(protocol).lower()
+        if op == 'create_binding':
+            protocol = protocol or 'http'
+        bindings = []
+        for binding in sites[site]['bindings']:
+            # A removal without a protocol takes the binding of every protocol
+            if binding['binding_information'] == info and protocol in ('', binding['protocol']):
+                inventory['bindings'].pop(_binding_key(binding['protocol'], info), None)
+            else:
+                bindings.append(binding)
+        if op == 'create_binding':
+            bindings.append({'protocol': protocol, 'binding_information': info})
+            inventory['bindings'][_binding_key(protocol, info)] = site
+        sites[site]['bindings'] = bindings
+    elif op in ('start_site', 'stop_site', 'restart_site') and name in sites:
+        sites[name]['state'] = 'Stopped' if op == 'stop_site' else 'Started'
+    elif op == 'set_apppool' and name in inventory['apppools']:
+        inventory['apppools'][name].update(kwargs['settings'])
+    elif op in ('start_apppool', 'stop_apppool', 'restart_apppool') and name in inventory['apppools']:
+        inventory['apppools'][name]['state'] = 'Stopped' if op == 'stop_apppool' else 'Started'
+    else:
+        _invalidate_inventory()
+
+
 
 def say_hi():
     return "xJoker Hi!"
 
 
+def _expand_names(names, index):
+    '''
+    Resolve a list (or comma separated string) of names and glob patterns
+    against an inventory index. Returns the matched names in order and
+    the literal names that were not found.
+    '''
+    if isinstance(names, six.string_types):
+        names = [x.strip() for x in names.split(',') if x.strip()]
+    matched = []
+    missing = []
+    for pattern in names:
+        if any(c in pattern for c in '*?['):
+            hits = sorted(fnmatch.filter(index, pattern))
+        else:
+            hits = [pattern] if pattern in index else []
+            if not hits:
+                missing.append(pattern)
+        matched.extend(x for x in hits if x not in matched)
+    return matched, missing
+
+
+def _lifecycle(op, names, index_key, fail_fast):
+    '''
+    Run ``op`` on every matched name as one batch, so a single script
+    handles them all and the cached inventory is updated once afterwards
+    '''
+    start = time.time()
+    index = _inventory()[index_key]
+    matched, missing = _expand_names(names, index)
+
+    results = batch([{'op': op, 'name': name} for name in matched], fail_fast=fail_fast)
+    items = {}
+    for name, ret in zip(matched, results):
+        items[name] = {'result': ret['result'], 'duration': ret.get('duration', 0.0),
+                       'comment': ret['comment']}
+    for name in matched[len(results):]:
+        items[name] = {'result': False, 'duration': 0.0,
+                       'comment': 'No result, the batch script did not finish'}
+    for name in missing:
+        items[name] = {'result': False, 'duration': 0.0, 'comment': 'Not found'}
+    return {
+        'result': all(x['result'] for x in items.values()),
+        'duration': round(time.time() - start, 3),
+        'items': items,
+    }
+
+
+def start_sites(names, concurrency=4, fail_fast=False):
+    '''
+    Start many IIS WebSites in one powershell round trip
+
+    ``names`` is a list (or comma separated string) of site names and glob
+    patterns. All sites are handled by a single batch script, see
+    ``xjoker_win_iis.batch``; ``concurrency`` is no longer used and only
+    kept for existing callers. With ``fail_fast=True`` no site is started
+    after the first failure, the rest are reported with a None result.
+
+    Returns the overall ``result`` and ``duration`` plus per-site
+    ``result``, ``comment`` and ``duration`` under ``items``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_win_iis.start_sites 'shop*,blog' fail_fast=True
+    '''
+    return _lifecycle('start_site', names, 'sites', fail_fast)
+
+
+def stop_sites(names, concurrency=4, fail_fast=False):
+    '''
+    Stop many IIS WebSites in one round trip, see ``xjoker_win_iis.start_sites``
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_win_iis.stop_sites '[shop1, shop2]' fail_fast=True
+    '''
+    return _lifecycle('stop_site', names, 'sites', fail_fast)
+
+
+def restart_sites(names, concurrency=4, fail_fast=False):
+    '''
+    Restart many IIS WebSites in one round trip, see ``xjoker_win_iis.start_sites``
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_win_iis.restart_sites 'shop*'
+    '''
+    return _lifecycle('restart_site', names, 'sites', fail_fast)
+
+
+def recycle_apppools(names, concurrency=4, fail_fast=False):
+    '''
+    Recycle many IIS Apppools in one round trip, see ``xjoker_win_iis.start_sites``
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_win_iis.recycle_apppools 'shop*'
+    '''
+    return _lifecycle('restart_apppool', names, 'apppools', fail_fast)
+
+
+def start_apppools(names, concurrency=4, fail_fast=False):
+    '''
+    Start many IIS Apppools in one round trip, see ``xjoker_win_iis.start_sites``
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_win_iis.start_apppools 'shop*'
+    '''
+    return _lifecycle('start_apppool', names, 'apppools', fail_fast)
+
+
+def stop_apppools(names, concurrency=4, fail_fast=False):
+    '''
+    Stop many IIS Apppools in one round trip, see ``xjoker_win_iis.start_sites``
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_win_iis.stop_apppools 'shop*'
+    '''
+    return _lifecycle('stop_apppool', names, 'apppools', fail_fast)
+
+
+class _AclJob(object):
+    '''
+    Grant ``identity`` full control on a directory tree in the background.
+
+    The tree is split into one unit per top-level entry plus the root
+    itself; units run on ``concurrency`` threads with icacls. In
+    incremental mode a unit whose files all already grant the identity
+    full control is skipped. Once every unit is done the root ACL is
+    checked again before the job is reported ``done``.
+
+    The inheritable grant on the root is written without propagating it,
+    icacls would walk the whole tree again. Without pywin32 there is no
+    way to do that, so the root is granted alone and Windows propagates
+    the grant.
+    '''
+
+    def __init__(self, path, identity, incremental=False, concurrency=4):
+        self.id = '{0}-{1}'.format(int(time.time() * 1000), next(_ACL_IDS))
+        self.path = path
+        self.identity = identity
+        self.incremental = incremental and HAS_WIN32
+        self.concurrency = concurrency
+        self.status = 'running'
+        self.units_total = 0
+        self.units_done = 0
+        self.units_skipped = 0
+        self.errors = []
+        self.started = time.time()
+        self.finished = None
+        self.reported = False
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._sid = None
+
+    def info(self):
+        return {
+            'job': self.id,
+            'path': self.path,
+            'identity': self.identity,
+            'status': self.status,
+            'units_total': self.units_total,
+            'units_done': self.units_done,
+            'units_skipped': self.units_skipped,
+            'errors': self.errors,
+            'duration': round((self.finished or time.time()) - self.started, 3),
+        }
+
+    def start(self):
+        worker = threading.Thread(target=self._run)
+        worker.daemon = True
+        worker.start()
+        return self
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.info()
+
+    def report(self, wait=False, timeout=None):
+        '''
+        Job info for a caller; once the final info was handed out the job
+        can be dropped
+        '''
+        info = self.wait(timeout) if wait else self.info()
+        if info['status'] != 'running':
+            self.reported = True
+        return info
+
+    def _icacls(self, path, recurse):
+        grant = '{0}:(OI)(CI)F'.format(self.identity) if os.path.isdir(path) else \
+            '{0}:F'.format(self.identity)
+        cmd = ['icacls', path, '/grant', grant, '/C', '/Q']
+        if recurse:
+            cmd.append('/T')
+        try:
+            __utils__['xjoker_runner.run'](cmd, label='icacls')
+        except CommandExecutionError as exc:
+            return str(exc)
+        return None
+
+    def _granted(self, path):
+        try:
+            dacl = win32security.GetFileSecurity(
+                path, win32security.DACL_SECURITY_INFORMATION).GetSecurityDescriptorDacl()
+        except win32security.error:
+            return False
+        if dacl is None:
+            return True
+        for idx in range(dacl.GetAceCount()):
+            (ace_type, _), mask, sid = dacl.GetAce(idx)
+            if (ace_type == win32security.ACCESS_ALLOWED_ACE_TYPE and sid == self._sid
+                    and mask & ntsecuritycon.FILE_ALL_ACCESS == ntsecuritycon.FILE_ALL_ACCESS):
+                return True
+        return False
+
+    def _grant_root(self):
+        '''
+        Add the inheritable grant to the root DACL with SetFileSecurity,
+        which unlike icacls does not propagate it to the children
+        '''
+        security = win32security.GetFileSecurity(self.path, win32security.DACL_SECURITY_INFORMATION)
+        dacl = security.GetSecurityDescriptorDacl()
+        if dacl is None:
+            return None
+        adders = {
+            win32security.ACCESS_ALLOWED_ACE_TYPE: 'AddAccessAllowedAceEx',
+            win32security.ACCESS_DENIED_ACE_TYPE: 'AddAccessDeniedAceEx',
+        }
+        aces = [dacl.GetAce(idx) for idx in range(dacl.GetAceCount())]
+        if any(ace[0][0] not in adders for ace in aces):
+            return self._icacls(self.path, recurse=False)
+        # Explicit entries go before inherited ones
+        new = win32security.ACL()
+        grant = (win32security.ACL_REVISION,
+                 win32security.OBJECT_INHERIT_ACE | win32security.CONTAINER_INHERIT_ACE,
+                 ntsecuritycon.FILE_ALL_ACCESS, self._sid)
+        for (ace_type, flags), mask, sid in aces:
+            if grant and flags & win32security.INHERITED_ACE:
+                new.AddAccessAllowedAceEx(*grant)
+                grant = None
+            getattr(new, adders[ace_type])(win32security.ACL_REVISION, flags, mask, sid)
+        if grant:
+            new.AddAccessAllowedAceEx(*grant)
+        security.SetSecurityDescriptorDacl(1, new, 0)
+        try:
+            win32security.SetFileSecurity(self.path, win32security.DACL_SECURITY_INFORMATION, security)
+        except win32security.error as exc:
+            return str(exc)
+        return None
+
+    def _unit_granted(self, path):
+        if not self._granted(path):
+            return False
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                if not self._granted(os.path.join(root, name)):
+                    return False
+        return True
+
+    def _run_unit(self, path):
+        if self.incremental and self._unit_granted(path):
+            with self._lock:
+                self.units_skipped += 1
+            return True, 'skipped'
+        error = self._icacls(path, recurse=os.path.isdir(path))
+        with self._lock:
+            self.units_done += 1
+            if error:
+                self.errors.append(error)
+        return error is None, error or ''
+
+    def _run(self):
+        try:
+            if HAS_WIN32:
+                self._sid = win32security.LookupAccountName(None, self.identity)[0]
+                units = [os.path.join(self.path, x) for x in sorted(os.listdir(self.path))]
+            else:
+                units = []
+            self.units_total = len(units) + 1
+            __utils__['xjoker_runner.parallel'](units, self._run_unit, self.concurrency)
+            # The root last, so new files inherit the grant
+            if HAS_WIN32:
+                error = self._grant_root()
+            else:
+                error = self._icacls(self.path, recurse=False)
+            self.units_done += 1
+            if error:
+                self.errors.append(error)
+            if HAS_WIN32 and not self.errors:
+                if not self._granted(self.path):
+                    self.errors.append('{0} is not granted on {1} after the run'
+                                       .format(self.identity, self.path))
+        except Exception as exc:
+            self.errors.append(str(exc))
+        self.status = 'failed' if self.errors else 'done'
+        self.finished = time.time()
+        self._done.set()
+
+
+def _prune_acl_jobs():
+    '''
+    Forget finished ACL jobs that were reported, or that nobody asked for
+    within ``xjoker_win_iis:acl_job_ttl`` seconds
+    '''
+    ttl = __salt__['config.get']('xjoker_win_iis:acl_job_ttl', 3600)
+    now = time.time()
+    with _ACL_LOCK:
+        for key, job in list(_ACL_JOBS.items()):
+            if job.finished and (job.reported or now - job.finished > ttl):
+                del _ACL_JOBS[key]
+
+
+def set_acl(path, identity, incremental=False, concurrency=4, wait=False, timeout=None):
+    '''
+    Grant ``identity`` full control on ``path`` and everything below it
+
+    The work runs in the background, split across the top-level entries
+    of ``path`` on ``concurrency`` threads (with pywin32, otherwise one
+    icacls call on ``path``). ``incremental=True`` skips
+    entries whose ACLs already grant the identity (needs pywin32).
+    Returns the job info, with ``job`` to pass to
+    ``xjoker_win_iis.acl_status``; with ``wait=True`` it returns once the
+    job is finished (or ``timeout`` seconds passed).
+
+    Jobs live in the minion worker process, so polling them from a later
+    call needs ``multiprocessing: False``. A finished job is dropped once
+    its final info was returned, here or by ``xjoker_win_iis.acl_status``,
+    or ``xjoker_win_iis:acl_job_ttl`` seconds (default 3600) after it
+    finished.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_win_iis.set_acl 'd:\\web\\shop' 'IIS AppPool\\shop' incremental=True wait=True
+    '''
+    if not os.path.isdir(path):
+        raise SaltInvocationError('Directory not found: {0}'.format(path))
+    _prune_acl_jobs()
+    job = _AclJob(path, identity, incremental, concurrency)
+    with _ACL_LOCK:
+        _ACL_JOBS[job.id] = job
+    job.start()
+    return job.report(wait, timeout)
+
+
+def acl_status(job=None, wait=False, timeout=None):
+    '''
+    Progress of an ACL job started by ``xjoker_win_iis.set_acl``, or of
+    every known job when ``job`` is not given. Finished jobs are only
+    reported once, see ``xjoker_win_iis.set_acl``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_win_iis.acl_status 1500000000000-0 wait=True
+    '''
+    _prune_acl_jobs()
+    with _ACL_LOCK:
+        jobs = dict(_ACL_JOBS)
+    if job is None:
+        return dict((key, value.report()) for key, value in six.iteritems(jobs))
+    if job not in jobs:
+        raise SaltInvocationError('Unknown ACL job: {0}, finished jobs are only reported once'
+                                  .format(job))
+    return jobs[job].report(wait, timeout)
+
+
+def inventory(refresh=False):
+    '''
+    Return the indexed IIS inventory
+
+    Sites and application pools are read with one ``appcmd /config /xml``
+    call and indexed by site name (``sites``), site id (``site_ids``),
+    apppool name (``apppools``), apppool to sites (``apppool_sites``) and
+    ``protocol/bindingInformation`` (``bindings``, e.g.
+    ``https/*:443:www.example.com``).
+
+    The index is cached for ``xjoker_win_iis:inventory_ttl`` seconds
+    (default 60) and kept up to date by the functions of this module.
+    Pass ``refresh=True`` to read it again.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_win_iis.inventory refresh=True
+    '''
+    return _inventory(refresh)
+
+
 def list_sites():
     '''
     List all the currently deployed websites
@@ -77,14 +1088,8 @@ def list_sites():
 
         salt '*' xjoker_win_iis.list_sites
     '''
-    pscmd = []
-    pscmd.append(r'Get-WebSite -erroraction silentlycontinue -warningaction silentlycontinue')
-    pscmd.append(r' | foreach {')
-    pscmd.append(r' $_.Name')
-    pscmd.append(r'};')
-
-    command = ''.join(pscmd)
-    return _srvmgr(command)
+    sites = _inventory()['sites']
+    return [site['name'] for site in sorted(sites.values(), key=lambda x: x['id'])]
 
 
 def list_sites_xml():
@@ -108,22 +1113,21 @@ def list_sites_xml():
 
 def list_sites_status():
     '''
-    List all the currently deployed websites
+    List all the currently deployed websites with their state and physical path
+
+    The ``config`` backend has no runtime state and reports ``state`` as
+    None.
 
     CLI Example:
 
     .. code-block:: bash
 
-        salt '*' xjoker_win_iis.list_sites
+        salt '*' xjoker_win_iis.list_sites_status
     '''
-    pscmd = []
-    pscmd.append(r'Get-WebSite -erroraction silentlycontinue -warningaction silentlycontinue')
-    pscmd.append(r' | foreach {')
-    pscmd.append(r' $_.Name,$_.state,$_.physicalPath')
-    pscmd.append(r'};')
-
-    command = ''.join(pscmd)
-    return _srvmgr(command)
+    ret = {}
+    for name, site in six.iteritems(_inventory()['sites']):
+        ret[name] = {'state': site['state'], 'physical_path': site['physical_path']}
+    return ret
 
 
 def site_binding(name):
@@ -136,75 +1140,186 @@ def site_binding(name):
 
         salt '*' xjoker_win_iis.site_binding name='sitename'
     '''
+    site = _inventory()['sites'].get(name)
 
-    # sites = list_sites()
-    #
-    # if name not in sites:
-    #     _LOG.warning('Site not found: %s', name)
-    #     return ""
+    if site is None:
+        _LOG.warning('Site not found: %s', name)
+        return []
 
+    return [binding['binding_information'] for binding in site['bindings']]
 
-    pscmd = []
-    pscmd.append(r'Get-WebBinding -Name "{0}" '.format(name))
-    pscmd.append(r' | foreach {')
-    pscmd.append(r' $_.bindingInformation')
-    pscmd.append(r'};')
+def batch(steps, fail_fast=False):
+    '''
+    Run several IIS operations in one powershell round trip
 
-    command = ''.join(pscmd)
-    return _srvmgr(command)
+    Each step is a dict with an ``op`` key and the arguments of that op.
+    Existence checks, mutations and verification reads of all steps are
+    sent together as a single script.
 
-def create_binding(site,
-                   hostheader='',
-                   ipaddress='*',
-                   port=80,
-                   protocol='http'):
-    pscmd = list()
-    protocol = str(protocol).lower()
-    name = _get_binding_info(hostheader, ipaddress, port)
+    Valid ops: create_apppool, remove_apppool, set_apppool, create_site, remove_site,
+    create_binding, remove_binding, start_site, stop_site, restart_site,
+    start_apppool, stop_apppool, restart_apppool
 
-    if protocol not in _VALID_PROTOCOLS:
+    Returns a list with one dict per step holding ``step``, ``op``,
+    ``name``, ``result``, ``changed``, ``comment`` and ``duration``. With
+    ``fail_fast=True`` the steps after the first failure are skipped and
+    get a None ``result``. A ``create_site``
+    step that created the site also returns its ``site_id``, ``apppool``
+    and ``state`` under ``index``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_win_iis.batch '[{op: create_apppool, name: Pool1}, {op: start_apppool, name: Pool1}]'
+    '''
+    if not steps:
+        return []
+    results = _parse_json(_srvmgr(_batch_script(steps, fail_fast)))
+    if isinstance(results, dict):
+        results = [results]
+    for step, result in zip(steps, results):
+        if result.get('result') is None:
+            # Skipped, nothing was run
+            continue
+        if result.get('changed') and result.get('result'):
+            _update_inventory(**dict(step, **result.get('index') or {}))
+        else:
+            # A failed step may have changed part of the state, and an
+            # unchanged one means the cache disagreed with IIS
+            _invalidate_inventory()
+        if not result.get('result'):
+            _LOG.error('Batch step %s (%s %s) failed: %s', result.get('step'),
+                       result.get('op'), result.get('name'), result.get('comment'))
+    return results
+
+
+def _parse_binding(binding):
+    '''
+    Turn a binding given as a dict, ``ip:port:host`` or
+    ``protocol/ip:port:host`` into create_binding arguments
+    '''
+    if isinstance(binding, dict):
+        ret = {'hostheader': binding.get('hostheader', ''),
+               'ipaddress': binding.get('ipaddress', '*'),
+               'port': binding.get('port', 80),
+               'protocol': binding.get('protocol', 'http')}
+    else:
+        protocol, _, info = str(binding).rpartition('/')
+        try:
+            ipaddress, port, hostheader = info.rsplit(':', 2)
+        except ValueError:
+            raise SaltInvocationError("Invalid binding '{0}', expected ip:port:host"
+                                      .format(binding))
+        ret = {'hostheader': hostheader, 'ipaddress': ipaddress or '*',
+               'port': port, 'protocol': protocol or 'http'}
+    ret['protocol'] = str(ret['protocol']).lower()
+    if ret['protocol'] not in _VALID_PROTOCOLS:
         message = ("Invalid protocol '{0}' specified. Valid formats:"
-                   ' {1}').format(protocol, _VALID_PROTOCOLS)
+                   ' {1}').format(ret['protocol'], _VALID_PROTOCOLS)
         raise SaltInvocationError(message)
+    return ret
 
-    current_bindings = site_binding(site)
 
-    if name in current_bindings:
-        _LOG.debug("Binding already present: %s", name)
-        return True
+def _binding_steps(site, bindings, current_bindings=None):
+    '''
+    Diff a desired binding list against the inventory of ``site`` (or
+    ``current_bindings``) and return the batch steps and the changes,
+    removals first
+    '''
+    if current_bindings is None:
+        current_bindings = _inventory()['sites'][site]['bindings']
+    current = {}
+    for binding in current_bindings:
+        current[(binding['protocol'], binding['binding_information'])] = binding
+    desired = {}
+    for binding in bindings:
+        args = _parse_binding(binding)
+        info = _get_binding_info(args['hostheader'], args['ipaddress'], args['port'])
+        desired[(args['protocol'], info)] = args
+
+    steps = []
+    changes = {'added': [], 'removed': []}
+    for key in sorted(set(current) - set(desired)):
+        protocol, info = key
+        ipaddress, port, hostheader = info.rsplit(':', 2)
+        steps.append({'op': 'remove_binding', 'site': site, 'hostheader': hostheader,
+                      'ipaddress': ipaddress, 'port': port, 'protocol': protocol})
+        changes['removed'].append('{0}/{1}'.format(protocol, info))
+    for key in sorted(set(desired) - set(current)):
+        step = {'op': 'create_binding', 'site': site}
+        step.update(desired[key])
+        steps.append(step)
+        changes['added'].append('{0}/{1}'.format(*key))
+    return steps, changes
+
+
+def set_bindings(site, bindings, test=False):
+    '''
+    Make the bindings of a site exactly match ``bindings``
 
-    pscmd.append("New-WebBinding -Name '{0}' -HostHeader '{1}'".format(site, hostheader))
-    pscmd.append(" -IpAddress '{0}' -Port '{1}'".format(ipaddress, port))
-    pscmd.append(" -Protocol '{0}'".format(protocol))
+    Each binding is a dict (hostheader, ipaddress, port, protocol) or a
+    ``[protocol/]ip:port:host`` string. The current bindings come from the
+    inventory; missing bindings are added and unlisted ones removed in a
+    single batch. Returns ``result``, ``changes`` (``added``/``removed``)
+    and ``comment``. With ``test=True`` the changes are only reported.
 
-    cmd_ret = _srvmgr(str().join(pscmd))
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_win_iis.set_bindings site='My Test Site' bindings='["*:80:www.example.com", "https/*:443:www.example.com"]'
+    '''
+    ret = {'name': site, 'result': True, 'changes': {}, 'comment': ''}
+
+    if site not in _inventory()['sites']:
+        _LOG.warning('Site not exist!')
+        ret['result'] = False
+        ret['comment'] = 'Site not exist!'
+        return ret
+
+    steps, changes = _binding_steps(site, bindings)
+    if not steps:
+        ret['comment'] = 'Bindings already match'
+        return ret
+    if test:
+        ret['result'] = None
+        ret['changes'] = changes
+        ret['comment'] = 'Bindings would be changed'
+        return ret
+
+    failed = [x for x in batch(steps) if not x['result']]
+    ret['changes'] = changes
+    if failed:
+        ret['result'] = False
+        ret['comment'] = '; '.join(x['comment'] for x in failed)
+    else:
+        ret['comment'] = 'Bindings changed'
+    return ret
 
-    new_bindings = site_binding(site)
 
-    if name in new_bindings:
-        _LOG.debug('Binding created successfully: %s', name)
+def create_binding(site,
+                   hostheader='',
+                   ipaddress='*',
+                   port=80,
+                   protocol='http'):
+    name = _get_binding_info(hostheader, ipaddress, port)
+    ret = batch([{'op': 'create_binding', 'site': site, 'hostheader': hostheader,
+                  'ipaddress': ipaddress, 'port': port, 'protocol': protocol}])[0]
+
+    if ret['result']:
+        _LOG.debug('Binding present: %s', name)
         return True
     _LOG.error('Unable to create binding: %s', name)
     return False
 
 def remove_binding(site, hostheader='', ipaddress='*', port=80):
-    pscmd = list()
     name = _get_binding_info(hostheader, ipaddress, port)
-    current_bindings = site_binding(site)
-
-    if name not in current_bindings:
-        _LOG.debug('Binding already absent: %s', name)
-        return True
-
-    pscmd.append("Remove-WebBinding -HostHeader '{0}' ".format(hostheader))
-    pscmd.append(" -IpAddress '{0}' -Port '{1}'".format(ipaddress, port))
-
-    cmd_ret = _srvmgr(str().join(pscmd))
-
-    new_bindings = site_binding(site)
+    ret = batch([{'op': 'remove_binding', 'site': site, 'hostheader': hostheader,
+                  'ipaddress': ipaddress, 'port': port}])[0]
 
-    if name not in new_bindings:
-        _LOG.debug('Binding removed successfully: %s', name)
+    if ret['result']:
+        _LOG.debug('Binding absent: %s', name)
         return True
     _LOG.error('Unable to remove binding: %s', name)
     return False
@@ -217,11 +1332,24 @@ def create_site(
         port='80',
         apppool='',
         hostheader='',
-        ipaddress='*'
+        ipaddress='*',
+        acl_incremental=False
 ):
     '''
     Create website in IIS
 
+    The site id comes from the cached inventory and a lock file in the
+    minion cachedir, the apppool check and site creation run as a single
+    batch, see ``xjoker_win_iis.batch``. The apppool identity is then
+    granted full control on ``sourcepath`` (see ``xjoker_win_iis.set_acl``)
+    and the site is only reported created once that has finished.
+
+    Returns True when the site exists with its permissions set, False
+    otherwise. If the ACL job takes longer than
+    ``xjoker_win_iis:acl_timeout`` seconds (default 600) it is left
+    running, False is returned and the job id is logged for
+    ``xjoker_win_iis.acl_status``.
+
     CLI Example:
 
     .. code-block:: bash
@@ -230,22 +1358,6 @@ def create_site(
     '''
     _LOG.debug("create website")
     protocol = str(protocol).lower()
-    app=list_apppools()
-    current_sites = list_sites()
-    pscmd = []
-
-    # Get Site id
-    site_id=int(_srvmgr("dir iis:\sites | foreach {$_.id} | sort -Descending | select -first 1"))+1
-
-    # 如果站点目录不存在则创建
-    if not os.path.exists(sourcepath):
-        os.mkdir(sourcepath)
-
-
-    # 判断站点名称是否已经存在
-    if name in current_sites:
-        _LOG.debug("Site '%s' already present.", name)
-        return True
 
     # 判断传入的协议是不是在允许协议列表内
     # 防止传入其他协议类型导致执行失败
@@ -254,43 +1366,44 @@ def create_site(
                    ' {1}').format(protocol, _VALID_PROTOCOLS)
         raise SaltInvocationError(message)
 
-
-    # 判断apppool是否存在 不存在则创建和站点名同名的apppool
-    if apppool:
-        if apppool not in app:
-            if name not in app:
-                create_apppool(name)
-                apppool = name
-            else:
-                raise SaltInvocationError("Invalid AppPool Name!")
-    else:
-        if name not in app:
-            create_apppool(name)
-            apppool = name
-        else:
-            raise SaltInvocationError("Invalid AppPool Name!")
-
-    # Create site powershell command
-    # New-Website -Name "$name" -PhysicalPath "$physicalPath" -ApplicationPool "$applicationPool" -Port "$port" -IPAddress "$IPAddress" -HostHeader "$hostName" -id $id
-
+    # 如果站点目录不存在则创建
     if not os.path.exists(sourcepath):
         os.makedirs(sourcepath)
         _LOG.info("create dir Done")
 
-    # 设置目录权限
-    cmd_ow = 'cacls "' + sourcepath + '" /g "iis apppool\{0}":f /t /e /c'.format(name)
-    subprocess.Popen(cmd_ow, stdout=subprocess.PIPE, shell=True)
+    # 判断站点名称是否已经存在
+    if name in _inventory()['sites']:
+        _LOG.debug("Site '%s' already present.", name)
+        return True
 
-    pscmd.append("New-Website -Name '{0}'".format(name))
-    pscmd.append(" -PhysicalPath '{0}'".format(sourcepath))
-    pscmd.append(" -ApplicationPool '{0}'".format(apppool))
-    pscmd.append(" -Port '{0}'".format(port))
-    pscmd.append(" -IPAddress '{0}'".format(ipaddress))
-    pscmd.append(" -HostHeader '{0}'".format(hostheader))
-    pscmd.append(" -id '{0}'".format(str(site_id)))
+    # 判断apppool是否存在 不存在则创建和站点名同名的apppool
+    # apppool 检查和 New-Website 在同一个脚本里执行
+    ret = batch([{'op': 'create_site', 'name': name, 'sourcepath': sourcepath,
+                  'port': port, 'apppool': apppool, 'hostheader': hostheader,
+                  'ipaddress': ipaddress, 'site_id': _allocate_site_id()}])[0]
+
+    if ret['comment'] == 'Invalid AppPool Name!':
+        raise SaltInvocationError(ret['comment'])
+    if not ret['result']:
+        return False
+    if not ret['changed']:
+        # 站点在缓存读取之后由别处创建, batch 已丢弃缓存
+        _LOG.debug("Site '%s' already present.", name)
+        return True
 
-    command = ''.join(pscmd)
-    return _srvmgr(command)
+    # 设置目录权限, 权限设置完成后才算站点创建成功
+    # apppool 账户在 apppool 创建之后才存在
+    pool = _inventory()['sites'][name]['apppool']
+    acl = set_acl(sourcepath, r'IIS AppPool\{0}'.format(pool), incremental=acl_incremental,
+                  wait=True, timeout=__salt__['config.get']('xjoker_win_iis:acl_timeout', 600))
+    if acl['status'] == 'running':
+        _LOG.warning('Permissions on %s are still being set, see xjoker_win_iis.acl_status %s',
+                     sourcepath, acl['job'])
+        return False
+    if acl['status'] != 'done':
+        _LOG.error('Unable to set permissions on %s: %s', sourcepath, acl['errors'])
+        return False
+    return True
 
 
 def site_log_path(name, path=''):
@@ -298,6 +1411,10 @@ def site_log_path(name, path=''):
     '''
         Setting website logfile path
 
+        With ``xjoker_win_iis:backend: config`` applicationHost.config is
+        edited directly. Returns True once the path is set, False when the
+        site does not exist or the change failed.
+
         CLI Example:
 
         .. code-block:: bash
@@ -305,11 +1422,35 @@ def site_log_path(name, path=''):
             salt '*' xjoker_win_iis.site_log_path name='My Test Site' path='c:\log'
 
         '''
+    if __salt__['config.get']('xjoker_win_iis:backend', 'appcmd') == 'config':
+        def _set_log_dir(root):
+            for site in root.iter('site'):
+                if site.get('name') == name:
+                    log_file = site.find('logFile')
+                    if log_file is None:
+                        log_file = ElementTree.SubElement(site, 'logFile')
+                    log_file.set('directory', str(path))
+                    return True
+            _LOG.warning('Site not exist!')
+            return False
+        return _write_config(_set_log_dir)
+
+    if name not in _inventory()['sites']:
+        _LOG.warning('Site not exist!')
+        return False
+
     site_path = r'IIS:\Sites\{0}'.format(name)
     pscmd = []
     pscmd.append("Set-ItemProperty -Path '{0}' -Name logFile.directory -Value '{1}';"
                  .format(site_path, str(path)))
 
+    command = ''.join(pscmd)
+    ret = _srvmgr(command)
+    if ret:
+        _LOG.error('Unable to set the log path of %s: %s', name, ret)
+        return False
+    return True
+
 
 def site_run_as(name, username='', password=''):
     '''
@@ -345,11 +1486,9 @@ def remove_site(name):
 
     '''
 
-    current_sites = list_sites()
-
     # 对于不存在的站点,直接返回已经删除
     # 反正也不存在
-    if name not in current_sites:
+    if name not in _inventory()['sites']:
         _LOG.debug('Site already absent: %s', name)
         return True
 
@@ -357,7 +1496,7 @@ def remove_site(name):
     pscmd.append(r"Remove-WebSite -Name '{0}'".format(name))
 
     command = ''.join(pscmd)
-    return _srvmgr(command)
+    return _srvmgr_update('remove_site', name, command)
 
 
 def list_apppools():
@@ -370,14 +1509,7 @@ def list_apppools():
 
         salt '*' xjoker_win_iis.list_apppools
     '''
-    pscmd = []
-    pscmd.append(r'Get-ChildItem IIS:\AppPools\ -erroraction silentlycontinue -warningaction silentlycontinue')
-    pscmd.append(r' | foreach {')
-    pscmd.append(r' $_.Name')
-    pscmd.append(r'};')
-
-    command = ''.join(pscmd)
-    return _srvmgr(command)
+    return sorted(_inventory()['apppools'])
 
 def list_apppools_xml():
     '''
@@ -408,9 +1540,7 @@ def create_apppool(name):
         salt '*' xjoker_win_iis.create_apppool name='MyTestPool'
     '''
 
-    apppool=list_apppools()
-
-    if name in apppool:
+    if name in _inventory()['apppools']:
         _LOG.warning('AppPool is exist')
         return 'AppPool is exist'
 
@@ -418,7 +1548,9 @@ def create_apppool(name):
     pscmd.append("New-WebAppPool '{0}'".format(name))
 
     command = ''.join(pscmd)
-    return _srvmgr(command)
+    ret = _srvmgr(command)
+    _invalidate_inventory()
+    return ret
 
 
 def remove_apppool(name):
@@ -432,9 +1564,7 @@ def remove_apppool(name):
         salt '*' xjoker_win_iis.remove_apppool name='MyTestPool'
     '''
 
-    apppool=list_apppools()
-
-    if name not in apppool:
+    if name not in _inventory()['apppools']:
         _LOG.warning('Apppool is delete')
         return True
 
@@ -444,7 +1574,7 @@ def remove_apppool(name):
     pscmd.append(r"Remove-Item -Path '{0}' -recurse".format(apppool_path))
 
     command = ''.join(pscmd)
-    return _srvmgr(command)
+    return _srvmgr_update('remove_apppool', name, command)
 
 
 def start_site(name):
@@ -458,9 +1588,7 @@ def start_site(name):
         salt '*' xjoker_win_iis.start_site name='MyTestPool'
     '''
 
-    sites=list_sites()
-
-    if name not in sites:
+    if name not in _inventory()['sites']:
         _LOG.warning('Site not exist!')
         return False
 
@@ -469,7 +1597,7 @@ def start_site(name):
     pscmd.append(r"Start-WebSite '{0}'".format(name))
 
     command = ''.join(pscmd)
-    return _srvmgr(command)
+    return _srvmgr_update('start_site', name, command)
 
 
 def stop_site(name):
@@ -483,9 +1611,7 @@ def stop_site(name):
         salt '*' xjoker_win_iis.stop_site name='MyTestPool'
     '''
 
-    sites = list_sites()
-
-    if name not in sites:
+    if name not in _inventory()['sites']:
         _LOG.warning('Site not exist!')
         return False
 
@@ -493,7 +1619,7 @@ def stop_site(name):
     pscmd.append(r"Stop-WebSite '{0}'".format(name))
 
     command = ''.join(pscmd)
-    return _srvmgr(command)
+    return _srvmgr_update('stop_site', name, command)
 
 
 def restart_site(name):
@@ -507,18 +1633,16 @@ def restart_site(name):
         salt '*' xjoker_win_iis.restart_site name='MyTestPool'
     '''
 
-    sites = list_sites()
-
-    if name not in sites:
+    if name not in _inventory()['sites']:
         _LOG.warning('Site not exist!')
         return False
 
     pscmd = []
-    pscmd.append(r"Stop-WebSite '{0}'".format(name))
+    pscmd.append(r"Stop-WebSite '{0}';".format(name))
     pscmd.append(r"Start-WebSite '{0}'".format(name))
 
     command = ''.join(pscmd)
-    return _srvmgr(command)
+    return _srvmgr_update('restart_site', name, command)
 
 
 def restart_apppool(name):
@@ -532,9 +1656,7 @@ def restart_apppool(name):
         salt '*' xjoker_win_iis.restart_apppool name='MyTestPool'
     '''
 
-    apppool=list_apppools()
-
-    if name not in apppool:
+    if name not in _inventory()['apppools']:
         _LOG.warning('AppPool not exist!')
         return False
 
@@ -542,7 +1664,7 @@ def restart_apppool(name):
     pscmd.append(r"Restart-WebAppPool '{0}'".format(name))
 
     command = ''.join(pscmd)
-    return _srvmgr(command)
+    return _srvmgr_update('restart_apppool', name, command)
 
 
 def start_apppool(name):
@@ -556,9 +1678,7 @@ def start_apppool(name):
         salt '*' xjoker_win_iis.start_apppool name='MyTestPool'
     '''
 
-    apppool = list_apppools()
-
-    if name not in apppool:
+    if name not in _inventory()['apppools']:
         _LOG.warning('AppPool not exist!')
         return False
 
@@ -566,7 +1686,7 @@ def start_apppool(name):
     pscmd.append(r"Start-WebAppPool '{0}'".format(name))
 
     command = ''.join(pscmd)
-    return _srvmgr(command)
+    return _srvmgr_update('start_apppool', name, command)
 
 
 def stop_apppool(name):
@@ -580,9 +1700,7 @@ def stop_apppool(name):
         salt '*' xjoker_win_iis.stop_apppool name='MyTestPool'
     '''
 
-    apppool = list_apppools()
-
-    if name not in apppool:
+    if name not in _inventory()['apppools']:
         _LOG.warning('AppPool not exist!')
         return False
 
@@ -590,7 +1708,38 @@ def stop_apppool(name):
     pscmd.append(r"Stop-WebAppPool '{0}'".format(name))
 
     command = ''.join(pscmd)
-    return _srvmgr(command)
+    return _srvmgr_update('stop_apppool', name, command)
+
+
+def _apppool_desired(auto_start='', runtime_version='', pipeline_mode='', bit_setting=''):
+    '''
+    Normalize apppool_setting arguments to inventory record values
+    '''
+    desired = {}
+    if runtime_version:
+        desired['runtime_version'] = str(runtime_version)
+    if str(pipeline_mode):
+        pipeline_mode = str(pipeline_mode)
+        desired['pipeline_mode'] = {'0': 'Integrated', '1': 'Classic'}.get(pipeline_mode, pipeline_mode)
+    if str(auto_start):
+        desired['auto_start'] = str(auto_start).lower()
+    if bit_setting == "True" or bit_setting == "False" or isinstance(bit_setting, bool):
+        desired['enable_32bit'] = str(bit_setting).lower()
+    return desired
+
+
+def _apppool_changes(name, desired):
+    '''
+    Compare desired settings against the inventory record of an apppool
+    and return them in the ``{attr: {'old': .., 'new': ..}}`` format
+    '''
+    current = _inventory()['apppools'][name]
+    changes = {}
+    for key, value in six.iteritems(desired):
+        old = current.get(key)
+        if (old or '').lower() != value.lower():
+            changes[_APPPOOL_ATTRS[key]] = {'old': old, 'new': value}
+    return changes
 
 
 def apppool_setting(
@@ -598,10 +1747,17 @@ def apppool_setting(
         auto_start='',
         runtime_version='',
         pipeline_mode='',
-        bit_setting=''):
+        bit_setting='',
+        test=False):
     '''
     Change Apppool setting
 
+    The current settings come from the inventory and only the properties
+    that differ are set, all in one script, so an apppool that already
+    matches is not written to (and not recycled). Returns ``result``,
+    ``changes`` (``{property: {'old': .., 'new': ..}}``) and ``comment``.
+    With ``test=True`` the changes are only reported.
+
     CLI Example:
 
     .. code-block:: bash
@@ -611,32 +1767,174 @@ def apppool_setting(
     bit_setting; This setting apppool 32bit or 64bit    True = 64bit  False = 32bit
         salt '*' xjoker_win_iis.apppool_setting name='MyTestPool' runtime_version='v2.0' pipeline_mode=0
     '''
+    ret = {'name': name, 'result': True, 'changes': {}, 'comment': ''}
 
-    apppool = list_apppools()
-
-    if name not in apppool:
+    if name not in _inventory()['apppools']:
         _LOG.warning('AppPool not exist!')
-        return False
+        ret['result'] = False
+        ret['comment'] = 'AppPool not exist!'
+        return ret
+
+    desired = _apppool_desired(auto_start, runtime_version, pipeline_mode, bit_setting)
+    changes = _apppool_changes(name, desired)
+    if not changes:
+        ret['comment'] = 'AppPool settings already match'
+        return ret
+    if test:
+        ret['result'] = None
+        ret['changes'] = changes
+        ret['comment'] = 'AppPool settings would be changed'
+        return ret
+
+    settings = dict((key, value) for key, value in six.iteritems(desired)
+                    if _APPPOOL_ATTRS[key] in changes)
+    step = batch([{'op': 'set_apppool', 'name': name, 'settings': settings}])[0]
+    ret['result'] = step['result']
+    if step['result']:
+        ret['changes'] = changes
+        ret['comment'] = 'AppPool settings changed'
+    else:
+        ret['comment'] = step['comment']
+    return ret
 
-    apppool_path = r'IIS:\AppPools\{0}'.format(name)
+def _plan_site_present(planned, name, sourcepath, apppool='', port='80', protocol='http',
+                       hostheader='', ipaddress='*', test=False):
+    if name in _inventory()['sites'] or name in planned['sites']:
+        return [], {}, 'Site already present'
+    protocol = str(protocol).lower()
+    if protocol not in _VALID_PROTOCOLS:
+        raise SaltInvocationError("Invalid protocol '{0}' specified. Valid formats: {1}"
+                                  .format(protocol, _VALID_PROTOCOLS))
+    planned['sites'][name] = [{'protocol': protocol,
+                               'binding_information': _get_binding_info(hostheader, ipaddress, port)}]
+    step = {'op': 'create_site', 'name': name, 'sourcepath': sourcepath, 'port': port,
+            'apppool': apppool, 'hostheader': hostheader, 'ipaddress': ipaddress}
+    if not test:
+        step['site_id'] = _allocate_site_id()
+    return [step], {'site': {'old': None, 'new': name}}, 'Site created'
+
+
+def _plan_site_absent(planned, name, test=False):
+    if name not in _inventory()['sites']:
+        return [], {}, 'Site already absent'
+    return [{'op': 'remove_site', 'name': name}], {'site': {'old': name, 'new': None}}, 'Site removed'
+
+
+def _plan_apppool_present(planned, name, auto_start='', runtime_version='', pipeline_mode='',
+                          bit_setting='', test=False):
+    desired = _apppool_desired(auto_start, runtime_version, pipeline_mode, bit_setting)
+    if name in _inventory()['apppools'] or name in planned['apppools']:
+        if name in planned['apppools']:
+            changes = dict((_APPPOOL_ATTRS[k], {'old': None, 'new': v}) for k, v in six.iteritems(desired))
+        else:
+            changes = _apppool_changes(name, desired)
+        if not changes:
+            return [], {}, 'AppPool already present'
+        settings = dict((k, v) for k, v in six.iteritems(desired) if _APPPOOL_ATTRS[k] in changes)
+        return [{'op': 'set_apppool', 'name': name, 'settings': settings}], changes, 'AppPool settings changed'
+
+    planned['apppools'][name] = True
+    steps = [{'op': 'create_apppool', 'name': name}]
+    changes = {'apppool': {'old': None, 'new': name}}
+    if desired:
+        steps.append({'op': 'set_apppool', 'name': name, 'settings': desired})
+        for key, value in six.iteritems(desired):
+            changes[_APPPOOL_ATTRS[key]] = {'old': None, 'new': value}
+    return steps, changes, 'AppPool created'
+
+
+def _plan_apppool_absent(planned, name, test=False):
+    if name not in _inventory()['apppools']:
+        return [], {}, 'AppPool already absent'
+    return [{'op': 'remove_apppool', 'name': name}], {'apppool': {'old': name, 'new': None}}, 'AppPool removed'
+
+
+def _plan_bindings(planned, site, bindings):
+    if site in planned['sites']:
+        return _binding_steps(site, bindings, planned['sites'][site])
+    if site not in _inventory()['sites']:
+        raise SaltInvocationError('Site not exist: {0}'.format(site))
+    return _binding_steps(site, bindings)
+
+
+def _plan_bindings_managed(planned, name, bindings, test=False):
+    steps, changes = _plan_bindings(planned, name, bindings)
+    if not steps:
+        return [], {}, 'Bindings already match'
+    return steps, changes, 'Bindings changed'
+
+
+def _plan_binding_present(planned, name, site, hostheader='', ipaddress='*', port=80,
+                          protocol='http', test=False):
+    args = _parse_binding({'hostheader': hostheader, 'ipaddress': ipaddress,
+                           'port': port, 'protocol': protocol})
+    current = planned['sites'].get(site)
+    if current is None:
+        if site not in _inventory()['sites']:
+            raise SaltInvocationError('Site not exist: {0}'.format(site))
+        current = _inventory()['sites'][site]['bindings']
+    info = _get_binding_info(hostheader, ipaddress, port)
+    if (args['protocol'], info) in [(x['protocol'], x['binding_information']) for x in current]:
+        return [], {}, 'Binding already present'
+    step = {'op': 'create_binding', 'site': site}
+    step.update(args)
+    return [step], {'binding': {'old': None, 'new': '{0}/{1}'.format(args['protocol'], info)}}, 'Binding created'
+
+
+def _plan_binding_absent(planned, name, site, hostheader='', ipaddress='*', port=80, test=False):
+    info = _get_binding_info(hostheader, ipaddress, port)
+    site_record = _inventory()['sites'].get(site)
+    if site_record is None or info not in [x['binding_information'] for x in site_record['bindings']]:
+        return [], {}, 'Binding already absent'
+    step = {'op': 'remove_binding', 'site': site, 'hostheader': hostheader,
+            'ipaddress': ipaddress, 'port': port}
+    return [step], {'binding': {'old': info, 'new': None}}, 'Binding removed'
+
+
+_PLANNERS = {
+    'site_present': _plan_site_present,
+    'site_absent': _plan_site_absent,
+    'apppool_present': _plan_apppool_present,
+    'apppool_absent': _plan_apppool_absent,
+    'binding_present': _plan_binding_present,
+    'binding_absent': _plan_binding_absent,
+    'bindings_managed': _plan_bindings_managed,
+}
+
+
+def plan(specs, test=False):
+    '''
+    Work out the batch steps needed to reach a list of desired states
+
+    Each spec is a dict with ``fun`` (site_present, site_absent,
+    apppool_present, apppool_absent, binding_present, binding_absent or
+    bindings_managed) and that state's arguments. All specs are checked
+    against one inventory read; objects created by an earlier spec are
+    taken into account by the later ones. Returns one dict per spec with
+    ``steps``, ``changes``, ``comment`` and ``result`` (False when the
+    spec is invalid). The steps can be run with ``xjoker_win_iis.batch``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_win_iis.plan '[{fun: apppool_present, name: Pool1, runtime_version: v4.0}]'
+    '''
+    planned = {'sites': {}, 'apppools': {}}
+    ret = []
+    for spec in specs:
+        spec = dict(spec)
+        fun = spec.pop('fun', None)
+        if fun not in _PLANNERS:
+            raise SaltInvocationError("Invalid state '{0}'. Valid states: {1}"
+                                      .format(fun, sorted(_PLANNERS)))
+        try:
+            steps, changes, comment = _PLANNERS[fun](planned, test=test, **spec)
+            ret.append({'steps': steps, 'changes': changes, 'comment': comment, 'result': True})
+        except (SaltInvocationError, TypeError) as exc:
+            ret.append({'steps': [], 'changes': {}, 'comment': str(exc), 'result': False})
+    return ret
 
-    pscmd = []
-    if runtime_version:
-        pscmd.append("Set-ItemProperty -Path '{0}'  'managedRuntimeVersion'  '{1}';"
-                     .format(apppool_path, runtime_version))
-    if pipeline_mode:
-        pscmd.append("Set-ItemProperty -Path '{0}' 'managedPipelineMode' '{1}';"
-                     .format(apppool_path, pipeline_mode))
-    if auto_start:
-        pscmd.append("Set-ItemProperty -Path '{0}' 'autoStart' '{1}';"
-                     .format(apppool_path, auto_start))
-    if bit_setting == "True" or bit_setting == "False":
-        pscmd.append("Set-ItemProperty -Path '{0}' 'enable32BitAppOnWin64' '{1}';"
-                     .format(apppool_path, bit_setting))
-
-    # New-Item -Path 'IIS:\AppPools\ttt' | Set-ItemProperty -Name enable32BitAppOnWin64 -Value True | Set-ItemProperty -Name managedPipelineMode -Value 1
-    command = ''.join(pscmd)
-    return _srvmgr(command)
 
 def iis(fun):
     '''
@@ -660,4 +1958,6 @@ def iis(fun):
         pscmd.append("invoke-command -scriptblock {iisreset /STOP}")
 
     command = ''.join(pscmd)
-    return _srvmgr(command)
\ No newline at end of file
+    ret = _srvmgr(command)
+    _invalidate_inventory()
+    return ret
\ No newline at end of file
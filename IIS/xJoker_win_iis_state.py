@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+'''
+Microsoft IIS site, apppool and binding states on top of the
+``xjoker_win_iis`` execution module
+
+:platform:      Windows
+
+Install into the ``_states`` directory of the file roots.
+
+Every state is planned against the cached IIS inventory and applied with
+``xjoker_win_iis.batch``. With aggregation enabled (``state_aggregate:
+True`` in the minion config, or ``- aggregate: True`` on a state) all
+xjoker_win_iis states of a run without requisites are merged into the
+first one: a single inventory read and a single batch script apply them
+all. The other states then just report their part of that result. States
+with ``onlyif``, ``unless``, ``creates``, ``check_cmd`` or ``failhard``,
+or targeted by another state's requisites, run on their own, as does
+every state of a ``failhard`` run.
+
+.. code-block:: yaml
+
+    shop-pool:
+      xjoker_win_iis.apppool_present:
+        - name: shop
+        - runtime_version: v4.0
+        - pipeline_mode: 0
+
+    shop-site:
+      xjoker_win_iis.site_present:
+        - name: shop
+        - sourcepath: d:\\web\\shop
+        - apppool: shop
+
+    shop-bindings:
+      xjoker_win_iis.bindings_managed:
+        - name: shop
+        - bindings:
+          - '*:80:shop.example.com'
+          - 'https/*:443:shop.example.com'
+'''
+
+from __future__ import absolute_import
+
+# Import salt libs
+import salt.utils
+
+import inspect
+import json
+import logging
+
+# Define the module's virtual name
+__virtualname__ = 'xjoker_win_iis'
+
+_LOG = logging.getLogger(__name__)
+_PENDING_KEY = 'xjoker_win_iis.aggregate_pending'
+_RESULTS_KEY = 'xjoker_win_iis.aggregate_results'
+_REQUISITES = ('require', 'watch', 'prereq', 'onchanges', 'onfail', 'listen', 'use')
+# Checked by salt before a state runs, an aggregated state would already
+# be applied by then
+_CONDITIONS = ('onlyif', 'unless', 'creates', 'check_cmd', 'failhard', 'prerequired')
+_getargspec = getattr(inspect, 'getfullargspec', getattr(inspect, 'getargspec', None))
+
+
+def __virtual__():
+    '''
+    Load only if the xjoker_win_iis execution module is available
+    '''
+    if 'xjoker_win_iis.plan' in __salt__:
+        return __virtualname__
+    return (False, 'State xjoker_win_iis: xjoker_win_iis execution module not loaded')
+
+
+def _spec(fun, args):
+    '''
+    Build the plan spec of a state from its arguments, filling defaults
+    the same way for a state call and for an aggregated low chunk
+    '''
+    argspec = _getargspec(globals()[fun])
+    defaults = dict(zip(reversed(argspec.args), reversed(argspec.defaults or ())))
+    spec = {'fun': fun}
+    for arg in argspec.args:
+        spec[arg] = args.get(arg, defaults.get(arg))
+    return spec
+
+
+def _spec_key(spec):
+    return json.dumps(spec, sort_keys=True)
+
+
+def _apply(specs):
+    '''
+    Plan all specs against one inventory read and run every step in one
+    batch, returning a state return dict per spec
+    '''
+    test = __opts__['test']
+    plans = __salt__['xjoker_win_iis.plan'](specs, test=test)
+    steps = []
+    for plan in plans:
+        steps.extend(plan['steps'])
+    results = [] if test or not steps else __salt__['xjoker_win_iis.batch'](steps)
+
+    rets = []
+    pos = 0
+    for spec, plan in zip(specs, plans):
+        ret = {'name': spec['name'], 'changes': {}, 'result': plan['result'],
+               'comment': plan['comment']}
+        if plan['result'] and plan['steps']:
+            if test:
+                ret['result'] = None
+                ret['changes'] = plan['changes']
+                ret['comment'] = '{0} (test mode)'.format(plan['comment'])
+            else:
+                step_results = results[pos:pos + len(plan['steps'])]
+                failed = [x for x in step_results if not x['result']]
+                if len(step_results) < len(plan['steps']):
+                    # The script stopped before reporting every step
+                    ret['result'] = False
+                    ret['comment'] = ('Only {0} of {1} steps reported a result, the batch'
+                                      ' script did not finish'.format(len(step_results),
+                                                                      len(plan['steps'])))
+                elif failed:
+                    ret['result'] = False
+                    ret['comment'] = '; '.join(x['comment'] for x in failed)
+                else:
+                    ret['changes'] = plan['changes']
+                    if spec['fun'] == 'site_present':
+                        _site_acl(spec, ret)
+            pos += len(plan['steps'])
+        rets.append(ret)
+    return rets
+
+
+def _site_acl(spec, ret):
+    '''
+    Grant the apppool identity of a newly created site full control on
+    its physical path, failing the state when that fails. The result is
+    None while the ACL job is still running after
+    ``xjoker_win_iis:acl_timeout`` seconds.
+    '''
+    pool = __salt__['xjoker_win_iis.inventory']()['sites'][spec['name']]['apppool']
+    acl = __salt__['xjoker_win_iis.set_acl'](
+        spec['sourcepath'], r'IIS AppPool\{0}'.format(pool), wait=True,
+        timeout=__salt__['config.get']('xjoker_win_iis:acl_timeout', 600))
+    if acl['status'] == 'running':
+        ret['result'] = None
+        ret['comment'] = ('Site created, permissions are still being set by ACL job {0}'
+                          .format(acl['job']))
+    elif acl['status'] != 'done':
+        ret['result'] = False
+        ret['comment'] = 'Site created but permissions failed: {0}'.format('; '.join(acl['errors']))
+
+
+def _run(fun, args):
+    spec = _spec(fun, args)
+    key = _spec_key(spec)
+    results = __context__.setdefault(_RESULTS_KEY, {})
+    if key in results:
+        return results.pop(key)
+
+    pending = [x for x in __context__.pop(_PENDING_KEY, []) if _spec_key(x) != key]
+    rets = _apply([spec] + pending)
+    for other, ret in zip(pending, rets[1:]):
+        results[_spec_key(other)] = ret
+    return rets[0]
+
+
+def _requisite_targets(chunks):
+    '''
+    IDs and names referenced by the requisites of any chunk of the run,
+    including the ``*_in`` forms pointing at other states
+    '''
+    targets = set()
+    for chunk in chunks:
+        for key, value in chunk.items():
+            if key.split('_')[0] not in _REQUISITES or not isinstance(value, list):
+                continue
+            for req in value:
+                if isinstance(req, dict):
+                    targets.update(str(x) for x in req.values())
+                else:
+                    targets.add(str(req))
+    return targets
+
+
+def _standalone(chunk, targets):
+    if any(chunk.get(key) for key in chunk if key.split('_')[0] in _REQUISITES):
+        return True
+    if any(key in chunk for key in _CONDITIONS):
+        return True
+    return chunk.get('__id__') in targets or chunk.get('name') in targets
+
+
+def mod_aggregate(low, chunks, running):
+    '''
+    Queue every other xjoker_win_iis state of the run that has no
+    requisites or run conditions, so the first one to execute applies them
+    all at once
+    '''
+    if __opts__.get('failhard') or low.get('failhard'):
+        # A failure must stop the states after it from being applied
+        return low
+    pending = __context__.setdefault(_PENDING_KEY, [])
+    targets = _requisite_targets(chunks)
+    for chunk in chunks:
+        if chunk.get('state') != __virtualname__ or chunk is low:
+            continue
+        if '__agg__' in chunk or chunk.get('fun') not in _STATES:
+            continue
+        if salt.utils.gen_state_tag(chunk) in running:
+            continue
+        if _standalone(chunk, targets):
+            continue
+        chunk['__agg__'] = True
+        pending.append(_spec(chunk['fun'], chunk))
+    return low
+
+
+def site_present(name, sourcepath, apppool='', port='80', protocol='http',
+                 hostheader='', ipaddress='*'):
+    '''
+    Ensure a website exists, see ``xjoker_win_iis.create_site``
+
+    name
+        Name of the site
+    sourcepath
+        Physical path of the site, created when missing. The apppool
+        identity is granted full control on it.
+    apppool
+        Apppool of the site, a pool named after the site is created when
+        it does not exist
+    '''
+    return _run('site_present', locals())
+
+
+def site_absent(name):
+    '''
+    Ensure a website does not exist
+    '''
+    return _run('site_absent', locals())
+
+
+def apppool_present(name, auto_start='', runtime_version='', pipeline_mode='',
+                    bit_setting=''):
+    '''
+    Ensure an apppool exists with the given settings, see
+    ``xjoker_win_iis.apppool_setting``. Only settings that differ are
+    written.
+    '''
+    return _run('apppool_present', locals())
+
+
+def apppool_absent(name):
+    '''
+    Ensure an apppool does not exist
+    '''
+    return _run('apppool_absent', locals())
+
+
+def binding_present(name, site, hostheader='', ipaddress='*', port=80, protocol='http'):
+    '''
+    Ensure a site has a binding
+
+    name
+        Label of the state
+    site
+        Name of the site
+    '''
+    return _run('binding_present', locals())
+
+
+def binding_absent(name, site, hostheader='', ipaddress='*', port=80):
+    '''
+    Ensure a site does not have a binding
+    '''
+    return _run('binding_absent', locals())
+
+
+def bindings_managed(name, bindings):
+    '''
+    Ensure the bindings of site ``name`` are exactly ``bindings``, see
+    ``xjoker_win_iis.set_bindings``
+    '''
+    return _run('bindings_managed', locals())
+
+
+_STATES = ('site_present', 'site_absent', 'apppool_present', 'apppool_absent',
+           'binding_present', 'binding_absent', 'bindings_managed')
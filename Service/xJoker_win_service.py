@@ -6,51 +6,370 @@ Microsoft service management via powershell module
 
 .. versionadded:: 2016.7.14
 
+Needs the ``xjoker_runner`` utils module, commands run in its long-lived
+powershell hosts unless ``xjoker_win_service:pshost`` is False.
+
 '''
 from __future__ import absolute_import
 
 # Import salt libs
 import salt.utils
-from salt.exceptions import SaltInvocationError
+from salt.exceptions import CommandExecutionError, SaltInvocationError
 
+import fnmatch
 import logging
 import sys
+import time
 
 # Define the module's virtual name
 __virtualname__ = 'xjoker_win_service'
 
 _LOG = logging.getLogger(__name__)
 
+# Get-Service style start types to Win32_Service StartMode
+_START_TYPES = {
+    'automatic': 'Auto',
+    'auto': 'Auto',
+    'manual': 'Manual',
+    'disabled': 'Disabled',
+    'boot': 'Boot',
+    'system': 'System',
+}
+
 def __virtual__():
     '''
     Load only on Windows
     '''
     if salt.utils.is_windows():
+        if 'xjoker_runner.powershell' not in __utils__:
+            return (False, 'Module xjoker_win_service: the xjoker_runner utils module is missing')
+        __utils__['xjoker_runner.instrument'](globals(), __virtualname__)
         return __virtualname__
     return (False, 'Module xjoker_win_service: module only works on Windows systems')
 
 
-def _srvmgr(func, xml=False):
+def _srvmgr(func, timeout=None):
     '''
     Execute a function from the PS module
     '''
-    set_encoding='$OutputEncoding = New-Object -typename System.Text.UTF8Encoding;'
-    command = '{0} {1}'.format(set_encoding,func)
+    return __utils__['xjoker_runner.powershell'](
+        func,
+        persistent=__salt__['config.get']('xjoker_win_service:pshost', True),
+        timeout=timeout,
+        label='service')
+
+
+def _split_names(name):
+    if isinstance(name, (list, tuple)):
+        return [str(x).strip() for x in name if str(x).strip()]
+    return [x.strip() for x in str(name).split(',') if x.strip()]
+
+
+def _ps_names(names):
+    return ','.join("'{0}'".format(x.replace("'", "''")) for x in names)
+
+
+def _wql_quote(value):
+    return "'{0}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def _wql_like(pattern):
+    '''
+    Translate a name glob to a WQL LIKE pattern
+    '''
+    ret = []
+    for char in pattern:
+        if char in '%_[':
+            ret.append('[{0}]'.format(char))
+        elif char == '*':
+            ret.append('%')
+        elif char == '?':
+            ret.append('_')
+        else:
+            ret.append(char)
+    return ''.join(ret)
 
-    cmd_ret = __salt__['cmd.run'](command, shell='powershell', python_shell=True)
-    return cmd_ret
 
+def _wql_filter(name=None, status=None, start_type=None):
+    '''
+    Build the Win32_Service filter, so PowerShell only serializes the
+    matching services
+    '''
+    clauses = []
+    if name:
+        clauses.append('({0})'.format(' OR '.join(
+            'Name LIKE {0}'.format(_wql_quote(_wql_like(x))) for x in _split_names(name))))
+    if status:
+        clauses.append('State = {0}'.format(_wql_quote(str(status))))
+    if start_type:
+        mode = _START_TYPES.get(str(start_type).lower())
+        if mode is None:
+            raise SaltInvocationError("Invalid start_type '{0}'. Valid: {1}"
+                                      .format(start_type, sorted(_START_TYPES)))
+        clauses.append('StartMode = {0}'.format(_wql_quote(mode)))
+    return ' AND '.join(clauses)
 
-def get_service_status():
+
+def get_service_status(name=None, status=None, start_type=None):
     '''
     Use PS module get all service now status
 
+    Returns a dict keyed by service name with ``display_name``, ``status``
+    and ``start_type``. The filters are pushed down into the WMI query:
+
+    name
+        Service name glob, or a list / comma separated string of globs
+    status
+        Running, Stopped, Paused, Start Pending, ...
+    start_type
+        Automatic, Manual, Disabled, Boot or System
+
         salt '*' xjoker_win_service.get_service_status
+        salt '*' xjoker_win_service.get_service_status name='w3svc,MSSQL*' status=Running
     '''
     pscmd=[]
-    pscmd.append(r'get-service | format-list -Property Name,Status,DisplayName')
+    pscmd.append(r'Get-WmiObject -Class Win32_Service')
+    wql = _wql_filter(name, status, start_type)
+    if wql:
+        # Single quoted, so powershell does not expand a $ in the names
+        pscmd.append(r" -Filter '{0}'".format(wql.replace("'", "''")))
+    pscmd.append(r' | Select-Object Name,State,StartMode,DisplayName')
+    pscmd.append(r' | ConvertTo-Csv -NoTypeInformation')
 
     command = ''.join(pscmd)
     res=_srvmgr(command)
 
-    return res
\ No newline at end of file
+    ret = {}
+    for row in __utils__['xjoker_runner.csv_rows'](res.splitlines()):
+        ret[row['Name']] = {
+            'display_name': row['DisplayName'],
+            'status': row['State'],
+            'start_type': row['StartMode'],
+        }
+    return ret
+
+
+def status_delta(digest=None, name=None):
+    '''
+    Cheap service state snapshot for change detection
+
+    PowerShell hashes the ``name<TAB>status`` list of all services (or of
+    the ``name`` globs) and only sends the list back when the hash differs
+    from ``digest``. Returns ``digest``, ``changed`` and ``services``
+    (``{name: status}``, empty when unchanged).
+
+        salt '*' xjoker_win_service.status_delta
+        salt '*' xjoker_win_service.status_delta digest=0A1B... name='w3svc,MSSQL*'
+    '''
+    pscmd=[]
+    pscmd.append(r'$lines = @(Get-Service')
+    if name:
+        pscmd.append(r' -Name {0}'.format(_ps_names(_split_names(name))))
+    pscmd.append(r' -ErrorAction SilentlyContinue | Sort-Object Name')
+    pscmd.append(r' | ForEach-Object { $_.Name + "`t" + $_.Status });')
+    pscmd.append(r'$md5 = [Security.Cryptography.MD5]::Create();')
+    pscmd.append(r'$hash = [BitConverter]::ToString($md5.ComputeHash(')
+    pscmd.append(r'[Text.Encoding]::UTF8.GetBytes($lines -join "`n"))).Replace("-", "");')
+    pscmd.append(r'$hash;')
+    pscmd.append(r"if ($hash -ne '{0}') {{ $lines }}".format(str(digest or '').replace("'", '')))
+
+    command = ''.join(pscmd)
+    res=_srvmgr(command).splitlines()
+
+    ret = {'digest': res[0].strip() if res else '', 'changed': False, 'services': {}}
+    if ret['digest'] != digest:
+        ret['changed'] = True
+        for line in res[1:]:
+            svc, _, state = line.strip().partition('\t')
+            if svc:
+                ret['services'][svc] = state
+    return ret
+
+
+def _service_graph(names):
+    '''
+    Read the matching services and their dependencies in one query.
+
+    Returns ``{name: {'status', 'depends_on', 'dependents'}}``, the
+    dependency lists only hold services that are part of the result.
+    '''
+    pscmd=[]
+    pscmd.append(r'Get-Service -Name {0} -ErrorAction SilentlyContinue'.format(_ps_names(names)))
+    pscmd.append(r' | Select-Object Name,@{n="Status";e={[string]$_.Status}}')
+    pscmd.append(r',@{n="DependsOn";e={($_.ServicesDependedOn | ForEach-Object { $_.Name }) -join ";"}}')
+    pscmd.append(r',@{n="Dependents";e={($_.DependentServices | ForEach-Object { $_.Name }) -join ";"}}')
+    pscmd.append(r' | ConvertTo-Csv -NoTypeInformation')
+
+    command = ''.join(pscmd)
+    rows = list(__utils__['xjoker_runner.csv_rows'](_srvmgr(command).splitlines()))
+
+    known = dict((row['Name'].lower(), row['Name']) for row in rows)
+    graph = {}
+    for row in rows:
+        graph[row['Name']] = {'status': row['Status'], 'depends_on': set(), 'dependents': set()}
+    for row in rows:
+        # DependentServices is transitive, ServicesDependedOn only direct:
+        # read both so services linked through one outside the list are
+        # still ordered
+        for dep in row['DependsOn'].split(';'):
+            if dep.lower() in known:
+                graph[row['Name']]['depends_on'].add(known[dep.lower()])
+        for dep in row['Dependents'].split(';'):
+            if dep.lower() in known:
+                graph[known[dep.lower()]]['depends_on'].add(row['Name'])
+    for name, node in graph.items():
+        node['depends_on'].discard(name)
+        for dep in node['depends_on']:
+            graph[dep]['dependents'].add(name)
+    return graph
+
+
+def _service_levels(graph, edge):
+    '''
+    Group services into levels, every service only waits on services of
+    earlier levels through ``edge`` (``depends_on`` to start,
+    ``dependents`` to stop)
+    '''
+    levels = []
+    done = set()
+    todo = set(graph)
+    while todo:
+        level = sorted(x for x in todo if graph[x][edge] <= done)
+        if not level:
+            raise CommandExecutionError('Circular service dependency between: {0}'
+                                        .format(', '.join(sorted(todo))))
+        levels.append(level)
+        done.update(level)
+        todo.difference_update(level)
+    return levels
+
+
+def _control_level(action, names, timeout):
+    '''
+    Send start or stop to all services of a level at once, then poll until
+    each reached its target state or ``timeout`` seconds passed.
+
+    Returns ``{name: (status, milliseconds, error)}``.
+    '''
+    target = 'Running' if action == 'start' else 'Stopped'
+    pscmd=[]
+    pscmd.append(r'Add-Type -AssemblyName System.ServiceProcess;')
+    pscmd.append(r'$svcs = @(); foreach ($n in @({0})) {{'.format(_ps_names(names)))
+    pscmd.append(r' $e = @{Name=$n; Done=$false; Error="";')
+    pscmd.append(r' Ctl=(New-Object System.ServiceProcess.ServiceController($n));')
+    pscmd.append(r' Watch=[Diagnostics.Stopwatch]::StartNew()};')
+    pscmd.append(r" try {{ if ($e.Ctl.Status -ne '{0}') {{ $e.Ctl.{1}() }} }}".format(target, action.title()))
+    pscmd.append(r' catch { $e.Error = $_.Exception.GetBaseException().Message; $e.Done = $true; $e.Watch.Stop() };')
+    pscmd.append(r' $svcs += $e };')
+    pscmd.append(r'$clock = [Diagnostics.Stopwatch]::StartNew();')
+    pscmd.append(r'while (@($svcs | Where-Object { -not $_.Done }).Count')
+    pscmd.append(r' -and $clock.Elapsed.TotalSeconds -lt {0}) {{'.format(float(timeout)))
+    pscmd.append(r' foreach ($e in @($svcs | Where-Object { -not $_.Done })) {')
+    pscmd.append(r"  $e.Ctl.Refresh(); if ($e.Ctl.Status -eq '{0}') {{ $e.Done = $true; $e.Watch.Stop() }} }};".format(target))
+    pscmd.append(r' Start-Sleep -Milliseconds 100 };')
+    pscmd.append(r'$svcs | ForEach-Object { $_.Ctl.Refresh();')
+    pscmd.append(r' New-Object PSObject -Property @{Name=$_.Name; Status=[string]$_.Ctl.Status;')
+    pscmd.append(r' Ms=$_.Watch.ElapsedMilliseconds; Error=$_.Error} }')
+    pscmd.append(r' | Select-Object Name,Status,Ms,Error | ConvertTo-Csv -NoTypeInformation')
+
+    command = ''.join(pscmd)
+    output = _srvmgr(command, timeout=float(timeout) + 60)
+    ret = {}
+    for row in __utils__['xjoker_runner.csv_rows'](output.splitlines()):
+        ret[row['Name']] = (row['Status'], int(row['Ms'] or 0), row['Error'])
+    return ret
+
+
+def _control(actions, name, timeout):
+    start = time.time()
+    names = _split_names(name)
+    graph = _service_graph(names)
+    items = {}
+    for pattern in names:
+        if not any(fnmatch.fnmatch(x.lower(), pattern.lower()) for x in graph):
+            items[pattern] = {'result': False, 'status': None, 'duration': 0.0,
+                              'comment': 'Not found'}
+
+    failed = set()
+    plan = []
+    for action in actions:
+        target = 'Running' if action == 'start' else 'Stopped'
+        edge = 'depends_on' if action == 'start' else 'dependents'
+        levels = _service_levels(graph, edge)
+        plan.append({'action': action, 'levels': levels})
+        for level in levels:
+            todo = []
+            for svc in level:
+                blocked = sorted(graph[svc][edge] & failed)
+                if svc in failed:
+                    continue
+                if blocked:
+                    failed.add(svc)
+                    item = items.setdefault(svc, {'status': graph[svc]['status'], 'duration': 0.0})
+                    item['result'] = None
+                    item['comment'] = 'Skipped, {0} failed'.format(', '.join(blocked))
+                else:
+                    todo.append(svc)
+            if not todo:
+                continue
+            for svc, (status, msec, error) in _control_level(action, todo, timeout).items():
+                item = items.setdefault(svc, {'duration': 0.0})
+                item['duration'] = round(item['duration'] + msec / 1000.0, 3)
+                item['status'] = status
+                item['result'] = status == target and not error
+                if error:
+                    item['comment'] = error
+                elif status != target:
+                    item['comment'] = 'Still {0} after {1} seconds'.format(status, timeout)
+                else:
+                    item['comment'] = target
+                if not item['result']:
+                    failed.add(svc)
+
+    return {
+        'result': all(x['result'] for x in items.values()),
+        'duration': round(time.time() - start, 3),
+        'plan': plan,
+        'items': items,
+    }
+
+
+def start_services(name, timeout=60):
+    '''
+    Start many services, dependencies first
+
+    ``name`` is a list (or comma separated string) of service names and
+    globs. The dependency graph of all of them is read in one query and
+    split into levels: every service of a level is started at once, and a
+    level only begins when the services it depends on are running. A
+    service whose dependency failed is skipped with a ``None`` result.
+    ``timeout`` is the number of seconds a level may take.
+
+    Returns the overall ``result`` and ``duration``, the ``plan`` levels,
+    and per-service ``result``, ``status``, ``comment`` and ``duration``
+    (seconds until the state was reached) under ``items``.
+
+        salt '*' xjoker_win_service.start_services 'MSSQLSERVER,app-*' timeout=120
+    '''
+    return _control(('start',), name, timeout)
+
+
+def stop_services(name, timeout=60):
+    '''
+    Stop many services, dependents first, see
+    ``xjoker_win_service.start_services``
+
+        salt '*' xjoker_win_service.stop_services 'app-*'
+    '''
+    return _control(('stop',), name, timeout)
+
+
+def restart_services(name, timeout=60):
+    '''
+    Stop many services dependents first, then start them dependencies
+    first, see ``xjoker_win_service.start_services``. The ``duration`` of
+    a service is its stop plus its start time.
+
+        salt '*' xjoker_win_service.restart_services 'app-*'
+    '''
+    return _control(('stop', 'start'), name, timeout)
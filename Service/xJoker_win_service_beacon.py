@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+'''
+Beacon firing when a Windows service changes state
+
+:platform:      Windows
+
+Install into the ``_beacons`` directory of the file roots. The service
+states are kept in memory between runs. Every interval one
+``xjoker_win_service.status_delta`` query checks a hash of all states, and
+events are only sent for services whose state actually changed.
+
+.. code-block:: yaml
+
+    beacons:
+      xjoker_win_service:
+        services:          # optional name globs, default all services
+          - w3svc
+          - MSSQL*
+        emit_at_startup: False
+        interval: 60
+
+Event data holds ``service``, ``status`` and ``previous`` (``None`` for a
+new service, ``Removed`` as status for a deleted one).
+'''
+from __future__ import absolute_import
+
+# Import salt libs
+import salt.utils
+from salt.ext import six
+
+import logging
+
+# Define the module's virtual name
+__virtualname__ = 'xjoker_win_service'
+
+_LOG = logging.getLogger(__name__)
+
+# Last snapshot: {'digest': ..., 'services': {name: status}}
+LAST_STATUS = {}
+
+
+def __virtual__():
+    '''
+    Load only on Windows
+    '''
+    if salt.utils.is_windows():
+        return __virtualname__
+    return (False, 'Beacon xjoker_win_service: beacon only works on Windows systems')
+
+
+def _config(config):
+    # Beacon config is a dict in older Salt and a list of dicts in newer
+    if isinstance(config, list):
+        ret = {}
+        for item in config:
+            ret.update(item)
+        return ret
+    return config
+
+
+def __validate__(config):
+    '''
+    Validate the beacon configuration
+    '''
+    config = _config(config)
+    if not isinstance(config, dict):
+        return False, 'Configuration for xjoker_win_service beacon must be a dict or a list of dicts.'
+    services = config.get('services')
+    if services is not None and not isinstance(services, (list,) + six.string_types):
+        return False, 'services for xjoker_win_service beacon must be a list of name globs.'
+    return True, 'Valid beacon configuration'
+
+
+def beacon(config):
+    '''
+    Emit an event for every service whose state changed since the last run
+    '''
+    config = _config(config)
+    delta = __salt__['xjoker_win_service.status_delta'](
+        digest=LAST_STATUS.get('digest'), name=config.get('services'))
+    if not delta['changed']:
+        return []
+
+    previous = LAST_STATUS.get('services')
+    current = delta['services']
+    LAST_STATUS['digest'] = delta['digest']
+    LAST_STATUS['services'] = current
+
+    if previous is None and not config.get('emit_at_startup', False):
+        return []
+    previous = previous or {}
+
+    ret = []
+    for name, status in current.items():
+        if previous.get(name) != status:
+            ret.append({'tag': name, 'service': name, 'status': status,
+                        'previous': previous.get(name)})
+    for name in set(previous) - set(current):
+        ret.append({'tag': name, 'service': name, 'status': 'Removed',
+                    'previous': previous[name]})
+    _LOG.debug('xjoker_win_service beacon: %d service state change(s)', len(ret))
+    return ret
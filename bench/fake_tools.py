@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Stand-ins for the Windows tools called by the xJoker modules
+
+    fake_tools.py <tool> [arguments]
+
+``tool`` is one of ``powershell``, ``appcmd``, ``netsh``, ``svn``,
+``goodsync`` or ``icacls``. ``bench/run.py`` puts small wrappers named
+after the real executables on the PATH. Behaviour is set through the environment:
+
+XJOKER_FAKE_LATENCY, XJOKER_FAKE_LATENCY_<TOOL>
+    Seconds every process start takes (default 0)
+XJOKER_FAKE_REQUEST_LATENCY
+    Seconds every request to a persistent powershell host takes
+XJOKER_FAKE_SITES, XJOKER_FAKE_SERVICES, XJOKER_FAKE_RULES,
+XJOKER_FAKE_SVN_LINES, XJOKER_FAKE_JOBS
+    Size of the generated output
+XJOKER_FAKE_BATCH_FAIL
+    Comma separated names whose xjoker_win_iis batch steps fail
+XJOKER_FAKE_BATCH_LIMIT
+    Number of batch step results printed, as if the script stopped there
+XJOKER_FAKE_FIREWALL
+    JSON file keeping the rules added with netsh (directly or through
+    ``netsh -f``) on top of the generated ones
+XJOKER_FAKE_SVN_CHANGES
+    JSON file with the changes ``svn diff --summarize`` reports, a list of
+    ``{"path": .., "item": .., "kind": ..}``. ``svn update --parents``
+    into a working copy checked out with ``--depth empty`` writes the
+    listed files as ``<path>@<revision>``, except those with
+    ``"lost": true``.
+XJOKER_FAKE_SVN_PASSWORD
+    Password the fake svn accepts, any by default. With ``--config-dir``
+    it stores the credentials like svn and accepts a missing
+    ``--password`` once they are stored.
+XJOKER_FAKE_LOG
+    File getting one ``<tool> spawn`` or ``<tool> request`` line per
+    process start or host request
+'''
+from __future__ import absolute_import, print_function
+
+import base64
+import io
+import json
+import os
+import re
+import shlex
+import sys
+import time
+
+
+def _size(name, default):
+    return int(os.environ.get('XJOKER_FAKE_' + name, default))
+
+
+def _log(tool, kind):
+    path = os.environ.get('XJOKER_FAKE_LOG')
+    if path:
+        with open(path, 'a') as fp_:
+            fp_.write('{0} {1}\n'.format(tool, kind))
+
+
+def _spawn(tool):
+    _log(tool, 'spawn')
+    time.sleep(float(os.environ.get('XJOKER_FAKE_LATENCY_' + tool.upper(),
+                                    os.environ.get('XJOKER_FAKE_LATENCY', 0))))
+
+
+def _write(text):
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    out.write(text.encode('utf-8'))
+    out.flush()
+
+
+def appcmd_sites():
+    ret = []
+    for idx in range(1, _size('SITES', 1000) + 1):
+        name = 'site-{0}'.format(idx)
+        ret.append(
+            '<SITE SITE.NAME="{0}" SITE.ID="{1}" state="Started">'
+            '<site name="{0}" id="{1}" serverAutoStart="true">'
+            '<bindings><binding protocol="http" bindingInformation="*:80:{0}.example.com" />'
+            '</bindings>'
+            '<application path="/" applicationPool="{0}">'
+            '<virtualDirectory path="/" physicalPath="d:\\web\\{0}" /></application>'
+            '</site></SITE>'.format(name, idx))
+    return '\n'.join(ret)
+
+
+def appcmd_apppools():
+    ret = []
+    for idx in range(1, _size('SITES', 1000) + 1):
+        ret.append(
+            '<APPPOOL APPPOOL.NAME="site-{0}" state="Started">'
+            '<add name="site-{0}" managedRuntimeVersion="v4.0" managedPipelineMode="Integrated" />'
+            '</APPPOOL>'.format(idx))
+    return '\n'.join(ret)
+
+
+def _batch(script):
+    failing = [x for x in os.environ.get('XJOKER_FAKE_BATCH_FAIL', '').split(',') if x]
+    stop = False
+    ret = []
+    steps = re.split(r"(?m)^(?=\$r = @\{step=)", script)[1:]
+    for text in steps:
+        step, op, name = re.match(r"\$r = @\{step=(\d+); op='([^']*)'; name='([^']*)'",
+                                  text).groups()
+        result = {'step': int(step), 'op': op, 'name': name, 'result': True,
+                  'changed': True, 'comment': '', 'duration': 0.001}
+        if stop:
+            result.update(result=None, changed=False, duration=0.0,
+                          comment='Skipped after an earlier failure')
+        elif name in failing:
+            result.update(result=False, changed=False, comment='fake failure')
+            stop = '$__stop = $true' in text
+        elif op == 'create_site':
+            pool = re.search(r"\$pool = '([^']*)'", text).group(1) or name
+            site_id = re.search(r"\$id = (\d+)", text)
+            result['index'] = {'site_id': int(site_id.group(1)) if site_id else 0,
+                               'apppool': pool, 'state': 'Started'}
+        ret.append(result)
+    limit = os.environ.get('XJOKER_FAKE_BATCH_LIMIT')
+    if limit:
+        ret = ret[:int(limit)]
+    return json.dumps(ret)
+
+
+def _services():
+    ret = ['"Name","State","StartMode","DisplayName"']
+    for idx in range(_size('SERVICES', 200)):
+        ret.append('"svc-{0}","Running","Auto","Service {0}"'.format(idx))
+    return '\n'.join(ret)
+
+
+def _added_rules():
+    path = os.environ.get('XJOKER_FAKE_FIREWALL')
+    if not path or not os.path.isfile(path):
+        return []
+    with io.open(path, encoding='utf-8') as fp_:
+        return json.load(fp_)
+
+
+def _save_rules(rules):
+    path = os.environ.get('XJOKER_FAKE_FIREWALL')
+    if path:
+        with io.open(path, 'w', encoding='utf-8') as fp_:
+            fp_.write(json.dumps(rules, ensure_ascii=False))
+
+
+_NETSH_CODES = {
+    'dir': {'in': '1', 'out': '2'},
+    'protocol': {'icmpv4': '1', 'tcp': '6', 'udp': '17', 'icmpv6': '58', 'any': '256'},
+    'action': {'block': '0', 'allow': '1'},
+}
+
+
+def _netsh_rule(args):
+    '''
+    ``firewall add|delete rule key=value ...`` against the rules file
+    '''
+    values = dict(arg.split('=', 1) for arg in args if '=' in arg)
+    rules = _added_rules()
+    if 'delete' in args:
+        rules = [x for x in rules if x['name'] != values.get('name')]
+    elif 'add' in args:
+        rules.append(dict((key, _NETSH_CODES.get(key, {}).get(value.lower(), value))
+                          for key, value in values.items()))
+    _save_rules(rules)
+
+
+def _firewall_rules():
+    ret = ['"Name","Direction","Protocol","LocalPorts","RemotePorts","LocalAddresses",'
+           '"RemoteAddresses","Action","Enabled","Profiles","Grouping","ApplicationName",'
+           '"ServiceName","EdgeTraversal"']
+    for idx in range(_size('RULES', 5000)):
+        ret.append('"rule-{0}","{1}","6","{2}","*","*","*","1","True","2147483647","","","",'
+                   '"False"'.format(idx, 1 + idx % 2, 10000 + idx))
+    for rule in _added_rules():
+        remoteip = rule.get('remoteip', 'any')
+        if remoteip == 'any':
+            remoteip = '*'
+        elif '/' not in remoteip:
+            remoteip += '/255.255.255.255'
+        ret.append('"{0}","{1}","{2}","{3}","*","*","{4}","{5}","True","2147483647","","","",'
+                   '"False"'.format(rule['name'], rule.get('dir', '1'), rule.get('protocol', '6'),
+                                    rule.get('localport', '*'), remoteip,
+                                    rule.get('action', '1')))
+    return '\n'.join(ret)
+
+
+def powershell_output(script):
+    '''
+    Output of a script, recognised by the commands it runs
+    '''
+    if 'list site /config /xml' in script or 'list apppool /config /xml' in script:
+        ret = []
+        if '"<inventory>"' in script:
+            ret.append('<inventory>')
+        if 'list site /config /xml' in script:
+            ret.append(appcmd_sites())
+        if 'list apppool /config /xml' in script:
+            ret.append(appcmd_apppools())
+        if '"</inventory>"' in script:
+            ret.append('</inventory>')
+        return '\n'.join(ret)
+    if '$__results' in script:
+        return _batch(script)
+    if 'Win32_Service' in script:
+        return _services()
+    if 'HNetCfg.FwPolicy2).Rules' in script:
+        return _firewall_rules()
+    if 'FirewallEnabled' in script:
+        return '1,True\n2,True\n4,False'
+    return ''
+
+
+def powershell(args):
+    _spawn('powershell')
+    if '-EncodedCommand' in args:
+        script = base64.b64decode(args[args.index('-EncodedCommand') + 1]).decode('utf-16-le')
+    elif '-File' in args:
+        with io.open(args[args.index('-File') + 1], encoding='utf-8-sig') as fp_:
+            script = fp_.read()
+    else:
+        script = ' '.join(args)
+
+    if 'XJOKER-FRAME' not in script:
+        _write(powershell_output(script) + '\n')
+        return 0
+
+    # Persistent host, see xjoker_runner._PSHost
+    latency = float(os.environ.get('XJOKER_FAKE_REQUEST_LATENCY', 0))
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    for line in iter(stdin.readline, b''):
+        line = line.strip()
+        if line == b'XJOKER-QUIT':
+            break
+        _log('powershell', 'request')
+        time.sleep(latency)
+        output = powershell_output(base64.b64decode(line).decode('utf-8'))
+        _write('XJOKER-FRAME 0 {0}\n'.format(
+            base64.b64encode(output.encode('utf-8')).decode('ascii')))
+    return 0
+
+
+def appcmd(args):
+    _spawn('appcmd')
+    if args[:2] == ['list', 'site']:
+        _write(appcmd_sites() + '\n')
+    elif args[:2] == ['list', 'apppool']:
+        _write(appcmd_apppools() + '\n')
+    return 0
+
+
+_NETSH_RULE = '''Rule Name:                            rule-{0}
+----------------------------------------------------------------------
+Enabled:                              Yes
+Direction:                            {1}
+Profiles:                             Domain,Private,Public
+Grouping:
+LocalIP:                              Any
+RemoteIP:                             Any
+Protocol:                             TCP
+LocalPort:                            {2}
+RemotePort:                           Any
+Edge traversal:                       No
+Action:                               Allow
+
+'''
+
+
+def netsh(args):
+    _spawn('netsh')
+    if args[:1] == ['-f']:
+        with io.open(args[1], encoding='utf-8') as fp_:
+            for line in fp_:
+                if line.strip():
+                    _netsh_rule(shlex.split(line))
+        _write('Ok.\n\n')
+    elif ('add' in args or 'delete' in args) and 'rule' in args:
+        _netsh_rule(args)
+        _write('Ok.\n\n')
+    elif 'show' in args and 'rule' in args:
+        out = [''] + [_NETSH_RULE.format(idx, 'In' if idx % 2 else 'Out', 10000 + idx)
+                      for idx in range(_size('RULES', 5000))]
+        _write('\n'.join(out) + 'Ok.\n\n')
+    else:
+        _write('Ok.\n\n')
+    return 0
+
+
+_SVN_ITEMS = ('modified', 'added', 'unversioned', 'missing')
+
+_SVN_INFO_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<info>
+<entry kind="dir" path="." revision="1234">
+<url>https://svn.example.com/repo/trunk</url>
+<relative-url>^/trunk</relative-url>
+<repository><root>https://svn.example.com/repo</root><uuid>0f2c5b4e-1c2d-4e5f-8a9b-0c1d2e3f4a5b</uuid></repository>
+<wc-info><wcroot-abspath>D:/web/shop</wcroot-abspath><schedule>normal</schedule><depth>infinity</depth></wc-info>
+<commit revision="1230"><author>deploy</author><date>2016-05-04T03:02:01.123456Z</date></commit>
+</entry>
+</info>
+'''
+
+
+def _svn_status_xml(lines):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<status>\n<target path=".">\n'
+    for idx in range(lines):
+        item = _SVN_ITEMS[idx % 4]
+        yield '<entry path="trunk\\src\\module{0}\\file{1}.cs">\n'.format(idx // 100, idx)
+        if item in ('unversioned', 'added'):
+            yield '<wc-status props="none" item="{0}"></wc-status>\n</entry>\n'.format(item)
+        else:
+            yield ('<wc-status props="none" item="{0}" revision="1234">\n'
+                   '<commit revision="{1}"><author>deploy</author>'
+                   '<date>2016-05-04T03:02:01.123456Z</date></commit>\n'
+                   '</wc-status>\n</entry>\n'.format(item, 1000 + idx % 234))
+    yield '</target>\n</status>\n'
+
+
+def _svn_log_xml(entries):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n<log>\n'
+    for idx in range(entries):
+        yield ('<logentry revision="{0}">\n<author>deploy</author>\n'
+               '<date>2016-05-04T03:02:01.123456Z</date>\n<paths>\n'
+               '<path action="M" kind="file">/trunk/src/file{0}.cs</path>\n'
+               '</paths>\n<msg>change {0}</msg>\n</logentry>\n'.format(1234 - idx))
+    yield '</log>\n'
+
+
+def _option(args, name):
+    return args[args.index(name) + 1] if name in args else None
+
+
+def _svn_auth(args):
+    '''
+    Check the credentials against XJOKER_FAKE_SVN_PASSWORD and keep them
+    in ``--config-dir`` like the svn auth store does
+    '''
+    username = _option(args, '--username')
+    password = _option(args, '--password')
+    config_dir = _option(args, '--config-dir')
+    if not username:
+        return True
+    store = os.path.join(config_dir, 'auth', 'svn.simple') if config_dir else None
+    entry = os.path.join(store, 'fake-realm') if store else None
+    if password is None and entry and os.path.isfile(entry):
+        with io.open(entry, encoding='utf-8') as fp_:
+            password = fp_.read().split('\n')[3]
+    expected = os.environ.get('XJOKER_FAKE_SVN_PASSWORD')
+    if password is None or (expected is not None and password != expected):
+        sys.stderr.write('svn: E170001: Authorization failed\n')
+        return False
+    _log('svn', 'auth')
+    if store:
+        if not os.path.isdir(store):
+            os.makedirs(store)
+        lines = ['K 8', 'password', 'V {0}'.format(len(password)), password,
+                 'K 8', 'username', 'V {0}'.format(len(username)), username, 'END', '']
+        with io.open(entry, 'w', encoding='utf-8') as fp_:
+            fp_.write(u'\n'.join(lines))
+    return True
+
+
+def _svn_changes():
+    path = os.environ.get('XJOKER_FAKE_SVN_CHANGES')
+    if not path:
+        return []
+    with io.open(path, encoding='utf-8') as fp_:
+        return json.load(fp_)
+
+
+def _svn_positional(args):
+    '''
+    Arguments that are not options or option values
+    '''
+    ret = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in ('-r', '--depth', '--username', '--password', '--config-dir', '--limit'):
+            skip = True
+        elif not arg.startswith('-'):
+            ret.append(arg)
+    return ret
+
+
+def _svn_wc_root(path):
+    while not os.path.isdir(os.path.join(path, '.svn')):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    return path
+
+
+def _svn_sparse_update(paths, revision):
+    '''
+    ``svn update --parents`` of files in a ``--depth empty`` checkout
+    '''
+    changes = dict((x['path'], x) for x in _svn_changes())
+    for path in paths:
+        if path.endswith('@'):
+            path = path[:-1]
+        root = _svn_wc_root(os.path.dirname(path))
+        rel = os.path.relpath(path, root).replace(os.sep, '/')
+        change = changes.get(rel)
+        if change is None or change.get('lost') or change['item'] == 'deleted':
+            continue
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with io.open(path, 'w', encoding='utf-8') as fp_:
+            fp_.write(u'{0}@{1}'.format(rel, revision))
+        _write('A    {0}\n'.format(path))
+    _write('Updated to revision {0}.\n'.format(revision))
+
+
+def svn(args):
+    _spawn('svn')
+    if not _svn_auth(args):
+        return 1
+    cmd = [x for x in args if not x.startswith('-')][:1]
+    xml = '--xml' in args
+    positional = _svn_positional(args)
+    if cmd == ['status']:
+        lines = _size('SVN_LINES', 100000)
+        if xml:
+            out = _svn_status_xml(lines)
+        else:
+            out = ('{0}       trunk\\src\\module{1}\\file{2}.cs\n'.format('MA?!'[idx % 4], idx // 100, idx)
+                   for idx in range(lines))
+        for chunk in out:
+            _write(chunk)
+    elif cmd == ['info']:
+        if xml:
+            _write(_SVN_INFO_XML)
+        else:
+            _write('Path: .\nURL: https://svn.example.com/repo/trunk\nRevision: 1234\n'
+                   'Node Kind: directory\nLast Changed Rev: 1230\n\n')
+    elif cmd == ['log']:
+        entries = _size('SVN_LINES', 100000) // 100
+        if '--limit' in args:
+            entries = min(entries, int(args[args.index('--limit') + 1]))
+        for chunk in _svn_log_xml(entries):
+            _write(chunk)
+    elif cmd == ['diff'] and '--summarize' in args:
+        url = positional[1].rsplit('@', 1)[0]
+        _write('<?xml version="1.0" encoding="UTF-8"?>\n<diff>\n<paths>\n')
+        for change in _svn_changes():
+            _write('<path item="{0}" props="none" kind="{1}">{2}/{3}</path>\n'.format(
+                change['item'], change['kind'], url, change['path']))
+        _write('</paths>\n</diff>\n')
+    elif cmd == ['checkout'] and _option(args, '--depth') == 'empty':
+        os.makedirs(os.path.join(positional[2], '.svn'))
+        _write('Checked out revision {0}.\n'.format(_option(args, '-r')))
+    elif cmd == ['update'] and '--parents' in args:
+        _svn_sparse_update(positional[1:], _option(args, '-r'))
+    elif cmd == ['update']:
+        for idx in range(_size('SVN_LINES', 100000) // 10):
+            _write('U    trunk\\src\\file{0}.cs\n'.format(idx))
+        _write('Updated to revision 1235.\n')
+    return 0
+
+
+def goodsync(args):
+    _spawn('goodsync')
+    if args[:1] == ['job-list']:
+        _write('\n'.join('job-{0}'.format(idx) for idx in range(_size('JOBS', 500))) + '\n')
+    elif args:
+        _write('{0}: done\n'.format(' '.join(args[:2])))
+    return 0
+
+
+def icacls(args):
+    _spawn('icacls')
+    _write('Successfully processed 1 files; Failed processing 0 files\n')
+    return 0
+
+
+_TOOLS = {
+    'powershell': powershell,
+    'appcmd': appcmd,
+    'netsh': netsh,
+    'svn': svn,
+    'goodsync': goodsync,
+    'icacls': icacls,
+}
+
+
+if __name__ == '__main__':
+    sys.exit(_TOOLS[sys.argv[1]](sys.argv[2:]))
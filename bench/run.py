@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Benchmarks of the xJoker modules against fake Windows tools
+
+Runs on Linux with salt installed, no Windows tool is needed: the modules
+are loaded with mocked ``__salt__``/``__opts__``/``__context__`` and the
+real ``xjoker_runner`` as ``__utils__``. ``powershell``, ``appcmd``,
+``netsh``, ``svn`` and ``GoodSync.exe`` are served by ``fake_tools.py``.
+
+Every operation reports its mean wall time, the processes started and
+persistent host requests per call (counted by the fakes), and the
+commands, output bytes and cache hits/misses seen by the
+``xjoker_runner`` instrumentation.
+
+.. code-block:: bash
+
+    python bench/run.py                          # every scenario
+    python bench/run.py iis svn --repeat 5
+    python bench/run.py --latency 0.3 --request-latency 0.01 --scale 0.1
+    python bench/run.py --json results.json
+
+The ``svnserve`` scenario runs the real ``svn`` against a local
+``svnserve`` repository instead, with and without the
+``xjoker_svn:auth_cache``. It is skipped when ``svn``, ``svnadmin`` or
+``svnserve`` is not installed.
+'''
+from __future__ import absolute_import, print_function
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_TOOLS = os.path.join(ROOT, 'bench', 'fake_tools.py')
+
+# Executable name -> fake_tools.py tool
+_SHIMS = {
+    'powershell': 'powershell',
+    'appcmd': 'appcmd',
+    'netsh': 'netsh',
+    'svn': 'svn',
+    'GoodSync.exe': 'goodsync',
+    'icacls': 'icacls',
+}
+
+SCENARIOS = collections.OrderedDict()
+
+
+def scenario(name, **sizes):
+    '''
+    Register a scenario. ``sizes`` become XJOKER_FAKE_* variables for the
+    fake tools, scaled by ``--scale``.
+    '''
+    def _register(func):
+        SCENARIOS[name] = (func, sizes)
+        return func
+    return _register
+
+
+def _load(name, path):
+    if sys.version_info[0] == 2:
+        import imp
+        return imp.load_source(name, path)
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class Skip(Exception):
+    '''
+    Raised by a scenario that cannot run here
+    '''
+
+
+def _which(name, path):
+    for directory in path.split(os.pathsep):
+        exe = os.path.join(directory, name)
+        if os.path.isfile(exe) and os.access(exe, os.X_OK):
+            return exe
+    return None
+
+
+def _windows_stubs():
+    '''
+    Linux stand-ins for the pywin32 and registry calls of xJoker_GoodSync
+    '''
+    if 'win32security' not in sys.modules:
+        win32security = types.ModuleType('win32security')
+        win32security.LookupAccountName = lambda system, name: (name, None, 1)
+        win32security.ConvertSidToStringSid = lambda sid: 'S-1-5-21-{0}'.format(sid)
+        sys.modules['win32security'] = win32security
+
+    import salt.modules
+    reg = types.ModuleType('reg')
+    reg.read_value = lambda *args: {'vdata': 'default.rfi'}
+    reg.set_value = lambda *args: True
+    salt.modules.reg = reg
+
+
+class Bench(object):
+    '''
+    Temporary minion with fake tools on the PATH
+    '''
+
+    def __init__(self, args, sizes):
+        self.args = args
+        self.tmp = tempfile.mkdtemp(prefix='xjoker-bench-')
+        self.bindir = os.path.join(self.tmp, 'bin')
+        self.log = os.path.join(self.tmp, 'calls.log')
+        self.config = {}
+        self.cleanup = []
+        self.opts = {
+            'cachedir': os.path.join(self.tmp, 'cache'),
+            'xjoker_runner': {'instrument': True},
+        }
+        os.makedirs(self.bindir)
+        for exe, tool in _SHIMS.items():
+            path = os.path.join(self.bindir, exe)
+            with open(path, 'w') as fp_:
+                fp_.write('#!/bin/sh\nexec "{0}" "{1}" {2} "$@"\n'.format(sys.executable, FAKE_TOOLS, tool))
+            os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+        # _srvmgr only runs appcmd when %WINDIR%\system32\inetsrv\appcmd.exe exists
+        windir = os.path.join(self.tmp, 'windows')
+        open(windir + '\\system32\\inetsrv\\appcmd.exe', 'w').close()
+
+        self.env = {
+            'PATH': self.bindir + os.pathsep + os.environ.get('PATH', ''),
+            'WINDIR': windir,
+            'XJOKER_FAKE_LOG': self.log,
+            'XJOKER_FAKE_FIREWALL': os.path.join(self.tmp, 'firewall.json'),
+            'XJOKER_FAKE_LATENCY': str(args.latency),
+            'XJOKER_FAKE_REQUEST_LATENCY': str(args.request_latency),
+        }
+        for key, value in sizes.items():
+            self.env['XJOKER_FAKE_' + key.upper()] = str(max(1, int(value * args.scale)))
+        self._saved_env = dict((key, os.environ.get(key)) for key in self.env)
+        os.environ.update(self.env)
+
+        self.runner = _load('xjoker_runner', os.path.join(ROOT, 'Common', 'xJoker_runner.py'))
+        self.runner.__opts__ = self.opts
+        self.utils = dict(('xjoker_runner.' + key, getattr(self.runner, key))
+                          for key in dir(self.runner)
+                          if not key.startswith('_') and callable(getattr(self.runner, key)))
+
+    def size(self, key):
+        return int(self.env['XJOKER_FAKE_' + key.upper()])
+
+    def load(self, path, virtualname, **config):
+        '''
+        Load an execution module the way the minion would, with mocked
+        dunders
+        '''
+        module = _load(virtualname, os.path.join(ROOT, path))
+        self.config.update(config)
+        module.__opts__ = self.opts
+        module.__context__ = {}
+        module.__utils__ = self.utils
+        module.__salt__ = {
+            'config.get': lambda key, default=None: self.config.get(key, default),
+        }
+        self.runner.instrument(vars(module), virtualname)
+        return module
+
+    def _calls(self):
+        counts = collections.Counter()
+        if os.path.isfile(self.log):
+            with open(self.log) as fp_:
+                for line in fp_:
+                    counts[line.split()[1]] += 1
+            os.remove(self.log)
+        return counts
+
+    def measure(self, function, call):
+        '''
+        Run ``call`` ``--repeat`` times and average the numbers. Anything
+        after a space in ``function`` just tells apart rows of the same
+        function.
+        '''
+        function = function.split()[0]
+        repeat = self.args.repeat
+        totals = collections.Counter()
+        wall = 0.0
+        self._calls()
+        self.runner.report(reset=True)
+        for _ in range(repeat):
+            start = time.time()
+            call()
+            wall += time.time() - start
+        for key, value in self._calls().items():
+            totals[key] += value
+        stats = self.runner.report(function=function, reset=True).get(function, {})
+        return collections.OrderedDict([
+            ('seconds', round(wall / repeat, 4)),
+            ('spawns', round(float(totals['spawn']) / repeat, 2)),
+            ('host_requests', round(float(totals['request']) / repeat, 2)),
+            ('commands', round(float(stats.get('commands', 0)) / repeat, 2)),
+            ('bytes', int(stats.get('bytes', 0) / repeat)),
+            ('cache_hits', round(float(stats.get('cache_hits', 0)) / repeat, 2)),
+            ('cache_misses', round(float(stats.get('cache_misses', 0)) / repeat, 2)),
+        ])
+
+    def close(self):
+        for func in self.cleanup:
+            func()
+        for pool in self.runner._PSHOST_POOLS.values():
+            pool.stop()
+        for key, value in self._saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+@scenario('iis', sites=1000)
+def _iis(bench):
+    iis = bench.load('IIS/xJoker_win_iis.py', 'xjoker_win_iis')
+    return [
+        ('xjoker_win_iis.inventory', lambda: iis.inventory(refresh=True)),
+        ('xjoker_win_iis.list_sites_status', iis.list_sites_status),
+        ('xjoker_win_iis.start_sites', lambda: iis.start_sites('site-*')),
+        ('xjoker_win_iis.batch', lambda: iis.batch(
+            [{'op': 'restart_apppool', 'name': 'site-{0}'.format(idx)} for idx in range(1, 101)])),
+    ]
+
+
+@scenario('firewall', rules=5000)
+def _firewall(bench):
+    firewall = bench.load('xJoker_win_firewall.py', 'xjoker_firewall')
+    return [
+        ('xjoker_firewall.get_rule', lambda: firewall.get_rule('all')),
+        ('xjoker_firewall.list_rules', lambda: firewall.list_rules(refresh=True)),
+        ('xjoker_firewall.is_port_open', lambda: [firewall.is_port_open(port)
+                                                  for port in range(10000, 10100)]),
+        ('xjoker_firewall.get_config', firewall.get_config),
+        ('xjoker_firewall.add_rule', lambda: firewall.add_rule('bench', '8080')),
+        ('xjoker_firewall.add_rule x300', lambda: [firewall.add_rule('bench-{0}'.format(idx), str(20000 + idx))
+                                                  for idx in range(300)]),
+        ('xjoker_firewall.apply_ruleset', lambda: firewall.apply_ruleset(
+            [{'name': 'set-{0}'.format(idx), 'localport': str(30000 + idx)} for idx in range(300)],
+            prune='set-*')),
+    ]
+
+
+@scenario('svn', svn_lines=100000)
+def _svn(bench):
+    svn = bench.load('xJoker_svn.py', 'xjoker_svn')
+    return [
+        ('xjoker_svn.status', lambda: svn.status(bench.tmp)),
+        ('xjoker_svn.status fmt=records', lambda: svn.status(bench.tmp, fmt='records')),
+        ('xjoker_svn.update', lambda: svn.update(bench.tmp)),
+        ('xjoker_svn.update_many', lambda: svn.update_many(
+            [os.path.join(bench.tmp, 'wc-{0}'.format(idx)) for idx in range(30)], concurrency=8)),
+        ('xjoker_svn.info', lambda: svn.info(bench.tmp, fmt='dict')),
+        ('xjoker_svn.log', lambda: svn.log(bench.tmp, verbose=True)),
+    ]
+
+
+@scenario('svnserve', files=50)
+def _svnserve(bench):
+    path = bench._saved_env['PATH'] or ''
+    tools = dict((name, _which(name, path)) for name in ('svn', 'svnadmin', 'svnserve'))
+    missing = [name for name, exe in tools.items() if exe is None]
+    if missing:
+        raise Skip('{0} not installed'.format(', '.join(sorted(missing))))
+    # The real svn instead of the fake one
+    os.remove(os.path.join(bench.bindir, 'svn'))
+
+    repo = os.path.join(bench.tmp, 'repo')
+    subprocess.check_call([tools['svnadmin'], 'create', repo])
+    with open(os.path.join(repo, 'conf', 'svnserve.conf'), 'w') as fp_:
+        fp_.write('[general]\nanon-access = none\nauth-access = write\n'
+                  'password-db = passwd\nrealm = xjoker-bench\n')
+    with open(os.path.join(repo, 'conf', 'passwd'), 'w') as fp_:
+        fp_.write('[users]\nbench = secret\n')
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    server = subprocess.Popen([tools['svnserve'], '-d', '--foreground', '--listen-host',
+                               '127.0.0.1', '--listen-port', str(port), '-r', repo])
+    bench.cleanup.append(server.kill)
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            break
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+    url = 'svn://127.0.0.1:{0}/trunk'.format(port)
+    tree = os.path.join(bench.tmp, 'tree')
+    os.makedirs(tree)
+    for idx in range(bench.size('files')):
+        with open(os.path.join(tree, 'file{0}.txt'.format(idx)), 'w') as fp_:
+            fp_.write('{0}\n'.format(idx))
+    subprocess.check_call([tools['svn'], 'import', '--non-interactive', '--no-auth-cache',
+                           '--username', 'bench', '--password', 'secret', '-m', 'bench',
+                           tree, url], stdout=subprocess.PIPE)
+
+    svn = bench.load('xJoker_svn.py', 'xjoker_svn')
+    wc = os.path.join(bench.tmp, 'wc')
+    svn.checkout(wc, url, paths=['.'], username='bench', password='secret')
+
+    def _call(auth_cache, func):
+        def _run():
+            bench.config['xjoker_svn:auth_cache'] = auth_cache
+            return func()
+        return _run
+
+    info = lambda: svn.info(url, username='bench', password='secret', fmt='dict')
+    update = lambda: svn.update(wc, username='bench', password='secret', fmt='summary')
+    return [
+        ('xjoker_svn.info password', _call(False, info)),
+        ('xjoker_svn.info auth_cache', _call(True, info)),
+        ('xjoker_svn.update password', _call(False, update)),
+        ('xjoker_svn.update auth_cache', _call(True, update)),
+    ]
+
+
+@scenario('goodsync', jobs=500)
+def _goodsync(bench):
+    _windows_stubs()
+    goodsync = bench.load('GoodSync/xJoker_GoodSync.py', 'xjoker_goodsync')
+    goodsync._Gsync_path = os.path.join(bench.bindir, 'GoodSync.exe')
+    jobs = ['job-{0}'.format(idx) for idx in range(bench.size('jobs'))]
+
+    def _sync_each():
+        for job in jobs:
+            goodsync.jobsync('bench', job)
+
+    return [
+        ('xjoker_goodsync.joblist', lambda: goodsync.joblist('bench')),
+        ('xjoker_goodsync.jobsyncall', lambda: goodsync.jobsyncall('bench')),
+        ('xjoker_goodsync.jobsync', _sync_each),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('scenarios', nargs='*',
+                        help='scenarios to run, default all: {0}'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--repeat', type=int, default=3, help='runs per operation')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds every fake process start takes')
+    parser.add_argument('--request-latency', type=float, default=0.002,
+                        help='seconds every persistent powershell request takes')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the scenario sizes, e.g. 0.1 for a quick run')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenario: {0}'.format(', '.join(sorted(unknown))))
+
+    results = collections.OrderedDict()
+    columns = ('seconds', 'spawns', 'host_requests', 'commands', 'bytes',
+               'cache_hits', 'cache_misses')
+    print('{0:<36}'.format('operation') + ''.join('{0:>14}'.format(x) for x in columns))
+    for name in args.scenarios or SCENARIOS:
+        func, sizes = SCENARIOS[name]
+        bench = Bench(args, sizes)
+        try:
+            try:
+                calls = func(bench)
+            except Skip as exc:
+                print('{0:<36}skipped, {1}'.format(name, exc))
+                continue
+            for function, call in calls:
+                row = bench.measure(function, call)
+                results['{0}:{1}'.format(name, function)] = row
+                print('{0:<36}'.format(function) + ''.join('{0:>14}'.format(row[x]) for x in columns))
+        finally:
+            bench.close()
+
+    if args.json:
+        with open(args.json, 'w') as fp_:
+            json.dump(results, fp_, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+'''
+Fixtures of the unit tests
+
+The modules are loaded the way ``bench/run.py`` loads them, with mocked
+loader dunders and the fake Windows tools of ``bench/fake_tools.py`` on
+the PATH, so the tests run on Linux. They need salt to be importable.
+'''
+from __future__ import absolute_import
+
+import argparse
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+
+@pytest.fixture
+def make_bench():
+    '''
+    Factory of temporary minions, ``make_bench(sites=10)`` sets the size
+    of the fake tool output
+    '''
+    import run
+    benches = []
+
+    def _make(**sizes):
+        args = argparse.Namespace(latency=0, request_latency=0, scale=1, repeat=1)
+        bench = run.Bench(args, sizes)
+        benches.append(bench)
+        return bench
+
+    yield _make
+    for bench in benches:
+        bench.close()
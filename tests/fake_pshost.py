@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Stand-in for the persistent powershell host of xjoker_runner, speaking
+its framing. A request script is one of:
+
+echo TEXT
+    Reply TEXT with status 0
+fail TEXT
+    Reply TEXT with status 1
+noise TEXT
+    Print lines that are not frames, then reply TEXT
+pid
+    Reply the process id
+sleep SECONDS
+    Reply after SECONDS
+die
+    Exit without replying
+'''
+from __future__ import absolute_import
+
+import base64
+import os
+import sys
+import time
+
+
+def _reply(status, text):
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    out.write(b'XJOKER-FRAME ' + str(status).encode('ascii') + b' ' +
+              base64.b64encode(text.encode('utf-8')) + b'\n')
+    out.flush()
+
+
+def main():
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    for line in iter(stdin.readline, b''):
+        line = line.strip()
+        if line == b'XJOKER-QUIT':
+            break
+        script = base64.b64decode(line).decode('utf-8')
+        cmd, _, arg = script.partition(' ')
+        if cmd == 'echo':
+            _reply(0, arg)
+        elif cmd == 'fail':
+            _reply(1, arg)
+        elif cmd == 'noise':
+            sys.stdout.write('WARNING: not a frame\nXJOKER-FRAMEX 0 bm9wZQ==\n')
+            sys.stdout.flush()
+            _reply(0, arg)
+        elif cmd == 'pid':
+            _reply(0, str(os.getpid()))
+        elif cmd == 'sleep':
+            time.sleep(float(arg))
+            _reply(0, 'slept')
+        elif cmd == 'die':
+            return 3
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
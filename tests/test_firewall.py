@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+'''
+Rule inventory of xjoker_firewall against the fake netsh and COM dump
+'''
+from __future__ import absolute_import
+
+import pytest
+
+pytest.importorskip('salt')
+
+
+@pytest.fixture
+def bench(make_bench):
+    return make_bench(rules=100)
+
+
+@pytest.fixture
+def firewall(bench):
+    module = bench.load('xJoker_win_firewall.py', 'xjoker_firewall')
+    module.list_rules()
+    bench._calls()
+    return module
+
+
+def test_rule_index(firewall):
+    rules = firewall.list_rules()
+    assert len(rules) == 100
+    assert rules[3] == {
+        'name': 'rule-3', 'direction': 'out', 'protocol': 'tcp', 'localport': '10003',
+        'remoteport': 'any', 'localip': 'any', 'remoteip': 'any', 'action': 'allow',
+        'enabled': True, 'profiles': ['domain', 'private', 'public'], 'group': None,
+        'program': None, 'service': None, 'edge': False,
+    }
+    assert [x['name'] for x in firewall.list_rules(name='RULE-4')] == ['rule-4']
+    assert [x['name'] for x in firewall.list_rules(port=10004)] == ['rule-4']
+    assert firewall.list_rules(port=10004, direction='out') == []
+    assert firewall.list_rules(port=10004, protocol='udp') == []
+
+
+def test_port_ranges_and_block_rules(bench, firewall):
+    assert firewall.is_port_open(10002) is True
+    assert firewall.is_port_open(10003) is False
+    assert firewall.is_port_open(10003, direction='out') is True
+    assert firewall.is_port_open(20005) is False
+
+    firewall.add_rule('range', '20000-20010')
+    firewall.add_rule('blocker', '10002', action='block')
+    for refresh in (False, True):
+        assert firewall.is_port_open(20005, refresh=refresh) is True
+        assert firewall.is_port_open(20011) is False
+        assert firewall.is_port_open(10002) is False
+        assert [x['name'] for x in firewall.list_rules(port=20000)] == ['range']
+
+
+def test_add_rule_is_idempotent(bench, firewall):
+    assert firewall.add_rule('web', '8080', remoteip='10.0.0.1') is True
+    assert bench._calls() == {'spawn': 1}
+    # From the rule indexed after the add, then from the COM dump, which
+    # gives the address with its mask
+    assert firewall.add_rule('web', '8080', remoteip='10.0.0.1') is True
+    firewall.list_rules(refresh=True)
+    assert firewall.list_rules(name='web')[0]['remoteip'] == '10.0.0.1/255.255.255.255'
+    bench._calls()
+    assert firewall.add_rule('web', '8080', remoteip='10.0.0.1') is True
+    assert firewall.add_rule('web', ' 8080', remoteip='10.0.0.1/32') is True
+    assert bench._calls() == {}
+
+    # Another setting is another rule
+    assert firewall.add_rule('web', '8081', remoteip='10.0.0.1') is True
+    assert bench._calls() == {'spawn': 1}
+    assert len(firewall.list_rules(name='web', refresh=True)) == 2
+
+
+def test_delete_rule_drops_the_cache(bench, firewall):
+    firewall.add_rule('web', '8080')
+    assert firewall.delete_rule('web', '8080') is True
+    assert firewall._INVENTORY_KEY not in firewall.__context__
+    assert firewall.list_rules(name='web') == []
+
+
+def test_apply_ruleset(bench, firewall):
+    rules = [{'name': 'set-web', 'localport': '80,443'},
+             {'name': 'set-rdp', 'localport': 3389, 'remoteip': '10.0.0.0/8'},
+             {'name': 'set-dns', 'localport': 53, 'protocol': 'udp', 'direction': 'out'}]
+    firewall.add_rule('set-old', '9999')
+    firewall.add_rule('set-rdp', '3389')
+    bench._calls()
+
+    ret = firewall.apply_ruleset(rules, prune='set-*', test=True)
+    assert ret['result'] is None
+    assert bench._calls() == {'request': 1}
+
+    ret = firewall.apply_ruleset(rules, prune='set-*')
+    assert ret['result'] is True
+    assert ret['removed'] == ['set-rdp', 'set-old']
+    assert sorted(ret['added']) == ['set-dns', 'set-rdp', 'set-web']
+    # One netsh -f script and the two inventory reads
+    assert bench._calls() == {'spawn': 1, 'request': 2}
+    assert firewall.list_rules(name='set-old') == []
+
+    ret = firewall.apply_ruleset(rules, prune='set-*')
+    assert ret['result'] is True
+    assert ret['unchanged'] == ['set-dns', 'set-rdp', 'set-web']
+    assert ret['removed'] == ret['added'] == []
+    assert bench._calls() == {'request': 1}
+
+
+def test_apply_ruleset_refuses_quotes(firewall):
+    from salt.exceptions import SaltInvocationError
+    with pytest.raises(SaltInvocationError):
+        firewall.apply_ruleset([{'name': 'say "hi"', 'localport': 80}])
+    with pytest.raises(SaltInvocationError):
+        firewall.apply_ruleset([{'localport': 80}])
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+'''
+Directory ACL jobs of xjoker_win_iis, run with the fake icacls
+'''
+from __future__ import absolute_import
+
+import time
+
+import pytest
+
+pytest.importorskip('salt')
+
+
+@pytest.fixture
+def bench(make_bench):
+    return make_bench(sites=3)
+
+
+@pytest.fixture
+def iis(bench):
+    return bench.load('IIS/xJoker_win_iis.py', 'xjoker_win_iis')
+
+
+def test_job_reported_once(bench, iis):
+    from salt.exceptions import SaltInvocationError
+    job = iis.set_acl(bench.tmp, r'IIS AppPool\site-1')
+    assert job['status'] in ('running', 'done')
+    assert iis.acl_status(job['job'], wait=True, timeout=10)['status'] == 'done'
+    with pytest.raises(SaltInvocationError):
+        iis.acl_status(job['job'])
+    assert iis.acl_status() == {}
+
+
+def test_waited_job_dropped(bench, iis):
+    first = iis.set_acl(bench.tmp, r'IIS AppPool\site-1', wait=True, timeout=10)
+    second = iis.set_acl(bench.tmp, r'IIS AppPool\site-2')
+    assert first['status'] == 'done'
+    assert first['job'] != second['job']
+    assert list(iis.acl_status()) == [second['job']]
+
+
+def test_unreported_job_dropped_after_ttl(bench, iis):
+    bench.config['xjoker_win_iis:acl_job_ttl'] = 0
+    job = iis.set_acl(bench.tmp, r'IIS AppPool\site-1')
+    iis._ACL_JOBS[job['job']].wait(10)
+    time.sleep(0.01)
+    iis.set_acl(bench.tmp, r'IIS AppPool\site-2')
+    assert job['job'] not in iis._ACL_JOBS
+
+
+def test_create_site_returns_a_bool(monkeypatch, bench, iis):
+    assert iis.create_site('shop', bench.tmp + '/shop') is True
+    assert iis.inventory()['sites']['shop']['apppool'] == 'shop'
+    assert iis.create_site('site-1', bench.tmp + '/site-1') is True
+
+    # The ACL job outlives acl_timeout
+    monkeypatch.setenv('XJOKER_FAKE_LATENCY_ICACLS', '1')
+    bench.config['xjoker_win_iis:acl_timeout'] = 0.05
+    assert iis.create_site('blog', bench.tmp + '/blog') is False
+    assert [x['status'] for x in iis.acl_status().values()] == ['running']
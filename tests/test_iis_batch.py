@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+'''
+xjoker_win_iis batch scripts, the bulk lifecycle functions and the
+cached inventory they keep up to date
+'''
+from __future__ import absolute_import
+
+import pytest
+
+pytest.importorskip('salt')
+
+
+@pytest.fixture
+def bench(make_bench):
+    return make_bench(sites=50)
+
+
+@pytest.fixture
+def iis(bench):
+    # The fake host reads XJOKER_FAKE_* when it starts, at the first call
+    return bench.load('IIS/xJoker_win_iis.py', 'xjoker_win_iis')
+
+
+def test_lifecycle_in_one_round_trip(bench, iis):
+    iis.inventory()
+    bench._calls()
+    ret = iis.stop_sites('site-*')
+    assert ret['result'] is True
+    assert len(ret['items']) == 50
+    assert ret['items']['site-7'] == {'result': True, 'duration': 0.001, 'comment': ''}
+    assert bench._calls() == {'request': 1}
+    # The cache was updated, not read again
+    assert iis.list_sites_status()['site-7']['state'] == 'Stopped'
+    assert bench._calls() == {}
+
+    iis.recycle_apppools(['site-1', 'site-2'])
+    iis.start_apppools('site-1,site-2')
+    assert bench._calls() == {'request': 2}
+
+
+def test_lifecycle_fail_fast(monkeypatch, iis):
+    monkeypatch.setenv('XJOKER_FAKE_BATCH_FAIL', 'site-2')
+    ret = iis.stop_sites(['site-1', 'site-2', 'site-3', 'nope'], fail_fast=True)
+    assert ret['result'] is False
+    assert dict((key, value['result']) for key, value in ret['items'].items()) == {
+        'site-1': True, 'site-2': False, 'site-3': None, 'nope': False}
+    assert ret['items']['site-3']['comment'] == 'Skipped after an earlier failure'
+    assert ret['items']['nope']['comment'] == 'Not found'
+
+
+def test_lifecycle_without_fail_fast(monkeypatch, iis):
+    monkeypatch.setenv('XJOKER_FAKE_BATCH_FAIL', 'site-2')
+    ret = iis.start_sites('site-1,site-2,site-3')
+    assert [ret['items'][x]['result'] for x in ('site-1', 'site-2', 'site-3')] == [True, False, True]
+
+
+def test_lifecycle_short_results(monkeypatch, iis):
+    monkeypatch.setenv('XJOKER_FAKE_BATCH_LIMIT', '2')
+    ret = iis.restart_sites('site-1,site-2,site-3')
+    assert ret['result'] is False
+    assert ret['items']['site-3'] == {'result': False, 'duration': 0.0,
+                                      'comment': 'No result, the batch script did not finish'}
+
+
+def test_inventory_cached_for_the_ttl(bench, iis):
+    first = iis.inventory()
+    assert iis.inventory() is first
+    assert iis.inventory(refresh=True) is not first
+
+    bench.config['xjoker_win_iis:inventory_ttl'] = 0
+    second = iis.inventory()
+    assert iis.inventory() is not second
+
+
+def test_batch_updates_the_cache(bench, iis):
+    inventory = iis.inventory()
+    bench._calls()
+    results = iis.batch([
+        {'op': 'create_binding', 'site': 'site-1', 'hostheader': 'www', 'port': 443,
+         'protocol': 'https'},
+        {'op': 'remove_binding', 'site': 'site-2', 'hostheader': 'site-2.example.com'},
+        {'op': 'remove_site', 'name': 'site-3'},
+        {'op': 'stop_apppool', 'name': 'site-4'},
+        {'op': 'set_apppool', 'name': 'site-5', 'settings': {'runtime_version': 'v2.0'}},
+        {'op': 'create_apppool', 'name': 'new'},
+    ])
+    assert [x['result'] for x in results] == [True] * 6
+    assert bench._calls() == {'request': 1}
+    assert iis.inventory() is inventory
+    assert inventory['bindings']['https/*:443:www'] == 'site-1'
+    assert 'http/*:80:site-2.example.com' not in inventory['bindings']
+    assert inventory['sites']['site-2']['bindings'] == []
+    assert 'site-3' not in inventory['sites']
+    assert 3 not in inventory['site_ids']
+    assert inventory['apppool_sites']['site-3'] == []
+    assert inventory['apppools']['site-4']['state'] == 'Stopped'
+    assert inventory['apppools']['site-5']['runtime_version'] == 'v2.0'
+    assert inventory['apppools']['new']['runtime_version'] == 'v4.0'
+
+
+def test_create_site_indexed_in_place(bench, iis):
+    inventory = iis.inventory()
+    ret = iis.batch([{'op': 'create_site', 'name': 'shop', 'sourcepath': r'd:\web\shop',
+                      'hostheader': 'shop', 'site_id': 77}])[0]
+    assert ret['index'] == {'site_id': 77, 'apppool': 'shop', 'state': 'Started'}
+    assert iis.inventory() is inventory
+    assert inventory['sites']['shop']['id'] == 77
+    assert inventory['site_ids'][77] == 'shop'
+    assert inventory['max_site_id'] == 77
+    assert inventory['bindings']['http/*:80:shop'] == 'shop'
+    assert inventory['apppools']['shop']['state'] == 'Started'
+    assert inventory['apppool_sites']['shop'] == ['shop']
+
+
+def test_failed_step_drops_the_cache(monkeypatch, iis):
+    monkeypatch.setenv('XJOKER_FAKE_BATCH_FAIL', 'site-2')
+    inventory = iis.inventory()
+    results = iis.batch([{'op': 'stop_site', 'name': 'site-1'},
+                         {'op': 'stop_site', 'name': 'site-2'}])
+    assert [x['result'] for x in results] == [True, False]
+    assert iis._INVENTORY_KEY not in iis.__context__
+    assert iis.inventory() is not inventory
+
+
+def test_single_call_output_drops_the_cache(bench, iis):
+    inventory = iis.inventory()
+    assert iis.stop_site('site-1') == ''
+    assert iis.inventory()['sites']['site-1']['state'] == 'Stopped'
+    assert iis.inventory() is inventory
+
+    srvmgr = iis._srvmgr
+    iis._srvmgr = lambda func, xml=False: 'WARNING: something' if 'Start-' in func else srvmgr(func, xml)
+    iis.start_site('site-1')
+    assert iis._INVENTORY_KEY not in iis.__context__
+
+
+def test_site_ids_from_the_inventory_and_the_lock_file(iis):
+    assert iis._allocate_site_id() == 51
+    assert iis._allocate_site_id() == 52
+    iis.batch([{'op': 'create_site', 'name': 'shop', 'sourcepath': r'd:\web\shop',
+                'site_id': 90}])
+    assert iis._allocate_site_id() == 91
+
+
+def test_invalid_op(iis):
+    from salt.exceptions import SaltInvocationError
+    with pytest.raises(SaltInvocationError):
+        iis.batch([{'op': 'format_disk', 'name': 'c'}])
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+'''
+applicationHost.config backend of xjoker_win_iis, against the sample in
+files/ and generated configs with thousands of sites
+'''
+from __future__ import absolute_import
+
+import io
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip('salt')
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files',
+                      'applicationHost.config')
+
+
+def _generate(path, sites, pools=50):
+    '''
+    Write an applicationHost.config with ``sites`` sites spread over
+    ``pools`` apppools; every tenth site uses the default apppool
+    '''
+    with io.open(path, 'w', encoding='utf-8') as fp_:
+        fp_.write(u'<?xml version="1.0" encoding="UTF-8"?>\n<configuration>\n'
+                  u'<system.applicationHost>\n<applicationPools>\n')
+        for idx in range(pools):
+            fp_.write(u'<add name="pool-{0}" managedRuntimeVersion="v{1}.0" />\n'
+                      .format(idx, 2 + idx % 3))
+        fp_.write(u'<applicationPoolDefaults managedPipelineMode="Classic" />\n'
+                  u'</applicationPools>\n<sites>\n')
+        for idx in range(1, sites + 1):
+            pool = u'' if idx % 10 == 0 else u' applicationPool="pool-{0}"'.format(idx % pools)
+            fp_.write(u'<site name="site-{0}" id="{0}">\n'
+                      u'<application path="/"{1}>\n'
+                      u'<virtualDirectory path="/" physicalPath="D:\\web\\site-{0}" />\n'
+                      u'</application>\n<bindings>\n'
+                      u'<binding protocol="http" bindingInformation="*:80:site-{0}.example.com" />\n'
+                      u'<binding protocol="https" bindingInformation="*:443:site-{0}.example.com" />\n'
+                      u'</bindings>\n</site>\n'.format(idx, pool))
+        fp_.write(u'<applicationDefaults applicationPool="pool-0" />\n'
+                  u'</sites>\n</system.applicationHost>\n</configuration>\n')
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = str(tmp_path / 'applicationHost.config')
+    shutil.copy(SAMPLE, path)
+    return path
+
+
+@pytest.fixture
+def iis(make_bench, config):
+    bench = make_bench()
+    return bench.load('IIS/xJoker_win_iis.py', 'xjoker_win_iis',
+                      **{'xjoker_win_iis:backend': 'config',
+                         'xjoker_win_iis:config_path': config})
+
+
+def test_sites_and_defaults(iis, config):
+    inventory = iis._read_config_inventory(config)
+    sites = inventory['sites']
+    assert sorted(sites) == ['Default Web Site', 'blog', 'shop']
+
+    # No pool on the site: <sites><applicationDefaults>, which follows
+    # the sites in the file
+    assert sites['Default Web Site']['apppool'] == 'Classic .NET AppPool'
+    # The site's own applicationDefaults
+    assert sites['blog']['apppool'] == 'legacy32'
+    # The root application; /api and its virtual directory do not count
+    assert sites['shop']['apppool'] == 'shop'
+    assert sites['shop']['physical_path'] == r'D:\web\shop'
+    assert sites['shop']['auto_start'] is False
+    assert sites['shop']['state'] is None
+    assert sites['shop']['bindings'] == [
+        {'protocol': 'http', 'binding_information': '*:80:shop.example.com'},
+        {'protocol': 'https', 'binding_information': '*:443:shop.example.com'},
+    ]
+    assert inventory['bindings']['https/*:443:shop.example.com'] == 'shop'
+    assert inventory['site_ids'] == {1: 'Default Web Site', 7: 'shop', 3: 'blog'}
+    assert inventory['max_site_id'] == 7
+    assert inventory['apppool_sites'] == {'Classic .NET AppPool': ['Default Web Site'],
+                                          'shop': ['shop'], 'legacy32': ['blog']}
+
+
+def test_apppool_defaults(iis, config):
+    pools = iis._read_config_inventory(config)['apppools']
+    # applicationPoolDefaults, then the IIS schema defaults
+    assert pools['DefaultAppPool'] == {
+        'name': 'DefaultAppPool', 'state': None, 'auto_start': 'true',
+        'runtime_version': 'v4.0', 'pipeline_mode': 'Integrated',
+        'enable_32bit': 'false', 'identity_type': 'ApplicationPoolIdentity',
+    }
+    assert pools['Classic .NET AppPool']['pipeline_mode'] == 'Classic'
+    assert pools['shop']['runtime_version'] == 'v2.0'
+    assert pools['shop']['auto_start'] == 'false'
+    assert pools['shop']['identity_type'] == 'NetworkService'
+    assert pools['legacy32']['enable_32bit'] == 'true'
+
+
+def test_thousands_of_sites(iis, config):
+    _generate(config, 5000)
+    inventory = iis._inventory(refresh=True)
+    assert len(inventory['sites']) == 5000
+    assert len(inventory['bindings']) == 10000
+    assert inventory['max_site_id'] == 5000
+    assert inventory['sites']['site-10']['apppool'] == 'pool-0'
+    assert inventory['sites']['site-11']['apppool'] == 'pool-11'
+    assert inventory['sites']['site-4999']['physical_path'] == r'D:\web\site-4999'
+    assert inventory['apppools']['pool-1']['runtime_version'] == 'v3.0'
+    assert inventory['apppools']['pool-1']['pipeline_mode'] == 'Classic'
+    # Ids divisible by 50 are also divisible by 10, so pool-0 only holds
+    # the sites left on the default apppool
+    assert len(inventory['apppool_sites']['pool-0']) == 500
+    assert iis.list_sites()[:3] == ['site-1', 'site-2', 'site-3']
+
+
+def test_cache_refreshed_when_the_file_changes(iis, config):
+    first = iis._inventory()
+    assert iis._inventory() is first
+
+    _generate(config, 20)
+    stat = os.stat(config)
+    os.utime(config, (stat.st_atime, stat.st_mtime + 10))
+    second = iis._inventory()
+    assert second is not first
+    assert len(second['sites']) == 20
+    assert iis._inventory() is second
+
+
+def test_cache_kept_within_ttl_without_changes(iis, config):
+    first = iis._inventory()
+    stat = os.stat(config)
+    with io.open(config, 'r+', encoding='utf-8') as fp_:
+        content = fp_.read()
+        fp_.seek(0)
+        fp_.write(content.replace('id="7"', 'id="8"'))
+    os.utime(config, (stat.st_atime, stat.st_mtime))
+    assert iis._inventory() is first
+    assert iis._inventory(refresh=True)['max_site_id'] == 8
+
+
+def test_write_config_backup_and_swap(iis, config):
+    with io.open(config, 'rb') as fp_:
+        original = fp_.read()
+    iis._inventory()
+    # A reader holding the file open keeps seeing the complete old file
+    reader = io.open(config, 'rb')
+    try:
+        assert iis.site_log_path('blog', r'E:\logs\blog') is True
+        assert reader.read() == original
+    finally:
+        reader.close()
+
+    with io.open(config + '.xjoker.bak', 'rb') as fp_:
+        assert fp_.read() == original
+    with io.open(config, 'rb') as fp_:
+        written = fp_.read()
+    assert b'E:\\logs\\blog' in written
+    assert written.count(b'<site ') == 3
+
+    from xml.etree import ElementTree
+    root = ElementTree.parse(config).getroot()
+    blog = [x for x in root.iter('site') if x.get('name') == 'blog'][0]
+    assert blog.find('logFile').get('directory') == r'E:\logs\blog'
+    # The change dropped the cached inventory
+    assert iis._INVENTORY_KEY not in iis.__context__
+
+
+def test_write_config_without_change(iis, config):
+    with io.open(config, 'rb') as fp_:
+        original = fp_.read()
+    assert iis.site_log_path('missing', r'E:\logs') is False
+    assert not os.path.exists(config + '.xjoker.bak')
+    with io.open(config, 'rb') as fp_:
+        assert fp_.read() == original
+
+
+def test_site_log_path_on_both_backends(make_bench, config):
+    _generate(config, 5)
+    config_iis = make_bench().load('IIS/xJoker_win_iis.py', 'xjoker_win_iis',
+                                   **{'xjoker_win_iis:backend': 'config',
+                                      'xjoker_win_iis:config_path': config})
+    appcmd_iis = make_bench(sites=5).load('IIS/xJoker_win_iis.py', 'xjoker_win_iis')
+    scripts = []
+    srvmgr = appcmd_iis._srvmgr
+
+    def _srvmgr(func, xml=False):
+        scripts.append(func)
+        return srvmgr(func, xml)
+    appcmd_iis._srvmgr = _srvmgr
+
+    for iis in (config_iis, appcmd_iis):
+        assert iis.site_log_path('site-2', r'E:\logs\site-2') is True
+        assert iis.site_log_path('missing', r'E:\logs') is False
+
+    from xml.etree import ElementTree
+    root = ElementTree.parse(config).getroot()
+    site = [x for x in root.iter('site') if x.get('name') == 'site-2'][0]
+    assert site.find('logFile').get('directory') == r'E:\logs\site-2'
+    assert scripts[-1] == ("Set-ItemProperty -Path 'IIS:\\Sites\\site-2' -Name logFile.directory"
+                           " -Value 'E:\\logs\\site-2';")
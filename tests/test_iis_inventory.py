@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+'''
+IIS inventory of xjoker_win_iis read from the fake appcmd
+'''
+from __future__ import absolute_import
+
+import json
+
+import pytest
+
+pytest.importorskip('salt')
+
+
+@pytest.fixture
+def iis(make_bench):
+    bench = make_bench(sites=20)
+    return bench.load('IIS/xJoker_win_iis.py', 'xjoker_win_iis')
+
+
+def test_inventory_index(iis):
+    inventory = iis.inventory()
+    assert len(inventory['sites']) == 20
+    assert inventory['sites']['site-3'] == {
+        'name': 'site-3', 'id': 3, 'state': 'Started', 'auto_start': True,
+        'apppool': 'site-3', 'physical_path': r'd:\web\site-3',
+        'bindings': [{'protocol': 'http', 'binding_information': '*:80:site-3.example.com'}],
+    }
+    assert inventory['bindings']['http/*:80:site-3.example.com'] == 'site-3'
+    assert inventory['site_ids'][3] == 'site-3'
+    assert inventory['apppool_sites']['site-3'] == ['site-3']
+    assert inventory['apppools']['site-3']['state'] == 'Started'
+    assert inventory['max_site_id'] == 20
+
+
+def test_inventory_goes_back_to_the_master(iis):
+    import salt.payload
+    inventory = iis.inventory()
+    iis.batch([{'op': 'create_binding', 'site': 'site-3', 'hostheader': 'site-3.example.com',
+                'port': 443, 'protocol': 'https'}])
+    inventory = iis.inventory()
+    assert inventory['bindings']['https/*:443:site-3.example.com'] == 'site-3'
+
+    loaded = salt.payload.loads(salt.payload.dumps(inventory))
+    assert loaded['bindings'] == inventory['bindings']
+    assert loaded['sites'] == inventory['sites']
+    # --out=json
+    assert json.loads(json.dumps(inventory))['bindings'] == inventory['bindings']
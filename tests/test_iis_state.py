@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+'''
+xjoker_win_iis states: planning, aggregation and the batch results
+'''
+from __future__ import absolute_import
+
+import os
+
+import pytest
+
+pytest.importorskip('salt')
+
+
+@pytest.fixture
+def bench(make_bench):
+    return make_bench(sites=10)
+
+
+@pytest.fixture
+def iis(bench):
+    return bench.load('IIS/xJoker_win_iis.py', 'xjoker_win_iis')
+
+
+@pytest.fixture
+def state(bench, iis):
+    module = bench.load('IIS/xJoker_win_iis_state.py', 'xjoker_win_iis_state')
+    bench.opts['test'] = False
+    for fun in ('plan', 'batch', 'inventory', 'set_acl'):
+        module.__salt__['xjoker_win_iis.' + fun] = getattr(iis, fun)
+    return module
+
+
+def _chunk(id_, fun, **kwargs):
+    chunk = {'state': 'xjoker_win_iis', '__id__': id_, 'name': kwargs.pop('name', id_),
+             'fun': fun, '__sls__': 'iis', '__env__': 'base', 'order': 1}
+    chunk.update(kwargs)
+    return chunk
+
+
+def test_plan_against_the_inventory(iis):
+    plans = iis.plan([
+        {'fun': 'apppool_present', 'name': 'shop', 'runtime_version': 'v2.0'},
+        {'fun': 'site_present', 'name': 'shop', 'sourcepath': r'd:\web\shop', 'apppool': 'shop'},
+        {'fun': 'bindings_managed', 'name': 'shop', 'bindings': ['*:80:shop', 'https/*:443:shop']},
+        {'fun': 'site_present', 'name': 'site-1', 'sourcepath': r'd:\web\site-1'},
+        {'fun': 'apppool_present', 'name': 'site-2', 'runtime_version': 'v4.0'},
+        {'fun': 'binding_absent', 'name': 'gone', 'site': 'site-3', 'hostheader': 'nope'},
+        {'fun': 'bindings_managed', 'name': 'missing', 'bindings': []},
+    ], test=True)
+    assert [x['steps'] for x in plans[:2]] == [
+        [{'op': 'create_apppool', 'name': 'shop'},
+         {'op': 'set_apppool', 'name': 'shop', 'settings': {'runtime_version': 'v2.0'}}],
+        [{'op': 'create_site', 'name': 'shop', 'sourcepath': r'd:\web\shop', 'port': '80',
+          'apppool': 'shop', 'hostheader': '', 'ipaddress': '*'}],
+    ]
+    # The bindings of the site planned above, not of the inventory
+    assert plans[2]['changes'] == {'added': ['http/*:80:shop', 'https/*:443:shop'],
+                                   'removed': ['http/*:80:']}
+    assert [(x['steps'], x['comment']) for x in plans[3:6]] == [
+        ([], 'Site already present'),
+        ([], 'AppPool already present'),
+        ([], 'Binding already absent'),
+    ]
+    assert plans[6]['result'] is False
+    assert plans[6]['comment'] == 'Site not exist: missing'
+
+
+def test_states_applied_in_one_batch(bench, state):
+    chunks = [
+        _chunk('shop-pool', 'apppool_present', name='shop', runtime_version='v2.0'),
+        _chunk('shop-site', 'site_present', name='shop', sourcepath=bench.tmp, apppool='shop'),
+        _chunk('site-1-gone', 'site_absent', name='site-1'),
+    ]
+    state.mod_aggregate(chunks[0], chunks, {})
+    bench._calls()
+
+    ret = state.apppool_present('shop', runtime_version='v2.0')
+    assert ret['result'] is True
+    assert ret['changes']['apppool'] == {'old': None, 'new': 'shop'}
+    # Inventory read and one batch for the three states
+    assert bench._calls()['request'] == 2
+
+    site = state.site_present('shop', bench.tmp, apppool='shop')
+    gone = state.site_absent('site-1')
+    assert bench._calls()['request'] == 0
+    assert site['result'] is True
+    assert site['changes'] == {'site': {'old': None, 'new': 'shop'}}
+    assert gone['changes'] == {'site': {'old': 'site-1', 'new': None}}
+
+
+def test_conditions_and_requisites_are_not_aggregated(state):
+    low = _chunk('first', 'site_absent', name='site-1')
+    chunks = [
+        low,
+        _chunk('plain', 'site_absent', name='site-2'),
+        _chunk('unless', 'site_absent', name='site-3', unless='exit 0'),
+        _chunk('onlyif', 'site_absent', name='site-4', onlyif=['exit 1']),
+        _chunk('creates', 'site_absent', name='site-5', creates='c:\\done'),
+        _chunk('hard', 'site_absent', name='site-6', failhard=True),
+        _chunk('required', 'site_absent', name='site-7', require=[{'cmd': 'x'}]),
+        _chunk('target', 'site_absent', name='site-8'),
+        _chunk('other', 'site_absent', name='site-9', require_in=[{'xjoker_win_iis': 'target'}]),
+        _chunk('file', 'managed', name='site-10', state='file'),
+    ]
+    state.mod_aggregate(low, chunks, {})
+    pending = state.__context__[state._PENDING_KEY]
+    assert [x['name'] for x in pending] == ['site-2']
+    assert [x['__id__'] for x in chunks if '__agg__' in x] == ['plain']
+
+
+def test_nothing_aggregated_with_failhard(bench, state):
+    bench.opts['failhard'] = True
+    chunks = [_chunk('first', 'site_absent', name='site-1'),
+              _chunk('plain', 'site_absent', name='site-2')]
+    state.mod_aggregate(chunks[0], chunks, {})
+    assert not state.__context__.get(state._PENDING_KEY)
+
+
+def test_failed_step_fails_its_state(monkeypatch, state):
+    monkeypatch.setenv('XJOKER_FAKE_BATCH_FAIL', 'site-2')
+    rets = state._apply([state._spec('site_absent', {'name': 'site-1'}),
+                         state._spec('site_absent', {'name': 'site-2'})])
+    assert [x['result'] for x in rets] == [True, False]
+    assert rets[1]['comment'] == 'fake failure'
+    assert rets[1]['changes'] == {}
+
+
+def test_missing_step_results_fail_the_state(monkeypatch, state):
+    # The script stopped after the first step
+    monkeypatch.setenv('XJOKER_FAKE_BATCH_LIMIT', '1')
+    rets = state._apply([state._spec('site_absent', {'name': 'site-1'}),
+                         state._spec('apppool_present', {'name': 'new', 'runtime_version': 'v2.0'}),
+                         state._spec('site_absent', {'name': 'site-3'})])
+    assert rets[0]['result'] is True
+    assert rets[1]['result'] is False
+    assert rets[1]['changes'] == {}
+    assert rets[1]['comment'] == ('Only 0 of 2 steps reported a result, the batch script'
+                                  ' did not finish')
+    assert rets[2]['result'] is False
+
+
+def test_test_mode_runs_nothing(bench, state):
+    bench.opts['test'] = True
+    state.__salt__['xjoker_win_iis.inventory']()
+    bench._calls()
+    ret = state.site_absent('site-1')
+    assert ret['result'] is None
+    assert ret['changes'] == {'site': {'old': 'site-1', 'new': None}}
+    assert bench._calls()['request'] == 0
+    assert os.path.isdir(bench.tmp)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+'''
+Persistent powershell host of xjoker_runner, against a fake host
+speaking the same framing (see fake_pshost.py)
+'''
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip('salt')
+
+from salt.exceptions import CommandExecutionError  # pylint: disable=wrong-import-position
+
+FAKE_PSHOST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_pshost.py')
+
+
+@pytest.fixture
+def runner(make_bench):
+    bench = make_bench()
+    bench.opts['xjoker_runner'] = {'pshost_cmd': [sys.executable, FAKE_PSHOST],
+                                   'pshost_pool_size': 1}
+    return bench.runner
+
+
+def _host(runner, idle_timeout=300):
+    host = runner._PSHost([sys.executable, FAKE_PSHOST], idle_timeout=idle_timeout)
+    return host
+
+
+def test_reply_framing(runner):
+    host = _host(runner)
+    try:
+        assert host.execute('echo hello') == (0, 'hello')
+        assert host.execute(u'echo 站点 ok') == (0, u'站点 ok')
+        assert host.execute('fail broken') == (1, 'broken')
+        # Lines that are not frames are skipped
+        assert host.execute('noise after') == (0, 'after')
+        assert host.execute('echo') == (0, '')
+    finally:
+        host.stop()
+
+
+def test_powershell_uses_one_pooled_host(runner):
+    first = runner.powershell('pid')
+    assert runner.powershell('pid') == first
+    assert runner.powershell('echo a\r\nb') == 'a\nb'
+    # A failing script still returns its output
+    assert runner.powershell('fail oops') == 'oops'
+
+
+def test_host_death_restarts(runner):
+    host = _host(runner)
+    try:
+        pid = host.execute('pid')[1]
+        with pytest.raises(runner._PSHostDied):
+            host.execute('die')
+        assert not host.alive()
+        assert host.execute('pid')[1] != pid
+    finally:
+        host.stop()
+
+
+def test_powershell_reports_host_death(runner):
+    pid = runner.powershell('pid')
+    with pytest.raises(CommandExecutionError):
+        runner.powershell('die')
+    assert runner.powershell('pid') != pid
+
+
+def test_crashed_idle_host_is_replaced(runner):
+    host = _host(runner)
+    try:
+        pid = host.execute('pid')[1]
+        host.proc.kill()
+        host.proc.wait()
+        assert host.execute('pid')[1] != pid
+    finally:
+        host.stop()
+
+
+def test_request_timeout_stops_host(runner):
+    host = _host(runner)
+    try:
+        with pytest.raises(CommandExecutionError):
+            host.execute('sleep 1', timeout=0.3)
+        assert not host.alive()
+        assert host.execute('echo back') == (0, 'back')
+    finally:
+        host.stop()
+
+
+def test_idle_timeout(runner):
+    host = _host(runner, idle_timeout=0.2)
+    try:
+        pid = host.execute('pid')[1]
+        proc = host.proc
+        deadline = time.time() + 5
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        assert proc.poll() is not None
+        assert not host.alive()
+        assert host.execute('pid')[1] != pid
+    finally:
+        host.stop()
+
+
+def test_busy_host_is_not_stopped_as_idle(runner):
+    host = _host(runner, idle_timeout=0.2)
+    try:
+        pid = host.execute('pid')[1]
+        for _ in range(5):
+            assert host.execute('sleep 0.1') == (0, 'slept')
+        assert host.execute('pid')[1] == pid
+    finally:
+        host.stop()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+'''
+Auth cache of xjoker_svn against the fake svn, which checks the password
+and keeps the credentials in ``--config-dir`` like svn does
+'''
+from __future__ import absolute_import
+
+import hashlib
+import io
+import json
+import os
+import stat
+
+import pytest
+
+pytest.importorskip('salt')
+
+from salt import exceptions  # pylint: disable=wrong-import-position
+
+
+@pytest.fixture
+def svn(make_bench, monkeypatch):
+    monkeypatch.setenv('XJOKER_FAKE_SVN_PASSWORD', 'secret')
+    bench = make_bench(svn_lines=10)
+    module = bench.load('xJoker_svn.py', 'xjoker_svn', **{'xjoker_svn:auth_cache': True})
+    module.bench = bench
+    return module
+
+
+def _auth_calls(svn):
+    with io.open(svn.bench.log, encoding='utf-8') as fp_:
+        return sum(1 for line in fp_ if line.split() == ['svn', 'auth'])
+
+
+def _store_entry(svn):
+    return os.path.join(svn._auth_dir(), 'auth', 'svn.simple', 'fake-realm')
+
+
+def _run(svn, password='secret', stream=False):
+    ret = svn._run_svn('info', svn.bench.tmp, None, None, 'deploy', password,
+                       opts=('--xml',), stream=stream)
+    return ''.join(ret) if stream else ret
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_password_only_sent_until_stored(svn, stream):
+    _run(svn, stream=stream)
+    assert svn._auth_primed(svn._auth_dir(), 'deploy', 'secret')
+    assert not svn._auth_primed(svn._auth_dir(), 'deploy', 'other')
+
+    argv = []
+    run = svn.__utils__['xjoker_runner.run_stream' if stream else 'xjoker_runner.run']
+
+    def _record(cmd, **kwargs):
+        argv.append(cmd)
+        return run(cmd, **kwargs)
+
+    svn.__utils__ = dict(svn.__utils__, **{'xjoker_runner.run_stream': _record,
+                                           'xjoker_runner.run': _record})
+    _run(svn, stream=stream)
+    assert '--password' not in argv[0]
+
+
+def test_marker_does_not_hold_a_plain_hash(svn):
+    _run(svn)
+    path = svn._auth_dir()
+    with io.open(os.path.join(path, 'xjoker_auth.json'), encoding='utf-8') as fp_:
+        marker = json.load(fp_)
+    plain = hashlib.sha256(u'deploy\0secret'.encode('utf-8')).hexdigest()
+    assert marker['deploy'] != plain
+    assert marker['deploy'] == svn._auth_key(path, 'deploy', 'secret')
+    if os.name == 'posix':
+        mode = stat.S_IMODE(os.stat(os.path.join(path, 'xjoker_secret')).st_mode)
+        assert mode == 0o600
+
+
+def test_legacy_marker_is_removed(svn):
+    path = svn._auth_dir()
+    os.makedirs(path)
+    legacy = os.path.join(path, 'xjoker_primed.json')
+    with io.open(legacy, 'w', encoding='utf-8') as fp_:
+        fp_.write(u'{}')
+    _run(svn)
+    assert not os.path.exists(legacy)
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_rejected_cached_credentials_are_retried(svn, stream):
+    _run(svn, stream=stream)
+    before = _auth_calls(svn)
+    # The store no longer matches the server, e.g. the password was reset
+    # and set back, or the store was replaced
+    entry = _store_entry(svn)
+    with io.open(entry, encoding='utf-8') as fp_:
+        lines = fp_.read().split('\n')
+    lines[3] = 'stale'
+    with io.open(entry, 'w', encoding='utf-8') as fp_:
+        fp_.write(u'\n'.join(lines))
+
+    assert '<info>' in _run(svn, stream=stream)
+    assert _auth_calls(svn) == before + 1
+    assert svn._auth_primed(svn._auth_dir(), 'deploy', 'secret')
+    with io.open(entry, encoding='utf-8') as fp_:
+        assert fp_.read().split('\n')[3] == 'secret'
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_rejected_password_forgets_the_credentials(svn, monkeypatch, stream):
+    _run(svn, stream=stream)
+    monkeypatch.setenv('XJOKER_FAKE_SVN_PASSWORD', 'changed')
+    with pytest.raises(exceptions.CommandExecutionError):
+        _run(svn, stream=stream)
+    assert not svn._auth_primed(svn._auth_dir(), 'deploy', 'secret')
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+'''
+Changed-only ``xjoker_svn.export`` against the fake svn
+'''
+from __future__ import absolute_import
+
+import io
+import json
+import os
+
+import pytest
+
+pytest.importorskip('salt')
+
+REMOTE = 'https://svn.example.com/repo/trunk'
+
+
+@pytest.fixture
+def bench(make_bench):
+    return make_bench()
+
+
+@pytest.fixture
+def svn(bench):
+    return bench.load('xJoker_svn.py', 'xjoker_svn')
+
+
+def _changes(bench, monkeypatch, changes):
+    path = os.path.join(bench.tmp, 'changes.json')
+    with io.open(path, 'w', encoding='utf-8') as fp_:
+        fp_.write(json.dumps(changes, ensure_ascii=False))
+    monkeypatch.setenv('XJOKER_FAKE_SVN_CHANGES', path)
+
+
+def _read(path):
+    with io.open(path, encoding='utf-8') as fp_:
+        return fp_.read()
+
+
+def test_export_changed_files(bench, svn, monkeypatch):
+    files = ['src/module{0}/file{1}.cs'.format(idx // 100, idx) for idx in range(450)]
+    _changes(bench, monkeypatch, [
+        {'path': '', 'item': 'none', 'kind': 'dir'},
+        {'path': 'newdir', 'item': 'added', 'kind': 'dir'},
+        {'path': 'old.txt', 'item': 'deleted', 'kind': 'file'},
+        {'path': 'img/logo@2x.png', 'item': 'added', 'kind': 'file'},
+    ] + [{'path': x, 'item': 'modified', 'kind': 'file'} for x in files])
+    dest = os.path.join(bench.tmp, 'patch')
+    os.makedirs(os.path.join(dest, 'src', 'module0'))
+    with io.open(os.path.join(dest, 'src', 'module0', 'file0.cs'), 'w') as fp_:
+        fp_.write(u'old')
+    bench._calls()
+
+    ret = svn.export(dest, REMOTE, since=1200)
+    assert ret['result'] is True
+    assert ret['revision'] == 1234
+    assert ret['since'] == 1200
+    assert ret['errors'] == {}
+    assert ret['deleted'] == ['old.txt']
+    assert sorted(ret['exported']) == sorted(files + ['img/logo@2x.png'])
+    # Every file comes from the revision HEAD was resolved to
+    assert _read(os.path.join(dest, 'src', 'module0', 'file0.cs')) == 'src/module0/file0.cs@1234'
+    assert _read(os.path.join(dest, 'img', 'logo@2x.png')) == 'img/logo@2x.png@1234'
+    assert os.path.isdir(os.path.join(dest, 'newdir'))
+    assert sorted(os.listdir(dest)) == ['img', 'newdir', 'src']
+    # info, diff, then a checkout and an update for each of the three
+    # staging working copies
+    assert bench._calls()['spawn'] == 8
+
+
+def test_export_reports_files_not_fetched(bench, svn, monkeypatch):
+    _changes(bench, monkeypatch, [
+        {'path': 'a.txt', 'item': 'added', 'kind': 'file'},
+        {'path': 'b.txt', 'item': 'modified', 'kind': 'file', 'lost': True},
+    ])
+    dest = os.path.join(bench.tmp, 'patch')
+    ret = svn.export(dest, REMOTE, revision=1240, since=1234)
+    assert ret['result'] is False
+    assert ret['revision'] == 1240
+    assert ret['exported'] == ['a.txt']
+    assert ret['errors'] == {'b.txt': 'Not fetched: b.txt'}
+    assert _read(os.path.join(dest, 'a.txt')) == 'a.txt@1240'
+    assert os.listdir(dest) == ['a.txt']
+
+
+def test_arg_groups(svn):
+    paths = ['x' * 7] * 10
+    assert [len(x) for x in svn._arg_groups(paths, limit=35)] == [3, 3, 3, 1]
+    assert list(svn._arg_groups([], limit=35)) == []
+    assert list(svn._arg_groups(['y' * 50], limit=35)) == [['y' * 50]]
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+'''
+Parsing of the svn ``--xml`` output by xjoker_svn, from samples and from
+the fake svn
+'''
+from __future__ import absolute_import
+
+import pytest
+
+pytest.importorskip('salt')
+
+STATUS = u'''<?xml version="1.0" encoding="UTF-8"?>
+<status>
+<target path=".">
+<entry path="web.config">
+<wc-status props="modified" item="modified" revision="1234" wc-locked="true">
+<commit revision="1230"><author>deploy</author><date>2016-05-04T03:02:01.123456Z</date></commit>
+<lock><token>opaquelocktoken:1</token><owner>ops</owner><comment>hold</comment>
+<created>2016-05-01T00:00:00.000000Z</created></lock>
+</wc-status>
+<repos-status props="none" item="modified"></repos-status>
+</entry>
+<entry path="new.txt">
+<wc-status props="none" item="unversioned"></wc-status>
+</entry>
+<entry path="moved">
+<wc-status props="none" item="added" copied="true" tree-conflicted="true"></wc-status>
+</entry>
+<entry path="normal.txt">
+<wc-status props="conflicted" item="normal" revision="1234" switched="true"></wc-status>
+</entry>
+</target>
+<changelist name="hotfix">
+<entry path="app.js">
+<wc-status props="none" item="deleted" revision="1234"></wc-status>
+</entry>
+</changelist>
+</status>
+'''
+
+INFO = u'''<?xml version="1.0" encoding="UTF-8"?>
+<info>
+<entry kind="file" path="web.config" revision="1234">
+<url>https://svn.example.com/repo/trunk/web.config</url>
+<relative-url>^/trunk/web.config</relative-url>
+<repository><root>https://svn.example.com/repo</root><uuid>uuid-1</uuid></repository>
+<wc-info><wcroot-abspath>D:/web/shop</wcroot-abspath><schedule>normal</schedule>
+<depth>infinity</depth><checksum>abc</checksum></wc-info>
+<commit revision="1230"><author>deploy</author><date>2016-05-04T03:02:01.123456Z</date></commit>
+</entry>
+<entry kind="dir" path="images" revision="1234">
+<url>https://svn.example.com/repo/trunk/images</url>
+</entry>
+</info>
+'''
+
+LOG = u'''<?xml version="1.0" encoding="UTF-8"?>
+<log>
+<logentry revision="1235">
+<author>deploy</author>
+<date>2016-05-04T03:02:01.123456Z</date>
+<paths>
+<path action="A" kind="file" copyfrom-path="/trunk/old.txt" copyfrom-rev="1200">/trunk/new.txt</path>
+<path action="D" kind="">/trunk/old.txt</path>
+</paths>
+<msg>move
+two lines</msg>
+</logentry>
+<logentry revision="1234">
+</logentry>
+</log>
+'''
+
+
+@pytest.fixture
+def bench(make_bench):
+    return make_bench(svn_lines=400)
+
+
+@pytest.fixture
+def svn(bench):
+    return bench.load('xJoker_svn.py', 'xjoker_svn')
+
+
+def _lines(text):
+    return iter(text.splitlines())
+
+
+def test_status_records(svn):
+    records = list(svn._status_records(_lines(STATUS)))
+    assert [(x['path'], x['action'], x['props']) for x in records] == [
+        ('web.config', 'M', 'M'), ('new.txt', '?', ' '), ('moved', 'A', ' '),
+        ('normal.txt', ' ', 'C'), ('app.js', 'D', ' ')]
+    web = records[0]
+    assert web['locked'] is True
+    assert web['revision'] == 1234
+    assert web['last_changed_rev'] == 1230
+    assert web['last_changed_author'] == 'deploy'
+    assert web['last_changed_timestamp'] == 1462330921
+    assert web['lock']['owner'] == 'ops'
+    assert web['lock']['created_timestamp'] == 1462060800
+    assert web['repos_action'] == 'M'
+    assert web['repos_props'] == ' '
+    assert records[1]['revision'] is None
+    assert records[1]['last_changed_rev'] is None
+    assert records[2]['history'] is True
+    assert records[2]['tree_conflict'] is True
+    assert records[3]['switched'] is True
+    assert [x['changelist'] for x in records] == [None, None, None, None, 'hotfix']
+    assert 'repos_action' not in records[1]
+
+    summary = svn._summarize(iter(records))
+    assert summary == {'total': 5, 'actions': {'M': 1, '?': 1, 'A': 1, 'D': 1},
+                       'props': {'M': 1, 'C': 1}, 'conflicts': ['moved', 'normal.txt']}
+
+
+def test_info_records(svn):
+    records = list(svn._info_records(_lines(INFO)))
+    assert records[0] == {
+        'path': 'web.config', 'kind': 'file', 'revision': 1234,
+        'url': 'https://svn.example.com/repo/trunk/web.config',
+        'relative_url': '^/trunk/web.config',
+        'repository_root': 'https://svn.example.com/repo', 'repository_uuid': 'uuid-1',
+        'wc_root': 'D:/web/shop', 'schedule': 'normal', 'depth': 'infinity',
+        'checksum': 'abc', 'text_updated': None, 'lock': None,
+        'last_changed_rev': 1230, 'last_changed_author': 'deploy',
+        'last_changed_date': '2016-05-04T03:02:01.123456Z',
+        'last_changed_timestamp': 1462330921,
+    }
+    assert records[1]['kind'] == 'dir'
+    assert records[1]['wc_root'] is None
+    assert records[1]['last_changed_rev'] is None
+
+
+def test_log_records(svn):
+    records = list(svn._log_records(_lines(LOG)))
+    assert records[0]['revision'] == 1235
+    assert records[0]['message'] == 'move\ntwo lines'
+    assert records[0]['timestamp'] == 1462330921
+    assert records[0]['paths'] == [
+        {'path': '/trunk/new.txt', 'action': 'A', 'kind': 'file',
+         'copyfrom_path': '/trunk/old.txt', 'copyfrom_rev': 1200},
+        {'path': '/trunk/old.txt', 'action': 'D', 'kind': None,
+         'copyfrom_path': None, 'copyfrom_rev': None},
+    ]
+    assert records[1] == {'revision': 1234, 'author': None, 'date': None,
+                          'timestamp': None, 'message': None}
+
+
+def test_update_records(svn):
+    lines = ['Updating \'.\':', 'U    web.config', ' U   images', 'A B  app.js',
+             'C  C moved', 'Updated to revision 1235.', 'Summary of conflicts:',
+             '  Text conflicts: 1']
+    assert [(x['path'], x['action'], x['props'], x['lock_broken'], x['tree_conflict'])
+            for x in svn._update_records(iter(lines))] == [
+        ('web.config', 'U', ' ', False, False),
+        ('images', ' ', 'U', False, False),
+        ('app.js', 'A', ' ', True, False),
+        ('moved', 'C', ' ', False, True),
+    ]
+
+
+def test_status_from_svn(bench, svn):
+    records = svn.status(bench.tmp, fmt='records')
+    assert len(records) == 400
+    assert records[0]['path'] == 'trunk\\src\\module0\\file0.cs'
+    assert [x['action'] for x in records[:4]] == ['M', 'A', '?', '!']
+    assert svn.status(bench.tmp, fmt='summary') == {
+        'total': 400, 'actions': {'M': 100, 'A': 100, '?': 100, '!': 100},
+        'props': {}, 'conflicts': []}
+
+
+def test_info_and_log_from_svn(bench, svn):
+    info = svn.info(bench.tmp, fmt='dict')
+    assert [(x['revision'], x['last_changed_rev'], x['depth']) for x in info] == [
+        (1234, 1230, 'infinity')]
+    assert ('revision', 1234) in svn.info(bench.tmp, fmt='list')[0]
+
+    log = svn.log(bench.tmp, limit=2, verbose=True)
+    assert [x['revision'] for x in log] == [1234, 1233]
+    assert log[0]['paths'][0]['path'] == '/trunk/src/file1234.cs'
+
+
+def test_invalid_fmt(bench, svn):
+    from salt.exceptions import SaltInvocationError
+    with pytest.raises(SaltInvocationError):
+        svn.status(bench.tmp, fmt='json')
+    with pytest.raises(SaltInvocationError):
+        svn.info(bench.tmp, fmt='records')
@@ -1,230 +1,1278 @@
-# -*- coding: utf-8 -*-
-
-from __future__ import absolute_import
-
-# Import python libs
-import logging
-import os
-import re
-import subprocess
-
-import salt.utils
-from salt import utils, exceptions
-
-
-__virtualname__ = 'xjoker_svn'
-_LOG = logging.getLogger(__name__)
-_INI_RE = re.compile(r"^([^:]+):\s+(\S.*)$", re.M)
-
-def __virtual__():
-    if salt.utils.is_windows():
-        if utils.which('svn') is None:
-            return (False,
-                'The svn execution module cannot be loaded: svn unavailable.')
-        else:
-            return True
-    else:
-        return (False,
-                'This modules only run Windows system.')
-
-
-def _run_svn(cmd, cwd,runasUsername,runasPassword,username, password,certCheck,revision='', opts=''):
-    '''
-        Execute svn command
-
-
-    :param cmd: The command to svn.
-    :param cwd: The path to the Subversion repository.
-    :param username: Connect to Subversion server as another user.
-    :param password: Connect to Subversion server with this password.
-    :param certCheck: Check Subversion server Cert
-    :param opts: Any additional options to add to the command line
-    :return: Return the output of the command
-    '''
-
-    if runasUsername:
-        cmd = ['chcp', '936', '>', 'nul', '&', 'runas','/user:{0}'.format(runasUsername),'"svn', '--non-interactive', cmd, cwd]
-    else:
-        cmd=['chcp','936', '>', 'nul' ,'&','svn','--non-interactive',cmd,cwd]
-
-    options = list(opts)
-    if revision!='':
-        options.extend(['-r',str(revision)])
-
-    if username:
-        options.extend(['--username',username])
-    if password:
-        options.extend(['--password',password])
-
-    if not certCheck:
-        options.extend(['--trust-server-cert'])
-
-    cmd.extend(options)
-    if runasUsername:
-        cmd.extend('"')
-    _LOG.info(cmd)
-    # 设置为简中编码
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,stdin=subprocess.PIPE)
-
-    # 如果有指定RunAS密码在此插入
-    if runasPassword:
-        p.stdin.write(runasPassword)
-        p.stdin.close()
-
-    stdout, stderr = p.communicate()
-    if p.returncode==0:
-        return stdout.decode('cp936').encode('utf-8')
-
-    raise exceptions.CommandExecutionError(stdout.decode('cp936').encode('utf-8')+ '\n\n')
-
-
-def update(cwd,
-           targets=None,
-           runasUsername=None,
-           runasPassword=None,
-           username=None,
-           password=None,
-           certCheck=True,
-           revision='',
-           *opts):
-    '''
-
-    Execute svn update command
-
-    '''
-    if targets:
-        opts += tuple(salt.utils.shlex_split(targets))
-
-    return _run_svn('update', cwd,runasUsername, runasPassword,username, password,certCheck,revision,opts)
-
-def checkout(cwd,
-             remote,
-             target=None,
-             runasUsername=None,
-             runasPassword=None,
-             username=None,
-             password=None,
-             certCheck=True,
-             revision='',
-             *opts):
-    opts += (remote,)
-    if target:
-        opts += (target,)
-    if not os.path.exists(cwd):
-        os.mkdir(cwd)
-    return _run_svn('checkout', cwd, runasUsername, runasPassword,username, password,certCheck,revision,opts)
-
-def info(cwd,
-         targets=None,
-         runasUsername=None,
-         runasPassword=None,
-         username=None,
-         password=None,
-         fmt='str'):
-    opts = list()
-    if fmt == 'xml':
-        opts.append('--xml')
-    if targets:
-        opts += salt.utils.shlex_split(targets)
-    infos = _run_svn('info', cwd, runasUsername, runasPassword, username, password, opts)
-
-    if fmt in ('str', 'xml'):
-        return infos
-
-    info_list = []
-    for infosplit in infos.split('\n\n'):
-        info_list.append(_INI_RE.findall(infosplit))
-
-    if fmt == 'list':
-        return info_list
-    if fmt == 'dict':
-        return [dict(tmp) for tmp in info_list]
-
-def switch(cwd,
-           remote,
-           target=None,
-           runasUsername=None,
-           runasPassword=None,
-           username=None,
-           password=None,
-           *opts):
-    opts += (remote,)
-    if target:
-        opts += (target,)
-    return _run_svn('switch', cwd, runasUsername, runasPassword, username, password, opts)
-
-def diff(cwd,
-         targets=None,
-         runasUsername=None,
-         runasPassword=None,
-         username=None,
-         password=None,
-         *opts):
-    if targets:
-        opts += tuple(salt.utils.shlex_split(targets))
-    return _run_svn('diff', cwd,  runasUsername, runasPassword,username, password, opts)
-
-def commit(cwd,
-           targets=None,
-           runasUsername=None,
-           runasPassword=None,
-           msg=None,
-           username=None,
-           password=None,
-           *opts):
-    if msg:
-        opts += ('-m', msg)
-    if targets:
-        opts += tuple(salt.utils.shlex_split(targets))
-    return _run_svn('commit', cwd,  runasUsername, runasPassword,username, password, opts)
-
-def add(cwd,
-        targets,
-        runasUsername=None,
-        runasPassword=None,
-        username=None,
-        password=None,
-        *opts):
-    if targets:
-        opts += tuple(salt.utils.shlex_split(targets))
-    return _run_svn('add', cwd,  runasUsername, runasPassword,username, password, opts)
-
-def remove(cwd,
-           targets,
-           runasUsername=None,
-           runasPassword=None,
-           msg=None,
-           username=None,
-           password=None,
-           *opts):
-    if msg:
-        opts += ('-m', msg)
-    if targets:
-        opts += tuple(salt.utils.shlex_split(targets))
-    return _run_svn('remove', cwd,  runasUsername, runasPassword,username, password, opts)
-
-def status(cwd,
-           targets=None,
-           runasUsername=None,
-           runasPassword=None,
-           username=None,
-           password=None,
-           *opts):
-
-    if targets:
-        opts += tuple(salt.utils.shlex_split(targets))
-    return _run_svn('status', cwd,  runasUsername, runasPassword,username, password, opts)
-
-def export(cwd,
-           remote,
-           target=None,
-           runasUsername=None,
-           runasPassword=None,
-           username=None,
-           password=None,
-           revision='HEAD',
-           *opts):
-    opts += (remote,)
-    if target:
-        opts += (target,)
-    return _run_svn('export', cwd,  runasUsername, runasPassword,username, password,revision, opts)
\ No newline at end of file
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+# Import python libs
+import calendar
+import binascii
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+import salt.utils
+from salt import utils, exceptions
+from salt.ext import six
+
+
+__virtualname__ = 'xjoker_svn'
+_LOG = logging.getLogger(__name__)
+_FMTS = ('str', 'records', 'summary')
+_INFO_FMTS = ('str', 'xml', 'list', 'dict')
+_DEPTHS = ('empty', 'files', 'immediates', 'infinity', 'exclude')
+
+# Files a changed-only export fetches per staging working copy at least,
+# and characters of paths per svn update, below the Windows command line
+# limit of 32k
+_EXPORT_CHUNK = 200
+_ARGS_MAX = 24000
+
+# svn errors of rejected credentials: authorization failed, no more
+# credentials
+_AUTH_ERROR_RE = re.compile(r'\bE(170001|215004)\b')
+
+# servers file of the auth cache config directory. The plaintext store is
+# only used off Windows, there svn keeps passwords encrypted with DPAPI.
+_SERVERS = {
+    'store-auth-creds': 'yes',
+    'store-passwords': 'yes',
+    'store-plaintext-passwords': 'yes',
+}
+
+# svn status --xml item/props values -> status column codes
+_ITEM_CODES = {
+    'added': 'A',
+    'conflicted': 'C',
+    'deleted': 'D',
+    'external': 'X',
+    'ignored': 'I',
+    'incomplete': '!',
+    'missing': '!',
+    'modified': 'M',
+    'obstructed': '~',
+    'replaced': 'R',
+    'unversioned': '?',
+}
+
+def __virtual__():
+    if salt.utils.is_windows():
+        if utils.which('svn') is None:
+            return (False,
+                'The svn execution module cannot be loaded: svn unavailable.')
+        elif 'xjoker_runner.run' not in __utils__:
+            return (False,
+                'The svn execution module cannot be loaded: xjoker_runner utils missing.')
+        else:
+            __utils__['xjoker_runner.instrument'](globals(), __virtualname__)
+            return True
+    else:
+        return (False,
+                'This modules only run Windows system.')
+
+
+def _auth_dir():
+    return __salt__['config.get']('xjoker_svn:config_dir', None) or \
+        os.path.join(__opts__['cachedir'], 'xjoker_svn', 'config')
+
+
+def _auth_config():
+    '''
+    svn config directory of the auth cache, with a ``servers`` file
+    holding ``_SERVERS`` plus the ``xjoker_svn:servers`` profile
+    '''
+    path = _auth_dir()
+    if __context__.get('xjoker_svn.auth_config') == path:
+        return path
+    servers = dict(_SERVERS)
+    servers.update(__salt__['config.get']('xjoker_svn:servers', {}) or {})
+    content = '[global]\n' + ''.join(
+        '{0} = {1}\n'.format(key, value) for key, value in sorted(six.iteritems(servers)))
+    servers_file = os.path.join(path, 'servers')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    current = None
+    if os.path.isfile(servers_file):
+        with salt.utils.fopen(servers_file) as fp_:
+            current = fp_.read()
+    if current != content:
+        with salt.utils.fopen(servers_file, 'w') as fp_:
+            fp_.write(content)
+    # Unsalted hashes of an earlier version
+    legacy = os.path.join(path, 'xjoker_primed.json')
+    if os.path.isfile(legacy):
+        os.remove(legacy)
+    __context__['xjoker_svn.auth_config'] = path
+    return path
+
+
+def _auth_secret(path):
+    '''
+    Random key of this minion's auth cache, created readable by the
+    minion user only
+    '''
+    secret_file = os.path.join(path, 'xjoker_secret')
+    cached = __context__.get('xjoker_svn.auth_secret')
+    if cached and cached[0] == secret_file:
+        return cached[1]
+    with __utils__['xjoker_runner.file_lock'](secret_file + '.lock'):
+        if not os.path.isfile(secret_file):
+            fd_ = os.open(secret_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd_, 'w') as fp_:
+                fp_.write(binascii.hexlify(os.urandom(32)).decode('ascii'))
+        with salt.utils.fopen(secret_file) as fp_:
+            secret = fp_.read().strip().encode('ascii')
+    if not secret:
+        raise exceptions.CommandExecutionError('svn auth cache key {0} is empty'.format(secret_file))
+    __context__['xjoker_svn.auth_secret'] = (secret_file, secret)
+    return secret
+
+
+def _auth_key(path, username, password):
+    '''
+    HMAC of the credentials with the auth cache key, so the marker file
+    can not be used to guess the password without the key
+    '''
+    message = u'{0}\0{1}'.format(username, password).encode('utf-8')
+    return hmac.new(_auth_secret(path), message, hashlib.sha256).hexdigest()
+
+
+def _auth_primed(path, username, password):
+    '''
+    Whether svn stored the credentials of ``username`` with this
+    ``password`` in the auth cache
+    '''
+    try:
+        with salt.utils.fopen(os.path.join(path, 'xjoker_auth.json')) as fp_:
+            primed = json.load(fp_)
+    except (IOError, OSError, ValueError):
+        return False
+    return hmac.compare_digest(str(primed.get(username) or ''), _auth_key(path, username, password))
+
+
+def _auth_stored(path, username):
+    '''
+    Whether the svn auth store has a password of ``username``. svn builds
+    without a usable password store (no DPAPI, plaintext store disabled)
+    do not keep it.
+    '''
+    store = os.path.join(path, 'auth', 'svn.simple')
+    if not os.path.isdir(store):
+        return False
+    for name in os.listdir(store):
+        with salt.utils.fopen(os.path.join(store, name), 'rb') as fp_:
+            data = fp_.read()
+        if b'\npassword\n' in data and \
+                u'\n{0}\n'.format(username).encode('utf-8') in data:
+            return True
+    return False
+
+
+def _auth_prime(path, username, password=None):
+    '''
+    Note the credentials of ``username`` as stored by svn, or forget
+    them when ``password`` is None
+    '''
+    if password is not None and not _auth_stored(path, username):
+        _LOG.warning('svn did not store the password of %s, it is passed on every call', username)
+        return
+    marker = os.path.join(path, 'xjoker_auth.json')
+    with __utils__['xjoker_runner.file_lock'](marker + '.lock'):
+        try:
+            with salt.utils.fopen(marker) as fp_:
+                primed = json.load(fp_)
+        except (IOError, OSError, ValueError):
+            primed = {}
+        if password is None:
+            primed.pop(username, None)
+        else:
+            primed[username] = _auth_key(path, username, password)
+        with salt.utils.fopen(marker, 'w') as fp_:
+            json.dump(primed, fp_)
+
+
+def _svn_argv(cmd, cwd, runasUsername, username, password, certCheck, revision, opts,
+              config_dir):
+    cmd = ['svn', '--non-interactive', cmd, cwd]
+
+    options = list(opts)
+    if revision!='':
+        options.extend(['-r',str(revision)])
+
+    if config_dir:
+        options.extend(['--config-dir', config_dir])
+    if username:
+        options.extend(['--username',username])
+    if password:
+        options.extend(['--password',password])
+
+    if not certCheck:
+        options.extend(['--trust-server-cert'])
+
+    cmd.extend(options)
+    if runasUsername:
+        # runas takes the whole svn command line as one argument
+        cmd = ['runas', '/user:{0}'.format(runasUsername), subprocess.list2cmdline(cmd)]
+    return cmd
+
+
+def _cached_auth(run, cmd, retry, path, username, password, stream):
+    '''
+    Run ``cmd`` and note the credentials as stored afterwards. When it ran
+    without the password and svn rejects the cached credentials, they
+    are forgotten and ``retry`` (the command with the password) is run.
+    '''
+    if stream:
+        return _cached_auth_stream(run, cmd, retry, path, username, password)
+    try:
+        ret = run(cmd)
+    except exceptions.CommandExecutionError as exc:
+        if retry is None or not _AUTH_ERROR_RE.search(str(exc)):
+            raise
+        _LOG.info('svn rejected the cached credentials of %s, authenticating again', username)
+        _auth_prime(path, username)
+        ret = run(retry)
+        retry = None
+    if retry is None:
+        _auth_prime(path, username, password)
+    return ret
+
+
+def _cached_auth_stream(run, cmd, retry, path, username, password):
+    # svn error lines are held back until other output shows the command
+    # got past authentication, so a rejected login can still be retried
+    started = False
+    held = []
+    try:
+        for line in run(cmd):
+            if not started and line.startswith('svn: E'):
+                held.append(line)
+                continue
+            started = True
+            for error in held:
+                yield error
+            del held[:]
+            yield line
+        for error in held:
+            yield error
+    except exceptions.CommandExecutionError as exc:
+        if retry is None or started or not _AUTH_ERROR_RE.search(str(exc)):
+            raise
+        _LOG.info('svn rejected the cached credentials of %s, authenticating again', username)
+        _auth_prime(path, username)
+        for line in run(retry):
+            yield line
+        retry = None
+    if retry is None:
+        _auth_prime(path, username, password)
+
+
+def _run_svn(cmd, cwd,runasUsername,runasPassword,username, password,certCheck=True,revision='', opts='', stream=False, encoding=None):
+    '''
+        Execute svn command
+
+
+    :param cmd: The command to svn.
+    :param cwd: The path to the Subversion repository.
+    :param username: Connect to Subversion server as another user.
+    :param password: Connect to Subversion server with this password.
+    :param certCheck: Check Subversion server Cert
+    :param opts: Any additional options to add to the command line
+    :param stream: Return a generator of output lines instead of the text
+    :param encoding: Output encoding, ``--xml`` output is always UTF-8
+    :return: Return the output of the command
+
+    With ``xjoker_svn:auth_cache`` svn keeps the credentials in its auth
+    store under the minion cachedir. The password is passed once, later
+    commands of the same user authenticate from the store.
+    '''
+    config_dir = None
+    primed = False
+    if __salt__['config.get']('xjoker_svn:auth_cache', False):
+        config_dir = _auth_config()
+        primed = bool(username and password and _auth_primed(config_dir, username, password))
+        __utils__['xjoker_runner.count']('cache_hits' if primed else 'cache_misses')
+
+    argv = _svn_argv(cmd, cwd, runasUsername, username, None if primed else password,
+                     certCheck, revision, opts, config_dir)
+    _LOG.info(argv)
+
+    # 如果有指定RunAS密码在此插入
+    def _run(argv):
+        return __utils__['xjoker_runner.run_stream' if stream else 'xjoker_runner.run'](
+            argv,
+            stdin=runasPassword or None,
+            encoding=encoding or __salt__['config.get']('xjoker_svn:encoding', None),
+            timeout=__salt__['config.get']('xjoker_svn:timeout', None),
+            label='svn')
+
+    if not (config_dir and username and password):
+        return _run(argv)
+    retry = None
+    if primed:
+        retry = _svn_argv(cmd, cwd, runasUsername, username, password, certCheck, revision,
+                          opts, config_dir)
+    return _cached_auth(_run, argv, retry, config_dir, username, password, stream)
+
+
+def _fmt(kwargs, fmts=_FMTS, default='str'):
+    fmt = salt.utils.clean_kwargs(**kwargs).get('fmt', default)
+    if fmt not in fmts:
+        raise exceptions.SaltInvocationError(
+            "Invalid fmt '{0}'. Valid: {1}".format(fmt, ', '.join(fmts)))
+    return fmt
+
+
+class _LineReader(object):
+    '''
+    File object over the output lines of ``_run_svn(stream=True)``, so
+    iterparse reads the XML while svn is still writing it
+    '''
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            try:
+                line = (next(self._lines) + '\n').encode('utf-8')
+            except StopIteration:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = b''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def _iterxml(lines, tag):
+    '''
+    Yield every ``tag`` element of svn ``--xml`` output with the list of
+    its ancestors once it is complete. The element is cleared and
+    dropped from its parent afterwards, so memory stays flat however big
+    the working copy or the log is.
+    '''
+    stack = []
+    for event, elem in ElementTree.iterparse(_LineReader(lines), events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        if elem.tag == tag:
+            yield elem, stack
+            elem.clear()
+            if stack:
+                stack[-1].remove(elem)
+
+
+def _int(value):
+    return int(value) if value not in (None, '') else None
+
+
+def _timestamp(value):
+    '''
+    svn dates (``2016-05-04T03:02:01.123456Z``, always UTC) as epoch seconds
+    '''
+    if not value:
+        return None
+    return calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                            int(value[11:13]), int(value[14:16]), int(value[17:19])))
+
+
+def _commit(elem):
+    '''
+    Last changed revision, author and date from the ``<commit>`` child
+    of ``elem``
+    '''
+    commit = elem.find('commit')
+    if commit is None:
+        return {'last_changed_rev': None, 'last_changed_author': None,
+                'last_changed_date': None, 'last_changed_timestamp': None}
+    date = commit.findtext('date')
+    return {
+        'last_changed_rev': _int(commit.get('revision')),
+        'last_changed_author': commit.findtext('author'),
+        'last_changed_date': date,
+        'last_changed_timestamp': _timestamp(date),
+    }
+
+
+def _lock(elem):
+    '''
+    ``<lock>`` element as a dict, None when the path is not locked
+    '''
+    if elem is None:
+        return None
+    created = elem.findtext('created')
+    return {
+        'token': elem.findtext('token'),
+        'owner': elem.findtext('owner'),
+        'comment': elem.findtext('comment'),
+        'created': created,
+        'created_timestamp': _timestamp(created),
+        'expires': elem.findtext('expires'),
+    }
+
+
+def _info_records(lines):
+    '''
+    Parse ``svn info --xml`` output, one record per ``<entry>``
+    '''
+    for entry, _ in _iterxml(lines, 'entry'):
+        record = {
+            'path': entry.get('path'),
+            'kind': entry.get('kind'),
+            'revision': _int(entry.get('revision')),
+            'url': entry.findtext('url'),
+            'relative_url': entry.findtext('relative-url'),
+            'repository_root': entry.findtext('repository/root'),
+            'repository_uuid': entry.findtext('repository/uuid'),
+            'wc_root': entry.findtext('wc-info/wcroot-abspath'),
+            'schedule': entry.findtext('wc-info/schedule'),
+            'depth': entry.findtext('wc-info/depth'),
+            'checksum': entry.findtext('wc-info/checksum'),
+            'text_updated': entry.findtext('wc-info/text-updated'),
+            'lock': _lock(entry.find('lock')),
+        }
+        record.update(_commit(entry))
+        yield record
+
+
+def _status_records(lines):
+    '''
+    Parse ``svn status --xml`` output, one record per ``<entry>``.
+
+    ``action`` and ``props`` are the status column codes (`` `` when the
+    item is normal), ``item`` the name svn gives to the state. With
+    ``--show-updates`` the ``repos_action`` and ``repos_props`` codes of
+    the repository side are set as well.
+    '''
+    for entry, parents in _iterxml(lines, 'entry'):
+        wc_status = entry.find('wc-status')
+        if wc_status is None:
+            continue
+        item = wc_status.get('item')
+        record = {
+            'path': entry.get('path'),
+            'item': item,
+            'action': _ITEM_CODES.get(item, ' '),
+            'props': _ITEM_CODES.get(wc_status.get('props'), ' '),
+            'revision': _int(wc_status.get('revision')),
+            'locked': wc_status.get('wc-locked') == 'true',
+            'history': wc_status.get('copied') == 'true',
+            'switched': wc_status.get('switched') == 'true',
+            'tree_conflict': wc_status.get('tree-conflicted') == 'true',
+            'lock': _lock(wc_status.find('lock')),
+            'changelist': None,
+        }
+        record.update(_commit(wc_status))
+        for parent in parents:
+            if parent.tag == 'changelist':
+                record['changelist'] = parent.get('name')
+        repos_status = entry.find('repos-status')
+        if repos_status is not None:
+            record['repos_action'] = _ITEM_CODES.get(repos_status.get('item'), ' ')
+            record['repos_props'] = _ITEM_CODES.get(repos_status.get('props'), ' ')
+            record['repos_lock'] = _lock(repos_status.find('lock'))
+        yield record
+
+
+def _log_records(lines):
+    '''
+    Parse ``svn log --xml`` output, one record per ``<logentry>``
+    '''
+    for entry, _ in _iterxml(lines, 'logentry'):
+        date = entry.findtext('date')
+        record = {
+            'revision': _int(entry.get('revision')),
+            'author': entry.findtext('author'),
+            'date': date,
+            'timestamp': _timestamp(date),
+            'message': entry.findtext('msg'),
+        }
+        paths = entry.find('paths')
+        if paths is not None:
+            record['paths'] = [{
+                'path': path.text,
+                'action': path.get('action'),
+                'kind': path.get('kind') or None,
+                'copyfrom_path': path.get('copyfrom-path'),
+                'copyfrom_rev': _int(path.get('copyfrom-rev')),
+            } for path in paths.findall('path')]
+        yield record
+
+
+def _update_records(lines):
+    '''
+    Parse ``svn update`` output line by line, the four columns are the
+    item, properties, broken lock and tree conflict codes. The other
+    lines are in the svn language and skipped.
+    '''
+    for line in lines:
+        if len(line) < 6 or line[4] != ' ' or line[:4].strip() == '' \
+                or line[0] not in ' ADUCGER' or line[1] not in ' UCG':
+            continue
+        yield {
+            'path': line[5:],
+            'action': line[0],
+            'props': line[1],
+            'lock_broken': line[2] == 'B',
+            'tree_conflict': line[3] == 'C',
+        }
+
+
+def _wc_revision(cwd, runasUsername, runasPassword, username, password, certCheck=True):
+    '''
+    Revision of the working copy ``cwd`` from ``svn info --xml``, which
+    unlike the update output is the same in every svn language
+    '''
+    records = list(_info_records(_run_svn('info', cwd, runasUsername, runasPassword, username,
+                                          password, certCheck, opts=('--xml',), stream=True,
+                                          encoding='utf-8')))
+    return records[0]['revision'] if records else None
+
+
+def _summarize(records, result=None):
+    '''
+    Count records per action and property code and list the conflicts,
+    without keeping the records
+    '''
+    ret = {'total': 0, 'actions': {}, 'props': {}, 'conflicts': []}
+    for record in records:
+        ret['total'] += 1
+        if record['action'] != ' ':
+            ret['actions'][record['action']] = ret['actions'].get(record['action'], 0) + 1
+        if record['props'] != ' ':
+            ret['props'][record['props']] = ret['props'].get(record['props'], 0) + 1
+        if 'C' in (record['action'], record['props']) or record['tree_conflict']:
+            ret['conflicts'].append(record['path'])
+    if result is not None:
+        ret.update(result)
+    return ret
+
+
+def _relpath(path, cwd):
+    '''
+    Path printed by svn relative to the working copy ``cwd``, with ``/``
+    separators
+    '''
+    path = os.path.normpath(path)
+    base = os.path.normpath(cwd)
+    if path.lower().startswith(base.lower() + os.sep):
+        path = path[len(base) + 1:]
+    elif path.lower() == base.lower():
+        path = ''
+    return path.replace(os.sep, '/')
+
+
+def _manifest(cwd, runasUsername, runasPassword, username, password, certCheck, revision, opts):
+    '''
+    Update ``cwd`` and return what changed: ``old_revision``,
+    ``revision``, ``changed`` paths count, counts per ``actions`` and
+    ``props`` code, ``conflicts`` and ``paths`` with the ``path``
+    relative to ``cwd``, ``action`` and ``props`` codes
+    '''
+    old = _wc_revision(cwd, runasUsername, runasPassword, username, password, certCheck)
+    records = list(_update_records(_run_svn('update', cwd, runasUsername, runasPassword,
+                                            username, password, certCheck, revision, opts,
+                                            stream=True)))
+    summary = _summarize(records)
+    return {
+        'old_revision': old,
+        'revision': _wc_revision(cwd, runasUsername, runasPassword, username, password,
+                                 certCheck),
+        'changed': summary['total'],
+        'actions': summary['actions'],
+        'props': summary['props'],
+        'conflicts': summary['conflicts'],
+        'paths': [{'path': _relpath(x['path'], cwd), 'action': x['action'],
+                   'props': x['props']} for x in records],
+    }
+
+
+def _hook_rules(cwd, hooks=None):
+    '''
+    Hook rules given to the call plus those of ``xjoker_svn:hooks`` for
+    the working copy ``cwd``
+    '''
+    rules = list(hooks or [])
+    configured = __salt__['config.get']('xjoker_svn:hooks', {}) or {}
+    for path, path_rules in six.iteritems(configured):
+        if os.path.normcase(os.path.normpath(path)) == os.path.normcase(os.path.normpath(cwd)):
+            rules.extend(path_rules)
+    for rule in rules:
+        if not isinstance(rule, dict) or not rule.get('function'):
+            raise exceptions.SaltInvocationError(
+                'Every hook needs a function: {0}'.format(rule))
+    return rules
+
+
+def _run_hooks(manifest, rules):
+    '''
+    Call the function of every rule whose ``prefix`` has a changed path
+    under it, once per rule. Nothing runs when the update has conflicts.
+    '''
+    ret = []
+    for rule in rules:
+        prefix = rule.get('prefix', '').replace('\\', '/').strip('/').lower()
+        paths = [x['path'] for x in manifest['paths']
+                 if not prefix or x['path'].lower() == prefix
+                 or x['path'].lower().startswith(prefix + '/')]
+        hook = {'prefix': rule.get('prefix', ''), 'function': rule['function'],
+                'paths': len(paths), 'result': None, 'comment': ''}
+        ret.append(hook)
+        if not paths:
+            hook['comment'] = 'No changed path'
+            continue
+        if manifest['conflicts']:
+            hook['comment'] = 'Skipped, the update has conflicts'
+            continue
+        if rule['function'] not in __salt__:
+            hook['result'] = False
+            hook['comment'] = "Function '{0}' is not available".format(rule['function'])
+            continue
+        try:
+            hook['return'] = __salt__[rule['function']](*rule.get('args', []),
+                                                        **rule.get('kwargs', {}))
+        except Exception as exc:
+            hook['result'] = False
+            hook['comment'] = str(exc)
+            continue
+        hook['result'] = hook['return'].get('result', True) \
+            if isinstance(hook['return'], dict) else True
+    return ret
+
+
+def update(cwd,
+           targets=None,
+           runasUsername=None,
+           runasPassword=None,
+           username=None,
+           password=None,
+           certCheck=True,
+           revision='',
+           *opts,
+           **kwargs):
+    '''
+
+    Execute svn update command
+
+    fmt
+        ``str`` (default) returns the svn output. ``records`` returns a
+        list with ``path``, ``action``, ``props``, ``lock_broken`` and
+        ``tree_conflict`` per updated path, and ``summary`` just the
+        ``total``, the counts per ``actions`` and ``props`` code, the
+        ``conflicts`` paths and the ``revision`` (read with ``svn info
+        --xml`` afterwards). Both parse the output while svn runs, so the
+        full text is never held in memory.
+
+        ``manifest`` returns the ``old_revision`` and ``revision``, the
+        ``changed`` count, the counts per ``actions`` and ``props`` code,
+        the ``conflicts`` and under ``paths`` every changed ``path``
+        (relative to ``cwd``, ``/`` separated) with its ``action`` and
+        ``props`` codes, and the ``hooks`` run.
+
+    hooks
+        With ``fmt=manifest``, a list of rules run after the update. Each
+        has a path ``prefix`` relative to ``cwd``, the execution module
+        ``function`` to call and optional ``args`` and ``kwargs``. The
+        function is called once when any changed path is under the
+        prefix (an empty prefix matches every change), and not at all
+        when the update has conflicts. Rules for a working copy can also
+        be set in the minion config:
+
+        .. code-block:: yaml
+
+            xjoker_svn:
+              hooks:
+                'd:\\web\\shop':
+                  - prefix: bin
+                    function: xjoker_win_iis.recycle_apppools
+                    args: [shop]
+                  - prefix: web.config
+                    function: xjoker_win_iis.restart_sites
+                    args: [shop]
+
+        salt '*' xjoker_svn.update 'd:\\web\\shop' fmt=summary
+        salt '*' xjoker_svn.update 'd:\\web\\shop' fmt=manifest hooks='[{prefix: bin, function: xjoker_win_iis.recycle_apppools, args: [shop]}]'
+    '''
+    fmt = _fmt(kwargs, _FMTS + ('manifest',))
+    hooks = salt.utils.clean_kwargs(**kwargs).get('hooks')
+    if hooks and fmt != 'manifest':
+        raise exceptions.SaltInvocationError('hooks need fmt=manifest')
+    if targets:
+        opts += tuple(salt.utils.shlex_split(targets))
+
+    if fmt == 'manifest':
+        rules = _hook_rules(cwd, hooks)
+        ret = _manifest(cwd, runasUsername, runasPassword, username, password, certCheck,
+                        revision, opts)
+        ret['hooks'] = _run_hooks(ret, rules)
+        return ret
+
+    if fmt == 'str':
+        return _run_svn('update', cwd,runasUsername, runasPassword,username, password,certCheck,revision,opts)
+
+    lines = _run_svn('update', cwd, runasUsername, runasPassword, username, password,
+                     certCheck, revision, opts, stream=True)
+    records = _update_records(lines)
+    if fmt == 'summary':
+        summary = _summarize(records)
+        summary['revision'] = _wc_revision(cwd, runasUsername, runasPassword, username,
+                                           password, certCheck)
+        return summary
+    return list(records)
+
+def update_many(cwds,
+                runasUsername=None,
+                runasPassword=None,
+                username=None,
+                password=None,
+                certCheck=True,
+                revision='',
+                concurrency=None,
+                fail_fast=False):
+    '''
+    Execute svn update on many working copies at once
+
+    cwds
+        List (or comma separated string) of working copy paths, or a dict
+        of path to the revision to update that copy to (empty for
+        ``revision``)
+
+    revision
+        Revision for the copies without their own, HEAD by default
+
+    concurrency
+        Copies updated at once, ``xjoker_svn:concurrency`` from the minion
+        config or 4
+
+    fail_fast
+        Start no new update after the first failure
+
+    Returns the overall ``result`` and ``duration`` plus per copy under
+    ``items`` the ``result``, ``comment``, ``duration``,
+    ``old_revision``, ``revision``, ``changed`` paths count, counts per
+    ``actions`` code and the ``conflicts`` paths. A copy with conflicts
+    fails. The ``xjoker_svn:hooks`` of every copy are run after its
+    update, see ``xjoker_svn.update``, and reported under ``hooks``.
+
+        salt '*' xjoker_svn.update_many 'd:\\web\\shop,d:\\web\\blog' concurrency=8
+        salt '*' xjoker_svn.update_many '{"d:\\web\\shop": 1234, "d:\\web\\blog": ""}'
+    '''
+    start = time.time()
+    if isinstance(cwds, six.string_types):
+        cwds = [x.strip() for x in cwds.split(',') if x.strip()]
+    if isinstance(cwds, dict):
+        targets = dict((path, rev if rev not in (None, '') else revision)
+                       for path, rev in six.iteritems(cwds))
+    else:
+        targets = dict((path, revision) for path in cwds)
+    if concurrency is None:
+        concurrency = __salt__['config.get']('xjoker_svn:concurrency', 4)
+    details = {}
+
+    def _update(cwd):
+        rules = _hook_rules(cwd)
+        manifest = _manifest(cwd, runasUsername, runasPassword, username, password,
+                             certCheck, targets[cwd], ())
+        details[cwd] = dict((key, manifest[key]) for key in (
+            'old_revision', 'revision', 'changed', 'actions', 'conflicts'))
+        if rules:
+            details[cwd]['hooks'] = _run_hooks(manifest, rules)
+        if manifest['conflicts']:
+            return False, '{0} conflicts'.format(len(manifest['conflicts']))
+        if any(x['result'] is False for x in details[cwd].get('hooks', [])):
+            return False, 'Updated to revision {0}, hooks failed'.format(manifest['revision'])
+        return True, 'Updated to revision {0}'.format(manifest['revision'])
+
+    items = __utils__['xjoker_runner.parallel'](sorted(targets), _update, concurrency, fail_fast)
+    for cwd, item in six.iteritems(items):
+        item.update(details.get(cwd, {}))
+    return {
+        'result': all(x['result'] for x in items.values()),
+        'duration': round(time.time() - start, 3),
+        'items': items,
+    }
+
+def _depth_plan(paths):
+    '''
+    Sparse checkout plan as a dict of relative path to depth. ``paths``
+    is a list (or comma separated string) of paths checked out fully, or
+    a dict of path to depth.
+    '''
+    if isinstance(paths, six.string_types):
+        paths = [x.strip() for x in paths.split(',') if x.strip()]
+    if not isinstance(paths, dict):
+        paths = dict((path, 'infinity') for path in paths)
+    plan = {}
+    for path, depth in six.iteritems(paths):
+        if depth not in _DEPTHS:
+            raise exceptions.SaltInvocationError(
+                "Invalid depth '{0}' for {1}. Valid: {2}".format(depth, path, ', '.join(_DEPTHS)))
+        plan[os.path.normpath(path.strip('/\\'))] = depth
+    return plan
+
+
+def _sparse_checkout(wc, remote, paths, runasUsername, runasPassword, username, password,
+                     certCheck, revision, opts):
+    '''
+    Check out ``remote`` to ``wc`` with an empty depth, then bring every
+    path of the plan to its depth with one ``svn update --set-depth
+    --parents`` per depth. Paths already at their depth are left alone,
+    so calling it again with more paths only fetches the new ones.
+    '''
+    plan = _depth_plan(paths)
+    ret = {'checkout': False, 'set_depth': {}, 'unchanged': []}
+    if not os.path.isdir(os.path.join(wc, '.svn')):
+        _run_svn('checkout', remote, runasUsername, runasPassword, username, password,
+                 certCheck, revision, opts + (wc, '--depth', 'empty'))
+        ret['checkout'] = True
+
+    # Depth of the paths already there, and the working copy revision so
+    # new paths do not come from a newer one
+    targets = dict((os.path.normpath(os.path.join(wc, path)), path) for path in plan
+                   if os.path.exists(os.path.join(wc, path)))
+    current = {}
+    lines = _run_svn('info', wc, runasUsername, runasPassword, username, password, certCheck,
+                     opts=tuple(sorted(targets)) + ('--xml',), stream=True, encoding='utf-8')
+    for record in _info_records(lines):
+        path = os.path.normpath(record['path'])
+        if path == os.path.normpath(wc):
+            revision = revision or record['revision']
+        elif path in targets:
+            current[targets[path]] = 'infinity' if record['kind'] == 'file' else record['depth']
+
+    groups = {}
+    for path, depth in sorted(six.iteritems(plan)):
+        if current.get(path) == depth or (depth == 'exclude' and path not in current):
+            ret['unchanged'].append(path)
+        else:
+            groups.setdefault(depth, []).append(os.path.join(wc, path))
+            ret['set_depth'][path] = depth
+    for depth, group in sorted(six.iteritems(groups)):
+        update_opts = tuple(group[1:]) + ('--set-depth', depth)
+        if depth != 'exclude':
+            update_opts += ('--parents',)
+        _run_svn('update', group[0], runasUsername, runasPassword, username, password,
+                 certCheck, revision, update_opts)
+    return ret
+
+
+def checkout(cwd,
+             remote,
+             target=None,
+             runasUsername=None,
+             runasPassword=None,
+             username=None,
+             password=None,
+             certCheck=True,
+             revision='',
+             *opts,
+             **kwargs):
+    '''
+    Execute svn checkout command
+
+    paths
+        Sparse checkout: only these paths of ``remote`` are checked out
+        into ``cwd`` (or ``cwd\\target``). A list (or comma separated
+        string) of paths fetched fully, or a dict of path to depth
+        (``empty``, ``files``, ``immediates``, ``infinity`` or
+        ``exclude``). The parent directories are created empty. On an
+        existing working copy only the paths not yet at their depth are
+        fetched, at the revision of the working copy unless ``revision``
+        is given, so a role can be extended path by path.
+
+        Returns ``checkout`` (True when the working copy was created),
+        the paths brought to a new depth under ``set_depth`` and the
+        ``unchanged`` ones.
+
+        salt '*' xjoker_svn.checkout 'd:\\web\\assets' https://svn.example.com/repo/assets paths='[images/shop, css]'
+        salt '*' xjoker_svn.checkout 'd:\\web\\assets' https://svn.example.com/repo/assets paths='{fonts: files, images/old: exclude}'
+    '''
+    paths = salt.utils.clean_kwargs(**kwargs).get('paths')
+    if paths:
+        wc = os.path.join(cwd, target) if target else cwd
+        return _sparse_checkout(wc, remote, paths, runasUsername, runasPassword, username,
+                                password, certCheck, revision, opts)
+    opts += (remote,)
+    if target:
+        opts += (target,)
+    if not os.path.exists(cwd):
+        os.mkdir(cwd)
+    return _run_svn('checkout', cwd, runasUsername, runasPassword,username, password,certCheck,revision,opts)
+
+def info(cwd,
+         targets=None,
+         runasUsername=None,
+         runasPassword=None,
+         username=None,
+         password=None,
+         fmt='str'):
+    '''
+    Execute svn info command
+
+    fmt
+        ``str`` (default) returns the svn output and ``xml`` the
+        ``--xml`` output. ``dict`` returns one record per path with the
+        ``path``, ``kind``, ``revision``, ``url``, ``relative_url``,
+        ``repository_root``, ``repository_uuid``, ``wc_root``,
+        ``schedule``, ``depth``, ``last_changed_rev``,
+        ``last_changed_author``, ``last_changed_date`` and ``lock``, read
+        from the ``--xml`` output so it does not depend on the svn
+        language. ``list`` returns the same records as sorted
+        ``(key, value)`` lists.
+
+        salt '*' xjoker_svn.info 'd:\\web\\shop' fmt=dict
+    '''
+    if fmt not in _INFO_FMTS:
+        raise exceptions.SaltInvocationError(
+            "Invalid fmt '{0}'. Valid: {1}".format(fmt, ', '.join(_INFO_FMTS)))
+    opts = list()
+    if fmt != 'str':
+        opts.append('--xml')
+    if targets:
+        opts += salt.utils.shlex_split(targets)
+    if fmt in ('str', 'xml'):
+        return _run_svn('info', cwd, runasUsername, runasPassword, username, password, opts=opts)
+
+    records = _info_records(_run_svn('info', cwd, runasUsername, runasPassword, username,
+                                     password, opts=opts, stream=True, encoding='utf-8'))
+    if fmt == 'list':
+        return [sorted(record.items()) for record in records]
+    return list(records)
+
+def switch(cwd,
+           remote,
+           target=None,
+           runasUsername=None,
+           runasPassword=None,
+           username=None,
+           password=None,
+           *opts):
+    opts += (remote,)
+    if target:
+        opts += (target,)
+    return _run_svn('switch', cwd, runasUsername, runasPassword, username, password, opts=opts)
+
+def diff(cwd,
+         targets=None,
+         runasUsername=None,
+         runasPassword=None,
+         username=None,
+         password=None,
+         *opts):
+    if targets:
+        opts += tuple(salt.utils.shlex_split(targets))
+    return _run_svn('diff', cwd,  runasUsername, runasPassword,username, password, opts=opts)
+
+def commit(cwd,
+           targets=None,
+           runasUsername=None,
+           runasPassword=None,
+           msg=None,
+           username=None,
+           password=None,
+           *opts):
+    if msg:
+        opts += ('-m', msg)
+    if targets:
+        opts += tuple(salt.utils.shlex_split(targets))
+    return _run_svn('commit', cwd,  runasUsername, runasPassword,username, password, opts=opts)
+
+def add(cwd,
+        targets,
+        runasUsername=None,
+        runasPassword=None,
+        username=None,
+        password=None,
+        *opts):
+    if targets:
+        opts += tuple(salt.utils.shlex_split(targets))
+    return _run_svn('add', cwd,  runasUsername, runasPassword,username, password, opts=opts)
+
+def remove(cwd,
+           targets,
+           runasUsername=None,
+           runasPassword=None,
+           msg=None,
+           username=None,
+           password=None,
+           *opts):
+    if msg:
+        opts += ('-m', msg)
+    if targets:
+        opts += tuple(salt.utils.shlex_split(targets))
+    return _run_svn('remove', cwd,  runasUsername, runasPassword,username, password, opts=opts)
+
+def status(cwd,
+           targets=None,
+           runasUsername=None,
+           runasPassword=None,
+           username=None,
+           password=None,
+           *opts,
+           **kwargs):
+    '''
+    Execute svn status command
+
+    fmt
+        ``str`` (default) returns the svn output. ``records`` returns a
+        list with ``path``, ``item``, ``action`` and ``props`` codes,
+        ``revision``, ``locked``, ``history``, ``switched``,
+        ``tree_conflict``, ``lock``, ``changelist`` and the
+        ``last_changed_*`` commit per path, and ``summary`` just the
+        ``total``, the counts per ``actions`` and ``props`` code and the
+        ``conflicts`` paths. Both parse the ``--xml`` output while svn
+        runs, so the svn language does not matter.
+
+        salt '*' xjoker_svn.status 'd:\\web\\shop' fmt=summary
+    '''
+    fmt = _fmt(kwargs)
+    if targets:
+        opts += tuple(salt.utils.shlex_split(targets))
+    if fmt == 'str':
+        return _run_svn('status', cwd,  runasUsername, runasPassword,username, password, opts=opts)
+
+    records = _status_records(_run_svn('status', cwd, runasUsername, runasPassword, username,
+                                       password, opts=opts + ('--xml',), stream=True,
+                                       encoding='utf-8'))
+    if fmt == 'summary':
+        return _summarize(records)
+    return list(records)
+
+def log(cwd,
+        targets=None,
+        runasUsername=None,
+        runasPassword=None,
+        username=None,
+        password=None,
+        revision='',
+        limit=None,
+        verbose=False,
+        *opts):
+    '''
+    Execute svn log command
+
+    Returns one record per revision with the ``revision``, ``author``,
+    ``date``, ``timestamp`` and ``message``, plus the changed ``paths``
+    (``path``, ``action``, ``kind``, ``copyfrom_path``, ``copyfrom_rev``)
+    when ``verbose`` is True. The ``--xml`` output is parsed while svn
+    runs.
+
+    revision
+        Revision or range, e.g. ``1200:HEAD``
+
+    limit
+        Only the first ``limit`` log entries
+
+        salt '*' xjoker_svn.log 'd:\\web\\shop' revision='HEAD:1' limit=10 verbose=True
+    '''
+    opts += ('--xml',)
+    if limit:
+        opts += ('--limit', str(limit))
+    if verbose:
+        opts += ('--verbose',)
+    if targets:
+        opts += tuple(salt.utils.shlex_split(targets))
+    return list(_log_records(_run_svn('log', cwd, runasUsername, runasPassword, username,
+                                      password, revision=revision, opts=opts, stream=True,
+                                      encoding='utf-8')))
+
+def _diff_summarize(remote, old, new, runasUsername, runasPassword, username, password):
+    '''
+    Paths changed in ``remote`` between revisions ``old`` and ``new``,
+    from ``svn diff --summarize --xml``: ``path`` relative to ``remote``,
+    ``item`` (``added``, ``modified``, ``deleted``), ``props`` and ``kind``
+    '''
+    lines = _run_svn('diff', '{0}@{1}'.format(remote, new), runasUsername, runasPassword, username, password,
+                     revision='{0}:{1}'.format(old, new), opts=('--summarize', '--xml'),
+                     stream=True, encoding='utf-8')
+    base = remote.rstrip('/')
+    for elem, _ in _iterxml(lines, 'path'):
+        path = elem.text or ''
+        if path.startswith(base):
+            path = path[len(base):]
+        yield {
+            'path': path.strip('/'),
+            'item': elem.get('item'),
+            'props': elem.get('props'),
+            'kind': elem.get('kind'),
+        }
+
+
+def _resolve_revision(remote, revision, runasUsername, runasPassword, username, password):
+    '''
+    Number of ``revision`` (``HEAD``, a date, ...) of ``remote``
+    '''
+    if str(revision).isdigit():
+        return int(revision)
+    lines = _run_svn('info', '{0}@{1}'.format(remote, revision), runasUsername, runasPassword,
+                     username, password, opts=('--xml',), stream=True, encoding='utf-8')
+    records = list(_info_records(lines))
+    if not records or records[0]['revision'] is None:
+        raise exceptions.CommandExecutionError(
+            'Unable to resolve revision {0} of {1}'.format(revision, remote))
+    return records[0]['revision']
+
+
+def _arg_groups(paths, limit=_ARGS_MAX):
+    '''
+    Split ``paths`` into lists short enough for one command line
+    '''
+    group = []
+    size = 0
+    for path in paths:
+        if group and size + len(path) + 3 > limit:
+            yield group
+            group = []
+            size = 0
+        group.append(path)
+        size += len(path) + 3
+    if group:
+        yield group
+
+
+def _export_changed(dest, remote, old, new, runasUsername, runasPassword, username, password,
+                    concurrency, opts):
+    '''
+    Export the files added or modified in ``remote`` between ``old`` and
+    ``new`` to the same relative paths under ``dest``.
+
+    ``new`` is resolved to a number first, so the diff and every file come
+    from the same revision. The files are fetched into empty-depth
+    staging working copies below ``dest`` with ``svn update --parents``,
+    many paths per command, then moved into place. Large change sets are
+    split across ``concurrency`` staging working copies.
+    '''
+    start = time.time()
+    new = _resolve_revision(remote, new, runasUsername, runasPassword, username, password)
+    ret = {'result': True, 'revision': new, 'since': old, 'exported': [], 'deleted': [],
+           'errors': {}}
+    files = []
+    for change in _diff_summarize(remote, old, new, runasUsername, runasPassword, username,
+                                  password):
+        if not change['path']:
+            # Property change of remote itself
+            continue
+        local = os.path.join(dest, os.path.normpath(change['path']))
+        if change['item'] == 'deleted':
+            ret['deleted'].append(change['path'])
+        elif change['kind'] == 'dir':
+            if not os.path.isdir(local):
+                os.makedirs(local)
+        elif change['item'] in ('added', 'modified', 'replaced') or change['props'] == 'modified':
+            files.append(change['path'])
+
+    workers = max(1, min(int(concurrency), -(-len(files) // _EXPORT_CHUNK)))
+    files.sort()
+    size = -(-len(files) // workers) if files else 0
+    chunks = [files[idx:idx + size] for idx in range(0, len(files), size or 1)]
+
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    # Below dest, so the files are moved within one volume and the runas
+    # user can write there
+    staging = tempfile.mkdtemp(prefix='.xjoker-export-', dir=dest)
+    moved = set()
+
+    def _fetch(idx):
+        wc = os.path.join(staging, str(idx))
+        _run_svn('checkout', '{0}@{1}'.format(remote, new), runasUsername, runasPassword,
+                 username, password, revision=new, opts=opts + (wc, '--depth', 'empty'))
+        # A trailing @ keeps an @ in a file name from being read as a peg
+        # revision
+        paths = [os.path.join(wc, os.path.normpath(x)) + ('@' if '@' in x else '')
+                 for x in chunks[idx]]
+        for group in _arg_groups(paths):
+            _run_svn('update', group[0], runasUsername, runasPassword, username, password,
+                     revision=new, opts=tuple(group[1:]) + ('--parents',))
+        missing = []
+        for path in chunks[idx]:
+            source = os.path.join(wc, os.path.normpath(path))
+            local = os.path.join(dest, os.path.normpath(path))
+            if not os.path.isfile(source):
+                missing.append(path)
+                continue
+            if not os.path.isdir(os.path.dirname(local)):
+                os.makedirs(os.path.dirname(local))
+            if os.path.exists(local):
+                os.remove(local)
+            shutil.move(source, local)
+            moved.add(path)
+        if missing:
+            return False, 'Not fetched: {0}'.format(', '.join(missing))
+        return True, ''
+
+    try:
+        items = __utils__['xjoker_runner.parallel'](range(len(chunks)), _fetch, concurrency)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    for idx, chunk in enumerate(chunks):
+        for path in chunk:
+            if path in moved:
+                ret['exported'].append(path)
+            else:
+                ret['errors'][path] = items[idx]['comment']
+    ret['result'] = not ret['errors']
+    ret['duration'] = round(time.time() - start, 3)
+    return ret
+
+
+def export(cwd,
+           remote,
+           target=None,
+           runasUsername=None,
+           runasPassword=None,
+           username=None,
+           password=None,
+           revision='HEAD',
+           *opts,
+           **kwargs):
+    '''
+    Execute svn export command
+
+    since
+        Only export the files of ``remote`` added or modified between
+        revision ``since`` and ``revision``, from ``svn diff --summarize``,
+        to the same relative paths under ``cwd`` (or ``cwd\\target``).
+        ``revision`` is resolved to a number once, so every file comes
+        from the same revision. The files are fetched many per svn
+        command into staging working copies, large change sets on up to
+        ``concurrency`` (``xjoker_svn:concurrency`` or 4) of them at
+        once; ``opts`` go to their checkout. Deleted paths are only
+        listed, nothing is removed.
+
+        Returns the ``result``, ``revision``, ``since``, the ``exported``
+        and ``deleted`` paths, ``errors`` per path and the ``duration``.
+
+        salt '*' xjoker_svn.export 'd:\\deploy\\patch' https://svn.example.com/repo/trunk revision=1240 since=1234
+    '''
+    kwargs = salt.utils.clean_kwargs(**kwargs)
+    if kwargs.get('since') not in (None, ''):
+        if revision in (None, ''):
+            revision = 'HEAD'
+        concurrency = kwargs.get('concurrency') or \
+            __salt__['config.get']('xjoker_svn:concurrency', 4)
+        dest = os.path.join(cwd, target) if target else cwd
+        return _export_changed(dest, remote, kwargs['since'], revision, runasUsername,
+                               runasPassword, username, password, concurrency, opts)
+    opts += (remote,)
+    if target:
+        opts += (target,)
+    return _run_svn('export', cwd,  runasUsername, runasPassword,username, password,revision=revision, opts=opts)
\ No newline at end of file
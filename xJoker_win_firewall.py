@@ -5,13 +5,13 @@ Module for configuring Windows Firewall
 from __future__ import absolute_import
 
 # Import python libs
-import re
+import fnmatch
 import logging
-import subprocess
+import os
+import time
 
 # Import salt libs
 import salt.utils
-from salt.ext import six
 from salt import exceptions
 
 # Define the module's virtual name
@@ -19,50 +19,356 @@ __virtualname__ = 'xjoker_firewall'
 
 log = logging.getLogger(__name__)
 
+_INVENTORY_KEY = 'xjoker_firewall.inventory'
+
+# HNetCfg.FwPolicy2 values, the same on every Windows language
+_PROTOCOLS = {'1': 'icmpv4', '6': 'tcp', '17': 'udp', '58': 'icmpv6', '256': 'any'}
+_DIRECTIONS = {'1': 'in', '2': 'out'}
+_ACTIONS = {'0': 'block', '1': 'allow'}
+_PROFILES = ((1, 'domain'), (2, 'private'), (4, 'public'))
+
+_ALL_PROFILES = ('domain', 'private', 'public')
+
+_RULE_FIELDS = ('Name', 'Direction', 'Protocol', 'LocalPorts', 'RemotePorts',
+                'LocalAddresses', 'RemoteAddresses', 'Action', 'Enabled', 'Profiles',
+                'Grouping', 'ApplicationName', 'ServiceName', 'EdgeTraversal')
 
-# base cmd
-cmd = ['chcp','936', '>', 'nul' ,'&','netsh', 'advfirewall']
 
 def __virtual__():
     '''
     Only works on Windows systems
     '''
     if salt.utils.is_windows():
+        if 'xjoker_runner.run' not in __utils__:
+            return (False, "Module win_firewall: the xjoker_runner utils module is missing")
+        __utils__['xjoker_runner.instrument'](globals(), __virtualname__)
         return __virtualname__
     return (False, "Module win_firewall: module only works on Windows systems")
 
 
-def _cmd_run(cmd):
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.PIPE)
+def _cmd_run(args):
+    '''
+    Run ``netsh advfirewall`` with ``args``
+    '''
+    cmd = ['netsh', 'advfirewall']
+    cmd.extend(args)
+    return __utils__['xjoker_runner.run'](cmd, label='netsh')
+
+
+def _cmd_ok(args):
+    '''
+    Run ``netsh advfirewall`` with ``args`` and tell from the exit code
+    whether it worked, the messages are in the Windows language
+    '''
+    try:
+        _cmd_run(args)
+    except exceptions.CommandExecutionError as exc:
+        log.error('netsh advfirewall %s failed: %s', ' '.join(args), exc)
+        return False
+    return True
+
+
+def _powershell(script):
+    return __utils__['xjoker_runner.powershell'](
+        script,
+        persistent=__salt__['config.get']('xjoker_firewall:pshost', True),
+        label='firewall')
+
+
+def _any(value):
+    return 'any' if value in ('', '*') else value
+
+
+def _rule_record(row):
+    '''
+    Firewall rule of the COM dump with the values netsh takes
+    '''
+    profiles = int(row['Profiles'] or 0)
+    return {
+        'name': row['Name'],
+        'direction': _DIRECTIONS.get(row['Direction'], row['Direction']),
+        'protocol': _PROTOCOLS.get(row['Protocol'], row['Protocol']),
+        'localport': _any(row['LocalPorts']),
+        'remoteport': _any(row['RemotePorts']),
+        'localip': _any(row['LocalAddresses']),
+        'remoteip': _any(row['RemoteAddresses']),
+        'action': _ACTIONS.get(row['Action'], row['Action']),
+        'enabled': row['Enabled'] == 'True',
+        'profiles': [name for bit, name in _PROFILES if profiles & bit],
+        'group': row['Grouping'] or None,
+        'program': row['ApplicationName'] or None,
+        'service': row['ServiceName'] or None,
+        'edge': row['EdgeTraversal'] == 'True',
+    }
+
+
+def _port_ranges(value):
+    '''
+    ``(low, high)`` port ranges of a LocalPorts/RemotePorts value. ``any``
+    is None, keywords like ``RPC`` or ``IPHTTPS`` are skipped.
+    '''
+    if value == 'any':
+        return None
+    ranges = []
+    for part in value.split(','):
+        low, _, high = part.strip().partition('-')
+        if low.isdigit() and (not high or high.isdigit()):
+            ranges.append((int(low), int(high or low)))
+    return ranges
+
+
+def _index(rules):
+    '''
+    Index the rules by lower case name and by ``protocol:direction``, the
+    latter with single ``ports``, port ``ranges`` and rules for ``any``
+    port
+    '''
+    inventory = {'rules': [], 'names': {}, 'ports': {}}
+    for rule in rules:
+        _index_rule(inventory, rule)
+    return inventory
+
+
+def _index_rule(inventory, rule):
+    idx = len(inventory['rules'])
+    inventory['rules'].append(rule)
+    inventory['names'].setdefault(rule['name'].lower(), []).append(idx)
+    key = '{0}:{1}'.format(rule['protocol'], rule['direction'])
+    ports = inventory['ports'].setdefault(key, {'ports': {}, 'ranges': [], 'any': []})
+    ranges = _port_ranges(rule['localport'])
+    if ranges is None:
+        ports['any'].append(idx)
+        return
+    for low, high in ranges:
+        if low == high:
+            ports['ports'].setdefault(low, []).append(idx)
+        else:
+            ports['ranges'].append((low, high, idx))
+
+
+def _read_inventory():
+    pscmd = []
+    pscmd.append(r'(New-Object -ComObject HNetCfg.FwPolicy2).Rules')
+    pscmd.append(r' | Select-Object {0}'.format(','.join(_RULE_FIELDS)))
+    pscmd.append(r' | ConvertTo-Csv -NoTypeInformation')
+    rows = __utils__['xjoker_runner.csv_rows'](_powershell(''.join(pscmd)).splitlines())
+    return _index([_rule_record(row) for row in rows])
+
+
+def _inventory(refresh=False):
+    '''
+    Return the rule inventory cached in ``__context__``, reading it again
+    when it is older than ``xjoker_firewall:inventory_ttl`` seconds
+    '''
+    ttl = __salt__['config.get']('xjoker_firewall:inventory_ttl', 60)
+    cached = __context__.get(_INVENTORY_KEY)
+    if not refresh and cached and time.time() - cached[0] < ttl:
+        __utils__['xjoker_runner.count']('cache_hits')
+        return cached[1]
+    log.debug('Reading firewall rule inventory')
+    inventory = _read_inventory()
+    __utils__['xjoker_runner.count']('cache_misses')
+    __context__[_INVENTORY_KEY] = (time.time(), inventory)
+    return inventory
+
+
+def _invalidate_inventory():
+    __context__.pop(_INVENTORY_KEY, None)
+
+
+def _ports_key(value):
+    value = _any(str(value).replace(' ', '').lower())
+    return ','.join(sorted(value.split(',')))
 
-    stdout, stderr = p.communicate()
-    if p.returncode == 0:
-        return stdout.decode('cp936').encode('utf-8')
 
-    raise exceptions.CommandExecutionError(stdout.decode('cp936').encode('utf-8') + '\n\n')
+def _address_key(value):
+    '''
+    Addresses in the form the COM object returns them: single IPv4
+    addresses and prefix lengths become ``address/mask``
+    '''
+    value = _any(str(value).replace(' ', '').lower())
+    parts = []
+    for part in value.split(','):
+        address, _, mask = part.partition('/')
+        if address.count('.') == 3 and '-' not in address and all(
+                x.isdigit() for x in address.split('.')):
+            if not mask:
+                mask = '32'
+            if mask.isdigit():
+                bits = (0xffffffff << (32 - int(mask))) & 0xffffffff
+                mask = '.'.join(str((bits >> shift) & 0xff) for shift in (24, 16, 8, 0))
+            part = '{0}/{1}'.format(address, mask)
+        parts.append(part)
+    return ','.join(sorted(parts))
+
+
+def _rule_key(rule):
+    '''
+    What makes two rules of the same name equal: an inventory record or
+    the normalized arguments of ``add_rule`` (see ``_desired_rule``)
+    '''
+    return (
+        rule['direction'],
+        rule['protocol'],
+        'any' if rule['protocol'].startswith('icmp') else _ports_key(rule['localport']),
+        _ports_key(rule['remoteport']),
+        _address_key(rule['localip']),
+        _address_key(rule['remoteip']),
+        rule['action'],
+        rule['enabled'],
+        tuple(sorted(rule['profiles'])),
+        rule['program'],
+        rule['service'],
+    )
+
+
+def _desired_rule(name, localport='any', protocol='tcp', action='allow', dir='in',
+                  remoteip='any'):
+    '''
+    Rule as ``add_rule`` creates it, in the form of an inventory record
+    '''
+    protocol = str(protocol).lower()
+    return {
+        'name': name,
+        'direction': str(dir).lower(),
+        'protocol': protocol,
+        'localport': 'any' if protocol.startswith('icmp') else str(localport).replace(' ', ''),
+        'remoteport': 'any',
+        'localip': 'any',
+        'remoteip': str(remoteip),
+        'action': str(action).lower(),
+        'enabled': True,
+        'profiles': list(_ALL_PROFILES),
+        'group': None,
+        'program': None,
+        'service': None,
+        'edge': False,
+    }
+
+
+def _add_rule_args(rule):
+    args = ['name={0}'.format(rule['name']),
+            'protocol={0}'.format(rule['protocol']),
+            'dir={0}'.format(rule['direction']),
+            'action={0}'.format(rule['action']),
+            'remoteip={0}'.format(rule['remoteip'])]
+    if 'icmpv4' not in rule['protocol'] and 'icmpv6' not in rule['protocol']:
+        args.append('localport={0}'.format(rule['localport']))
+    return args
+
+
+def _script_line(args):
+    '''
+    netsh script line of ``advfirewall firewall`` arguments, with the
+    values containing spaces quoted. netsh has no way to escape a double
+    quote, so values with one (or a line break) are refused.
+    '''
+    line = ['advfirewall', 'firewall']
+    for arg in args:
+        if any(c in arg for c in '"\r\n'):
+            raise exceptions.SaltInvocationError(
+                'netsh can not take a double quote or line break in {0}'.format(arg))
+        key, sep, value = arg.partition('=')
+        if sep and (' ' in value or not value):
+            arg = '{0}="{1}"'.format(key, value)
+        line.append(arg)
+    return ' '.join(line)
+
+
+def _ruleset_plan(rules, prune, inventory):
+    '''
+    Names whose rules are not exactly the desired ones (or match
+    ``prune`` and are not desired at all) and the desired rules per name
+    '''
+    desired = {}
+    for rule in rules:
+        if not isinstance(rule, dict) or not rule.get('name'):
+            raise exceptions.SaltInvocationError('Every rule needs a name: {0}'.format(rule))
+        rule = dict(rule)
+        if 'direction' in rule:
+            rule['dir'] = rule.pop('direction')
+        try:
+            record = _desired_rule(**rule)
+        except TypeError as exc:
+            raise exceptions.SaltInvocationError('Invalid rule {0}: {1}'.format(rule, exc))
+        desired.setdefault(record['name'], []).append(record)
+
+    current = {}
+    for record in inventory['rules']:
+        current.setdefault(record['name'], []).append(record)
+
+    remove = []
+    add = []
+    unchanged = []
+    for name in sorted(desired):
+        want = sorted(_rule_key(x) for x in desired[name])
+        have = sorted(_rule_key(x) for x in current.get(name, []))
+        if want == have:
+            unchanged.append(name)
+            continue
+        if have:
+            remove.append(name)
+        add.extend(desired[name])
+    if prune:
+        remove.extend(name for name in sorted(current)
+                      if name not in desired and fnmatch.fnmatch(name, prune))
+    return remove, add, unchanged
+
+
+def _run_script(lines):
+    '''
+    Run netsh commands as one ``netsh -f`` script
+    '''
+    path = salt.utils.mkstemp(suffix='.netsh')
+    try:
+        # netsh reads scripts in the ANSI code page
+        encoding = 'mbcs' if salt.utils.is_windows() else 'utf-8'
+        with salt.utils.fopen(path, 'wb') as fp_:
+            fp_.write(u'\r\n'.join(lines + ['']).encode(encoding))
+        return __utils__['xjoker_runner.run'](['netsh', '-f', path], label='netsh',
+                                              ok_codes=(0, 1))
+    finally:
+        os.remove(path)
+
+
+def _port_rules(inventory, port, protocol, direction):
+    '''
+    Indexes of the rules covering ``port`` for ``protocol`` and
+    ``direction``, including rules for any protocol or any port
+    '''
+    found = set()
+    for proto in set([protocol, 'any']):
+        ports = inventory['ports'].get('{0}:{1}'.format(proto, direction))
+        if not ports:
+            continue
+        found.update(ports['any'])
+        found.update(ports['ports'].get(port, []))
+        found.update(idx for low, high, idx in ports['ranges'] if low <= port <= high)
+    return sorted(found)
 
 def get_config():
     '''
     Get the status of all the firewall profiles
 
+    Returns ``Domain Profile``, ``Private Profile`` and ``Public Profile``
+    with True when the firewall is on, read from the HNetCfg.FwPolicy2
+    COM object so the Windows language does not matter.
+
     CLI Example:
 
     .. code-block:: bash
 
         salt '*' firewall.get_config
     '''
+    pscmd = []
+    pscmd.append(r'$fw = New-Object -ComObject HNetCfg.FwPolicy2; ')
+    pscmd.append(r'foreach ($p in 1,2,4) { "$p,$($fw.FirewallEnabled($p))" }')
     profiles = {}
-    curr = None
-    cmd.extend(['show', 'allprofiles'])
-    for line in _cmd_run(cmd).splitlines():
-        if not curr:
-            tmp = re.search('(.*) 设置:', line)
-            if tmp:
-                curr = tmp.group(1)
-        elif line.startswith('状态'):
-            profiles[curr] = line.split()[1] == '打开'
-            curr = None
-
+    names = dict((str(bit), name) for bit, name in _PROFILES)
+    for line in _powershell(''.join(pscmd)).splitlines():
+        bit, _, state = line.strip().partition(',')
+        if bit in names:
+            profiles['{0} Profile'.format(names[bit].capitalize())] = state == 'True'
     return profiles
 
 
@@ -76,8 +382,7 @@ def disable(profile='allprofiles'):
 
         salt '*' firewall.disable
     '''
-    cmd.extend(['set', profile, 'state', 'off'])
-    return _cmd_run(cmd) == 'Ok.'
+    return _cmd_ok(['set', profile, 'state', 'off'])
 
 
 def enable(profile='allprofiles'):
@@ -92,8 +397,7 @@ def enable(profile='allprofiles'):
 
         salt '*' firewall.enable
     '''
-    cmd.extend(['set', profile, 'state', 'on'])
-    return _cmd_run(cmd) == 'Ok.'
+    return _cmd_ok(['set', profile, 'state', 'on'])
 
 
 def get_rule(name='all'):
@@ -102,19 +406,30 @@ def get_rule(name='all'):
 
     Get firewall rule(s) info
 
+    Returns the ``netsh`` description of the rules, or False when no rule
+    matches. Whether one matches is looked up in the rule inventory.
+
     CLI Example:
 
     .. code-block:: bash
 
         salt '*' firewall.get_rule 'MyAppPort'
     '''
-    ret = {}
-    cmd.extend(['firewall','show', 'rule', 'name={0}'.format(name)])
-    ret[name] = _cmd_run(cmd)
-
-    if ret[name].strip() == 'No rules match the specified criteria.':
-        ret = False
+    inventory = _inventory()
+    if name == 'all':
+        found = bool(inventory['rules'])
+    else:
+        found = name.lower() in inventory['names']
+    if not found:
+        return False
 
+    ret = {}
+    try:
+        ret[name] = _cmd_run(['firewall', 'show', 'rule', 'name={0}'.format(name)])
+    except exceptions.CommandExecutionError:
+        # Removed since the inventory was read
+        _invalidate_inventory()
+        return False
     return ret
 
 
@@ -123,7 +438,8 @@ def add_rule(name, localport, protocol='tcp', action='allow', dir='in',
     '''
     .. versionadded:: 2015.5.0
 
-    Add a new firewall rule
+    Add a new firewall rule, unless a rule of that name with the same
+    settings exists already
 
     CLI Example:
 
@@ -135,22 +451,22 @@ def add_rule(name, localport, protocol='tcp', action='allow', dir='in',
 
     '''
 
-    cmd.extend(['firewall', 'add', 'rule',
-           'name={0}'.format(name),
-           'protocol={0}'.format(protocol),
-           'dir={0}'.format(dir),
-           'action={0}'.format(action),
-           'remoteip={0}'.format(remoteip)])
+    rule = _desired_rule(name, localport, protocol, action, dir, remoteip)
+    key = _rule_key(rule)
+    inventory = _inventory()
+    for idx in inventory['names'].get(name.lower(), []):
+        if inventory['rules'][idx]['name'] == name and _rule_key(inventory['rules'][idx]) == key:
+            log.debug('Firewall rule %s already exists', name)
+            return True
 
-    if 'icmpv4' not in protocol and 'icmpv6' not in protocol:
-        cmd.append('localport={0}'.format(localport))
-
-    ret = _cmd_run(cmd)
-    if isinstance(ret, six.string_types):
-        return ret.strip() == 'Ok.'
-    else:
-        log.error('firewall.add_rule failed: {0}'.format(ret))
-        return False
+    if _cmd_ok(['firewall', 'add', 'rule'] + _add_rule_args(rule)):
+        # Index the new rule instead of reading all rules again
+        cached = __context__.get(_INVENTORY_KEY)
+        if cached:
+            _index_rule(cached[1], rule)
+        return True
+    _invalidate_inventory()
+    return False
 
 
 def delete_rule(name, localport, protocol='tcp', dir='in', remoteip='any'):
@@ -167,18 +483,180 @@ def delete_rule(name, localport, protocol='tcp', dir='in', remoteip='any'):
         salt '*' firewall.delete_rule 'test_remote_ip' '8000' 'tcp' 'in' '192.168.0.1'
     '''
 
-    cmd.extend(['firewall', 'delete', 'rule',
+    cmd = ['firewall', 'delete', 'rule',
            'name={0}'.format(name),
            'protocol={0}'.format(protocol),
            'dir={0}'.format(dir),
-           'remoteip={0}'.format(remoteip)])
+           'remoteip={0}'.format(remoteip)]
 
     if 'icmpv4' not in protocol and 'icmpv6' not in protocol:
         cmd.append('localport={0}'.format(localport))
 
-    ret = _cmd_run(cmd)
-    if isinstance(ret, six.string_types):
-        return ret.endswith('Ok.')
+    _invalidate_inventory()
+    return _cmd_ok(cmd)
+
+
+def list_rules(name=None, port=None, protocol=None, direction=None, refresh=False):
+    '''
+    List firewall rules from the rule inventory
+
+    Every rule has the ``name``, ``direction`` (in, out), ``protocol``
+    (tcp, udp, icmpv4, icmpv6, any or the number), ``localport``,
+    ``remoteport``, ``localip``, ``remoteip``, ``action`` (allow, block),
+    ``enabled``, ``profiles``, ``group``, ``program``, ``service`` and
+    ``edge``. The values are the ones ``netsh`` takes, whatever the
+    Windows language.
+
+    The inventory is read once through the HNetCfg.FwPolicy2 COM object
+    and cached for ``xjoker_firewall:inventory_ttl`` seconds (default 60)
+    or until ``add_rule``/``delete_rule`` change the rules.
+    ``refresh=True`` reads it again.
+
+    name
+        Rule name, case insensitive
+
+    port
+        Local port the rule covers, ``protocol`` defaults to tcp then
+
+    protocol, direction
+        Only rules for this protocol and direction
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_firewall.list_rules
+        salt '*' xjoker_firewall.list_rules port=8080 direction=in
+    '''
+    inventory = _inventory(refresh)
+    if port is not None:
+        protocol = (protocol or 'tcp').lower()
+        directions = [direction.lower()] if direction else list(_DIRECTIONS.values())
+        found = set()
+        for dir_ in directions:
+            found.update(_port_rules(inventory, int(port), protocol, dir_))
+        indexes = sorted(found)
+    elif name is not None:
+        indexes = inventory['names'].get(name.lower(), [])
     else:
-        log.error('firewall.delete_rule failed: {0}'.format(ret))
-        return False
\ No newline at end of file
+        indexes = range(len(inventory['rules']))
+
+    ret = []
+    for idx in indexes:
+        rule = inventory['rules'][idx]
+        if name is not None and rule['name'].lower() != name.lower():
+            continue
+        if protocol and rule['protocol'] not in (protocol.lower(), 'any'):
+            continue
+        if direction and rule['direction'] != direction.lower():
+            continue
+        ret.append(rule)
+    return ret
+
+
+def is_port_open(port, protocol='tcp', direction='in', profile=None, refresh=False):
+    '''
+    Whether the enabled firewall rules let ``port`` through
+
+    A port is open when an enabled allow rule covers it and no enabled
+    block rule does, as blocking wins in Windows Firewall. Without any
+    matching rule inbound ports are closed and outbound ones open, the
+    Windows defaults. ``profile`` (domain, private, public) only looks
+    at the rules of that profile. Answered from the rule inventory, see
+    ``xjoker_firewall.list_rules``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_firewall.is_port_open 8080
+        salt '*' xjoker_firewall.is_port_open 53 udp out profile=domain
+    '''
+    inventory = _inventory(refresh)
+    actions = set()
+    for idx in _port_rules(inventory, int(port), protocol.lower(), direction.lower()):
+        rule = inventory['rules'][idx]
+        if rule['enabled'] and (profile is None or profile.lower() in rule['profiles']):
+            actions.add(rule['action'])
+    if 'block' in actions:
+        return False
+    if 'allow' in actions:
+        return True
+    return direction.lower() == 'out'
+
+
+def apply_ruleset(rules, prune=None, test=False):
+    '''
+    Bring the firewall to a set of rules with one netsh run
+
+    rules
+        List of rules with the ``add_rule`` arguments: ``name``,
+        ``localport``, ``protocol`` (tcp), ``action`` (allow), ``dir`` (in)
+        and ``remoteip`` (any). Several rules may share a name.
+
+    prune
+        Name glob, e.g. ``salt-*``. Existing rules matching it that are
+        not in ``rules`` are deleted.
+
+    test
+        Only return what would change
+
+    The rules are compared with the rule inventory per name: names whose
+    existing rules differ from the desired ones in any setting (or are
+    duplicated) are deleted and added again, missing ones are added and
+    matching ones are left alone. All deletions and additions run as one
+    ``netsh -f`` script, then the inventory is read again to check the
+    result.
+
+    Returns the ``result``, the ``removed`` and ``added`` rule names, the
+    ``unchanged`` names, the ``failed`` names whose rules still differ
+    from the desired ones after the run, the ``lost`` names that were
+    deleted but could not be added again, and a ``comment``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' xjoker_firewall.apply_ruleset '[{name: web, localport: "80,443"}, {name: rdp, localport: 3389, remoteip: 10.0.0.0/8}]'
+        salt '*' xjoker_firewall.apply_ruleset "$(cat rules.json)" prune='salt-*' test=True
+    '''
+    remove, add, unchanged = _ruleset_plan(rules, prune, _inventory(refresh=True))
+    ret = {
+        'result': True,
+        'removed': remove,
+        'added': [x['name'] for x in add],
+        'unchanged': unchanged,
+        'failed': [],
+        'lost': [],
+        'comment': '',
+    }
+    if not remove and not add:
+        ret['comment'] = 'The firewall rules are already in the desired state'
+        return ret
+    if test:
+        ret['result'] = None
+        ret['comment'] = 'The firewall rules would be changed'
+        return ret
+
+    lines = [_script_line(['delete', 'rule', 'name={0}'.format(name)]) for name in remove]
+    lines.extend(_script_line(['add', 'rule'] + _add_rule_args(rule)) for rule in add)
+    output = _run_script(lines)
+    _invalidate_inventory()
+
+    inventory = _inventory(refresh=True)
+    remove_left, add_left, _ = _ruleset_plan(rules, prune, inventory)
+    if remove_left or add_left:
+        failed = set(remove_left + [x['name'] for x in add_left])
+        ret['result'] = False
+        ret['failed'] = sorted(failed)
+        ret['added'] = [x for x in ret['added'] if x not in failed]
+        ret['lost'] = sorted(set(x['name'] for x in add_left if x['name'] in remove
+                                 and x['name'].lower() not in inventory['names']))
+        ret['comment'] = 'netsh left rules to change: {0}'.format(', '.join(ret['failed']))
+        if ret['lost']:
+            ret['comment'] += '; deleted but not added again: {0}'.format(', '.join(ret['lost']))
+        ret['comment'] += '\n{0}'.format(output.strip())
+    else:
+        ret['comment'] = 'Removed {0} and added {1} firewall rules'.format(
+            len(remove), len(add))
+    return ret